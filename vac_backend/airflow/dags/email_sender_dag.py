@@ -11,6 +11,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from utils.valid_appointment_extraction import save_appointments_to_json
 from utils.appointment_email_sender import send_emails
 
+# parallel send tasks, each owning a contiguous appointment-id range
+EMAIL_SHARDS = int(os.getenv("EMAIL_SHARDS", 4))
+
 # default arguments of a DAG
 default_args = {
     'owner': 'DainyNguyen',
@@ -41,10 +44,14 @@ with DAG(
         python_callable=save_appointments_to_json
     )
 
-    send_emails = PythonOperator(
-        task_id="send_emails_to_patients",
-        python_callable=send_emails
-    )
+    send_emails = [
+        PythonOperator(
+            task_id=f"send_emails_to_patients_{shard}",
+            python_callable=send_emails,
+            op_kwargs={"shard": shard, "shards": EMAIL_SHARDS}
+        )
+        for shard in range(EMAIL_SHARDS)
+    ]
 
     end_pipeline = EmptyOperator(
         task_id="end_pipeline"
@@ -1,68 +1,146 @@
-from datetime import datetime, timedelta
-import json
 from dotenv import load_dotenv
+import logging
 import os
+from sendgrid import SendGridAPIClient
+from utils.appointment_stream import (read_header, iter_appointments, load_checkpoint, save_checkpoint,
+                                      dumps_line, shard_of)
+from utils.delivery_ledger import DeliveryLedger
+from utils.email_dispatcher import EmailDispatcher
+from utils import email_templates
+from utils.valid_appointment_extraction import get_mysql_connection
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 api_key = os.getenv("SENDGRID_API_KEY")
+SENDGRID_HOST = os.getenv("SENDGRID_API_HOST", "https://api.sendgrid.com")
 APPOINTMENTS_FILE = os.getenv("APPOINTMENTS_FILE_PATH")
+STATUS_FILE = os.getenv("APPOINTMENTS_STATUS_FILE_PATH") or f"{APPOINTMENTS_FILE}.status"
+CHECKPOINT_EVERY = int(os.getenv("APPOINTMENTS_CHECKPOINT_EVERY", 1000))
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", 8))
+EMAIL_RATE_PER_SECOND = float(os.getenv("EMAIL_RATE_PER_SECOND", 10))
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", 4))
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", email_templates.MAX_PERSONALIZATIONS))
+REMINDER_TEMPLATE = "appointment_reminder"
+REMINDER_LOCALE = os.getenv("REMINDER_LOCALE", "vi")
 
+_client = None
 
-def email(app, to_mail):
-    try:
-        # ssl._create_default_https_context = ssl._create_unverified_context
-        from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import (Mail, Attachment, FileContent, FileName, FileType, Disposition)
-        import base64
 
+def get_client():
+    global _client
+    if _client is None:
         if not api_key:
             raise ValueError("SendGrid API key is missing or empty")
+        _client = SendGridAPIClient(api_key, host=SENDGRID_HOST)
+    return _client
 
-        message = Mail(
-            from_email='dainnguyen1307@gmail.com',
-            to_emails=to_mail,
-            subject='Nhắc Nhở Lịch Tiêm Chủng Từ VaxServe',
-            html_content='<img src="https://schaeffer.usc.edu/wp-content/uploads/2024/10/covid-vaccine-web-2.png"'
-                         'style="width:300px; height:auto;">'
-                         '<h1> Nhắc nhở lịch tiêm chủng </h1>'
-                         f'<br>Tên bệnh nhân: <b>{app["patient_name"]}</b><br>'
-                         f'<br>Số điện thoại: <b>{app["phone"]}</b><br>'
-                         f'<br>Ngày hẹn tiêm: <b>{app["scheduled_date"]}</b><br>'
-                         f'<br>Địa điểm: Khách hàng vui lòng đến địa chỉ này: <b>{app["location"]}</b><br>'
-                         f'<br>Ghi chú: {app["notes"]}<br>'
-                         f'<br>Lưu ý: Nhớ mang theo <b>CĂN CƯỚC CÔNG DÂN</b> và <b>BẢO HIỂM Y TẾ</b> bạn nhé!!<br>'
-        )
-
-        sg = SendGridAPIClient(api_key)
-        response = sg.send(message)
-        return True
-    except Exception as e:
-        print(f"Error sending email to {to_mail}: {str(e)}")
-        return False
-
-
-def send_emails():
-    try:
-        with open(APPOINTMENTS_FILE, "r", encoding="utf-8") as file:
-            data = json.load(file)
 
-        valid_appointments = data.get("appointments", [])
-        if not valid_appointments:
+def get_dispatcher():
+    return EmailDispatcher(get_client(),
+                           workers=EMAIL_WORKERS,
+                           rate_per_second=EMAIL_RATE_PER_SECOND,
+                           max_retries=EMAIL_MAX_RETRIES)
+
+
+def iter_chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def send_chunk(dispatcher, ledger, chunk, status_file):
+    apps = []
+    for offset, app in chunk:
+        if app.get("email"):
+            apps.append(app)
+        else:
+            print(f"Missing email for patient: {app.get('patient_name', 'Unknown')}")
+            status_file.write(dumps_line({"id": app.get("id"), "email": None,
+                                          "status": "skipped", "error": "missing email"}))
+
+    owned = ledger.claim(app["id"] for app in apps)
+    claimed = []
+    for app in apps:
+        if app["id"] in owned:
+            claimed.append(app)
+        else:
+            status_file.write(dumps_line({"id": app["id"], "email": app["email"], "status": "skipped",
+                                          "error": "already delivered, claimed or out of attempts"}))
+
+    # one SendGrid request per batch, each recipient is a personalization
+    template = email_templates.get_template(REMINDER_TEMPLATE, REMINDER_LOCALE)
+    jobs = ((batch, email_templates.build_batch(template, batch))
+            for batch in email_templates.iter_batches(claimed, EMAIL_BATCH_SIZE))
+    results = [(app, result) for batch, result in dispatcher.dispatch(jobs) for app in batch]
+    ledger.record((app["id"], result) for app, result in results)
+
+    sent = 0
+    failed_ids = set()
+    for app, result in results:
+        status_file.write(dumps_line({"id": app["id"], "email": app["email"], **result}))
+        if result["status"] == "sent":
+            sent += 1
+        else:
+            failed_ids.add(app["id"])
+            print(f"Error sending email to {app['email']}: {result.get('error')}")
+    status_file.flush()
+
+    # the offset after the last record before the first failure: a resume must not skip a failed one
+    settled = None
+    for offset, app in chunk:
+        if app.get("id") in failed_ids:
+            break
+        settled = offset
+    return sent, len(failed_ids), settled
+
+
+def send_emails(shard=0, shards=1):
+    connection = None
+    try:
+        header = read_header(APPOINTMENTS_FILE)
+        if not header.get("sum_number_of_appointments"):
             print("No appointments found to send emails for")
             return
-        patient_email = None
-        for app in valid_appointments:
-            try:
-                patient_email = app.get("email")
-                if not patient_email:
-                    print(f"Missing email for patient: {app.get('patient_name', 'Unknown')}")
-                    continue
-
-                print(f"Sending email to: {patient_email} for patient: {app['patient_name']}")
-                email(app, patient_email)
-                print(f"Successfully sent email to {patient_email}")
-            except Exception as e:
-                print(f"Error sending email to {patient_email}: {str(e)}")
-    except Exception as e:
-        print(f"Error in send_emails function: {str(e)}")
+
+        suffix = f".{shard}" if shards > 1 else ""
+        offset = load_checkpoint(APPOINTMENTS_FILE, header, suffix)
+        if offset:
+            print(f"Resuming from byte offset {offset}")
+
+        connection = get_mysql_connection()
+        ledger = DeliveryLedger(connection, header["scheduled_date"], REMINDER_TEMPLATE,
+                                token=f"{header['generated_at']}/{shard}")
+        dispatcher = get_dispatcher()
+        records = ((offset, app) for offset, app in iter_appointments(APPOINTMENTS_FILE, offset)
+                   if shard_of(app["id"], header, shards) == shard)
+
+        total_sent = total_failed = 0
+        # the checkpoint follows the records that are done with; from the first failure on it stays put,
+        # and the rest of the file is still sent
+        with open(f"{STATUS_FILE}{suffix}", "ab") as status_file:
+            for chunk in iter_chunks(records, CHECKPOINT_EVERY):
+                sent, failed, settled = send_chunk(dispatcher, ledger, chunk, status_file)
+                total_sent += sent
+                if not total_failed and settled is not None:
+                    save_checkpoint(APPOINTMENTS_FILE, header, settled, suffix)
+                total_failed += failed
+
+        print(f"Shard {shard}/{shards}: sent {total_sent} emails, {total_failed} failed, "
+              f"results in {STATUS_FILE}{suffix}")
+        if total_failed:
+            # Airflow retries the task, the ledger hands the failed reminders back until they run out of attempts
+            raise RuntimeError(f"{total_failed} reminders failed to send (shard {shard}/{shards})")
+    except Exception:
+        # the task has to fail: Airflow retries it, and the retry re-claims what this run left pending
+        logger.exception("Error in send_emails (shard %s/%s)", shard, shards)
+        raise
+    finally:
+        if connection and connection.is_connected():
+            connection.close()
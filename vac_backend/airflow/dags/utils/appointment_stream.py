@@ -0,0 +1,71 @@
+import json
+import os
+
+# Line-delimited handoff file: the first line is a header object, every
+# following line is one appointment. Offsets are byte positions in the file.
+
+
+def dumps_line(obj):
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def write_appointments(path, header, appointments):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    count = 0
+    with open(tmp_path, "wb") as file:
+        file.write(dumps_line(header))
+        for app in appointments:
+            file.write(dumps_line(app))
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_header(path):
+    with open(path, "rb") as file:
+        return json.loads(file.readline())
+
+
+def iter_appointments(path, offset=None):
+    # yields (offset after the record, record); resuming from that offset skips it
+    with open(path, "rb") as file:
+        header_line = file.readline()
+        if offset is None or offset < len(header_line):
+            offset = len(header_line)
+        file.seek(offset)
+        for line in iter(file.readline, b""):
+            offset += len(line)
+            if line.strip():
+                yield offset, json.loads(line)
+
+
+def checkpoint_path(path, suffix=""):
+    return f"{path}.offset{suffix}"
+
+
+def load_checkpoint(path, header, suffix=""):
+    try:
+        with open(checkpoint_path(path, suffix), "r", encoding="utf-8") as file:
+            checkpoint = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    # a checkpoint from another extraction run does not apply to this file
+    if checkpoint.get("generated_at") != header.get("generated_at"):
+        return None
+    return checkpoint.get("offset")
+
+
+def save_checkpoint(path, header, offset, suffix=""):
+    tmp_path = f"{checkpoint_path(path, suffix)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"generated_at": header.get("generated_at"), "offset": offset}, file)
+    os.replace(tmp_path, checkpoint_path(path, suffix))
+
+
+def shard_of(app_id, header, shards):
+    # contiguous appointment-id ranges between the header's min_id and max_id
+    if shards <= 1 or header.get("min_id") is None:
+        return 0
+    width = -(-(header["max_id"] - header["min_id"] + 1) // shards)
+    return (app_id - header["min_id"]) // width
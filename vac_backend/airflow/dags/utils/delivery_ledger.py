@@ -0,0 +1,80 @@
+import os
+
+# Backed by the vac_management_reminderdelivery table (vac_management.models.ReminderDelivery),
+# unique on (appointment_id, scheduled_date, template).
+LEDGER_TABLE = "vac_management_reminderdelivery"
+LEASE_SECONDS = int(os.getenv("REMINDER_LEASE_SECONDS", 900))
+MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", 5))
+
+
+class DeliveryLedger:
+    def __init__(self, connection, scheduled_date, template, token):
+        # token identifies the claimant; a retry of the same shard reuses it and
+        # takes back the rows it left pending
+        self.connection = connection
+        self.connection.autocommit = True
+        self.scheduled_date = scheduled_date
+        self.template = template
+        self.token = token
+
+    def _in_clause(self, ids):
+        return ", ".join(["%s"] * len(ids))
+
+    def claim(self, appointment_ids):
+        ids = list(appointment_ids)
+        if not ids:
+            return set()
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(
+                f"INSERT IGNORE INTO {LEDGER_TABLE} "
+                "(appointment_id, scheduled_date, template, status, claim_token, claimed_at, attempts) "
+                "VALUES (%s, %s, %s, 'pending', %s, NOW(), 0)",
+                [(app_id, self.scheduled_date, self.template, self.token) for app_id in ids])
+
+            key = f"template = %s AND scheduled_date = %s AND appointment_id IN ({self._in_clause(ids)})"
+            params = [self.template, self.scheduled_date, *ids]
+            # out of attempts is final, for this claimant's own retries too
+            cursor.execute(
+                f"UPDATE {LEDGER_TABLE} SET status = 'pending', claim_token = %s, claimed_at = NOW() "
+                f"WHERE {key} AND status <> 'sent' AND attempts < %s AND (claim_token = %s "
+                "OR status = 'failed' "
+                "OR (status = 'pending' AND claimed_at < NOW() - INTERVAL %s SECOND))",
+                [self.token, *params, MAX_ATTEMPTS, self.token, LEASE_SECONDS])
+
+            cursor.execute(
+                f"SELECT appointment_id FROM {LEDGER_TABLE} "
+                f"WHERE {key} AND status = 'pending' AND claim_token = %s",
+                [*params, self.token])
+            return {row[0] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def record(self, results):
+        # results: iterable of (appointment_id, result dict from EmailDispatcher)
+        sent, failed = [], []
+        for app_id, result in results:
+            if result["status"] == "sent":
+                sent.append((app_id, result))
+            else:
+                failed.append((app_id, result))
+
+        cursor = self.connection.cursor()
+        try:
+            if sent:
+                ids = [app_id for app_id, _ in sent]
+                cursor.execute(
+                    f"UPDATE {LEDGER_TABLE} SET status = 'sent', sent_at = NOW(), attempts = attempts + 1, "
+                    "error = NULL "
+                    f"WHERE template = %s AND scheduled_date = %s AND claim_token = %s "
+                    f"AND appointment_id IN ({self._in_clause(ids)})",
+                    [self.template, self.scheduled_date, self.token, *ids])
+            if failed:
+                cursor.executemany(
+                    f"UPDATE {LEDGER_TABLE} SET status = 'failed', attempts = attempts + 1, error = %s "
+                    "WHERE template = %s AND scheduled_date = %s AND claim_token = %s AND appointment_id = %s",
+                    [(result.get("error"), self.template, self.scheduled_date, self.token, app_id)
+                     for app_id, result in failed])
+        finally:
+            cursor.close()
@@ -0,0 +1,80 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from python_http_client.exceptions import HTTPError
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    if isinstance(error, HTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (URLError, TimeoutError, ConnectionError))
+
+
+def retry_delay(error, attempt, backoff):
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return backoff * (2 ** attempt) + random.uniform(0, backoff)
+
+
+class EmailDispatcher:
+    def __init__(self, client, workers=8, rate_per_second=10, max_retries=4, backoff=0.5):
+        self.client = client
+        self.workers = workers
+        self.bucket = TokenBucket(rate_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def send(self, message):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                response = self.client.send(message)
+                return {"status": "sent", "status_code": response.status_code, "attempts": attempt + 1}
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    return {
+                        "status": "failed",
+                        "status_code": getattr(e, "status_code", None),
+                        "error": str(e),
+                        "attempts": attempt + 1,
+                    }
+                time.sleep(retry_delay(e, attempt, self.backoff))
+                attempt += 1
+
+    def dispatch(self, jobs):
+        # jobs: iterable of (key, message); yields (key, result) in submission order
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [(key, pool.submit(self.send, message)) for key, message in jobs]
+            for key, future in futures:
+                yield key, future.result()
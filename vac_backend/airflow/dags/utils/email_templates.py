@@ -0,0 +1,94 @@
+import html
+import re
+from sendgrid.helpers.mail import Mail, Personalization, To, Substitution
+
+FROM_EMAIL = 'dainnguyen1307@gmail.com'
+MAX_PERSONALIZATIONS = 1000  # SendGrid limit per request
+
+FIELD_PATTERN = re.compile(r"\{(\w+)\}")
+
+
+class CompiledTemplate:
+    def __init__(self, subject, body):
+        self.subject = subject
+        # split once into literal text (even positions) and field names (odd positions)
+        self.parts = FIELD_PATTERN.split(body)
+        self.fields = sorted(set(self.parts[1::2]))
+        # body with SendGrid substitution tags, sent once per batch
+        self.tagged_body = "".join(part if i % 2 == 0 else self.tag(part) for i, part in enumerate(self.parts))
+
+    @staticmethod
+    def tag(field):
+        return f"-{field}-"
+
+    @staticmethod
+    def escape(value):
+        return html.escape("" if value is None else str(value))
+
+    def render(self, context):
+        return "".join(part if i % 2 == 0 else self.escape(context.get(part))
+                       for i, part in enumerate(self.parts))
+
+    def substitutions(self, context):
+        return {self.tag(field): self.escape(context.get(field)) for field in self.fields}
+
+
+TEMPLATES = {
+    ('appointment_reminder', 'vi'): CompiledTemplate(
+        subject='Nhắc Nhở Lịch Tiêm Chủng Từ VaxServe',
+        body='<img src="https://schaeffer.usc.edu/wp-content/uploads/2024/10/covid-vaccine-web-2.png"'
+             'style="width:300px; height:auto;">'
+             '<h1> Nhắc nhở lịch tiêm chủng </h1>'
+             '<br>Tên bệnh nhân: <b>{patient_name}</b><br>'
+             '<br>Số điện thoại: <b>{phone}</b><br>'
+             '<br>Ngày hẹn tiêm: <b>{scheduled_date}</b><br>'
+             '<br>Địa điểm: Khách hàng vui lòng đến địa chỉ này: <b>{location}</b><br>'
+             '<br>Ghi chú: {notes}<br>'
+             '<br>Lưu ý: Nhớ mang theo <b>CĂN CƯỚC CÔNG DÂN</b> và <b>BẢO HIỂM Y TẾ</b> bạn nhé!!<br>'
+    ),
+    ('appointment_reminder', 'en'): CompiledTemplate(
+        subject='Your VaxServe Vaccination Appointment Reminder',
+        body='<img src="https://schaeffer.usc.edu/wp-content/uploads/2024/10/covid-vaccine-web-2.png"'
+             'style="width:300px; height:auto;">'
+             '<h1> Vaccination appointment reminder </h1>'
+             '<br>Patient name: <b>{patient_name}</b><br>'
+             '<br>Phone number: <b>{phone}</b><br>'
+             '<br>Appointment date: <b>{scheduled_date}</b><br>'
+             '<br>Location: Please come to this address: <b>{location}</b><br>'
+             '<br>Notes: {notes}<br>'
+             '<br>Reminder: Please bring your <b>CITIZEN ID CARD</b> and <b>HEALTH INSURANCE CARD</b>!<br>'
+    ),
+}
+
+
+def get_template(name, locale='vi'):
+    try:
+        return TEMPLATES[(name, locale)]
+    except KeyError:
+        return TEMPLATES[(name, 'vi')]
+
+
+def build_message(template, context, to_mail):
+    return Mail(from_email=FROM_EMAIL, to_emails=to_mail, subject=template.subject,
+                html_content=template.render(context))
+
+
+def build_batch(template, contexts):
+    # one request for up to MAX_PERSONALIZATIONS recipients; contexts need an "email" key
+    if len(contexts) > MAX_PERSONALIZATIONS:
+        raise ValueError(f"At most {MAX_PERSONALIZATIONS} recipients per batch")
+
+    message = Mail(from_email=FROM_EMAIL, subject=template.subject, html_content=template.tagged_body)
+    for context in contexts:
+        personalization = Personalization()
+        personalization.add_to(To(context["email"]))
+        for key, value in template.substitutions(context).items():
+            personalization.add_substitution(Substitution(key, value))
+        message.add_personalization(personalization)
+    return message
+
+
+def iter_batches(contexts, size=MAX_PERSONALIZATIONS):
+    size = min(size, MAX_PERSONALIZATIONS)
+    for start in range(0, len(contexts), size):
+        yield contexts[start:start + size]
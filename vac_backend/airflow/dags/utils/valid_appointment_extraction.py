@@ -1,56 +1,29 @@
 from datetime import datetime, timedelta
+import logging
 import os
-import json
 import sys
 import mysql.connector
 from dotenv import load_dotenv
 
-load_dotenv()
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils.appointment_stream import write_appointments
+
 load_dotenv()
+
+logger = logging.getLogger(__name__)
+
 APPOINTMENTS_FILE = os.getenv("APPOINTMENTS_FILE_PATH")
+BATCH_SIZE = int(os.getenv("APPOINTMENTS_BATCH_SIZE", 1000))
 
 DB_CONFIG = {
     'host': 'host.docker.internal',
     'port': 3306,
     'user': 'root',
-    'password': f'{os.getenv('MYSQLPASSWORD')}',
-    'database': f'{os.getenv('DATABASE')}'
+    'password': f'{os.getenv("MYSQLPASSWORD")}',
+    'database': f'{os.getenv("DATABASE")}'
 }
 
 
-def get_citizen_info(connection, citizen_id):
-    cursor = None
-    try:
-        cursor = connection.cursor(dictionary=True)
-
-        sql_query = """
-        SELECT 
-            id,
-            email,
-            first_name,
-            last_name,
-            phone_number
-        FROM vac_management_baseuser
-        WHERE id = %s
-        """
-
-        cursor.execute(sql_query, (citizen_id,))
-        citizen = cursor.fetchone()
-
-        return citizen
-
-    except mysql.connector.Error as e:
-        print(f"MySQL Error getting citizen info: {e}")
-        return None
-    except Exception as e:
-        print(f"Error getting citizen info: {str(e)}")
-        return None
-    finally:
-        if cursor:
-            cursor.close()
-
 def get_mysql_connection():
     try:
         connection = mysql.connector.connect(**DB_CONFIG)
@@ -59,92 +32,100 @@ def get_mysql_connection():
         print(f"Error connecting to MySQL: {e}")
         raise
 
-def get_valid_appointments():
-    connection = None
-    cursor = None
-
-    try:
-        today = datetime.now().date()
-        next_day = today + timedelta(days=1)
-        print(f"Filtering appointments for date: {next_day}")
 
-        sql_query = """
-        SELECT 
-            id,
-            scheduled_date,
-            location,
-            notes,
-            citizen_id,
-            staff_id,
-            active
-        FROM vac_management_appointment
-        WHERE DATE(scheduled_date) = %s 
-        AND active = 1
+VALID_APPOINTMENTS_WHERE = """
+        WHERE a.scheduled_date >= %s
+        AND a.scheduled_date < %s
+        AND a.active = 1
+"""
+
+
+SUMMARY_QUERY = ("SELECT COUNT(*), MIN(a.id), MAX(a.id) FROM vac_management_appointment a"
+                 + VALID_APPOINTMENTS_WHERE)
+
+VALID_APPOINTMENTS_QUERY = """
+        SELECT
+            a.id,
+            a.scheduled_date,
+            a.location,
+            a.notes,
+            a.citizen_id,
+            a.staff_id,
+            u.email,
+            u.first_name,
+            u.last_name,
+            u.phone_number
+        FROM vac_management_appointment a
+        JOIN vac_management_baseuser u ON u.id = a.citizen_id
+        """ + VALID_APPOINTMENTS_WHERE + """
+        ORDER BY a.id
         """
-        connection = get_mysql_connection()
-        cursor = connection.cursor(dictionary=True)
 
-        cursor.execute(sql_query, (next_day,))
-        appointments = cursor.fetchall()
 
-        return appointments
+def summarize_valid_appointments(connection, day):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(SUMMARY_QUERY, (day, day + timedelta(days=1)))
+        count, min_id, max_id = cursor.fetchone()
+        return {"sum_number_of_appointments": count, "min_id": min_id, "max_id": max_id}
+    finally:
+        cursor.close()
+
+
+def iter_valid_appointments(connection, day, batch_size=BATCH_SIZE):
+    # unbuffered cursor: rows stay on the server and are pulled batch_size at a time
+    cursor = connection.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(VALID_APPOINTMENTS_QUERY, (day, day + timedelta(days=1)))
 
-    except mysql.connector.Error as e:
-        print(f"MySQL Error: {e}")
-        return []
-    except Exception as e:
-        print(f"Error getting valid appointments: {str(e)}")
-        return []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
     finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-            print("MySQL connection closed")
+        cursor.close()
+
+
+def to_appointment_data(app):
+    return {
+        "id": app['id'],
+        "scheduled_date": str(app['scheduled_date']),
+        "location": app['location'],
+        "notes": app['notes'] if app['notes'] else "NO COMMENT",
+        "citizen_id": app['citizen_id'],
+        "staff_id": app['staff_id'],
+        "email": app['email'],
+        "patient_name": f"{app['first_name']} {app['last_name']}",
+        "phone": app['phone_number']
+    }
+
 
 def save_appointments_to_json():
+    connection = None
     try:
-        valid_appointments = get_valid_appointments()
-
-        appointments_data = {
-            "sum_number_of_appointments": len(valid_appointments),
-            "appointments": []
-        }
+        next_day = datetime.now().date() + timedelta(days=1)
+        print(f"Filtering appointments for date: {next_day}")
 
         connection = get_mysql_connection()
-        cursor = connection.cursor(dictionary=True)
-
-        for app in valid_appointments:
-            citizen = get_citizen_info(connection, app['citizen_id'])
-            # appointments_data["appointments"].append({
-            #     "id": app.id,
-            #     "scheduled_date": str(app.scheduled_date),
-            #     "location": app.location,
-            #     "notes": app.notes if app.notes else "NO COMMENT",
-            #     "citizen_id": app.citizen_id,
-            #     "staff_id": app.staff_id,
-            #     "email": citizen.email,
-            #     "patient_name": f"{citizen.first_name} {citizen.last_name}",
-            #     "phone": citizen.phone_number
-            # })
-            appointments_data["appointments"].append({
-                "id": app['id'],
-                "scheduled_date": str(app['scheduled_date']),
-                "location": app['location'],
-                "notes": app['notes'] if app['notes'] else "NO COMMENT",
-                "citizen_id": app['citizen_id'],
-                "staff_id": app['staff_id'],
-                "email": citizen['email'],
-                "patient_name": f"{citizen['first_name']} {citizen['last_name']}",
-                "phone": citizen['phone_number']
-            })
-
-        os.makedirs(os.path.dirname(APPOINTMENTS_FILE), exist_ok=True)
-        with open(APPOINTMENTS_FILE, "w", encoding="utf-8") as file:
-            json.dump(appointments_data, file, indent=4, ensure_ascii=False)
-
-        print(f"Valid appointments saved to {APPOINTMENTS_FILE}")
-        return True
-    except Exception as e:
-        print(f"Error saving appointments to JSON: {str(e)}")
-        return False
+        # the count and the rows are read from the same snapshot
+        connection.start_transaction(consistent_snapshot=True, readonly=True)
+        header = {
+            "scheduled_date": str(next_day),
+            "generated_at": datetime.now().isoformat(),
+            **summarize_valid_appointments(connection, next_day),
+        }
+        appointments = (to_appointment_data(app) for app in iter_valid_appointments(connection, next_day))
+        count = write_appointments(APPOINTMENTS_FILE, header, appointments)
+        connection.commit()
+
+        print(f"{count} valid appointments saved to {APPOINTMENTS_FILE}")
+        return count
+    except Exception:
+        # the task has to fail, the send tasks must not run on a missing or stale file
+        logger.exception("Error saving appointments")
+        raise
+    finally:
+        if connection and connection.is_connected():
+            connection.close()
+            print("MySQL connection closed")
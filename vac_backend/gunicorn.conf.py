@@ -0,0 +1,22 @@
+# gunicorn -c gunicorn.conf.py
+# GUNICORN_PROFILE=wsgi: threaded sync workers, a view waiting on Stripe holds one of the threads
+# GUNICORN_PROFILE=asgi: one event loop per worker, the async views (payment_sheet) wait without holding
+#                        anything; sync views run in threads of the worker
+import multiprocessing
+import os
+
+profile = os.getenv('GUNICORN_PROFILE', 'wsgi')
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+if workers > 1 and not os.getenv('CACHE_REDIS_URL'):
+    # each worker would keep its own catalog cache and version, a write reaches one of them
+    raise SystemExit('CACHE_REDIS_URL is required with more than one worker (set GUNICORN_WORKERS=1 without it)')
+timeout = 60
+
+if profile == 'asgi':
+    wsgi_app = 'vac_backend.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'vac_backend.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', 4))
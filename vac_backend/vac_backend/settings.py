@@ -47,6 +47,7 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'vac_management.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -111,6 +112,33 @@ import pymysql
 
 pymysql.install_as_MySQLdb()
 
+# shared cache behind the per-process catalog LRU; .env: CACHE_REDIS_URL = 'redis://...'
+# Needed with more than one worker: the catalog version is only shared through it, LocMemCache
+# invalidates the worker that handled the write and no other
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    } if CACHE_REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+CATALOG_CACHE_TIMEOUT = 60 * 60
+CATALOG_LOCAL_CACHE_SIZE = 512
+
+# Stripe; STRIPE_API_BASE points the client at another server, e.g. stripe-mock
+STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
+STRIPE_API_VERSION = os.getenv('STRIPE_API_VERSION')
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+STRIPE_CURRENCY = 'usd'
+STRIPE_MAX_NETWORK_RETRIES = 2
+STRIPE_TIMEOUT = 30
+
+# requests slower than this are logged with their slowest SQL, for the given share of them
+METRICS_SLOW_REQUEST_MS = 500
+METRICS_SLOW_SAMPLE_RATE = 1.0
+
 AUTH_USER_MODEL = 'vac_management.BaseUser'
 
 # Password validation
@@ -169,5 +197,11 @@ CKEDITOR_IMAGE_BACKEND = "pillow"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# images sent through the API are uploaded by a pool of background threads, see vac_management/uploads.py
+UPLOAD_BACKEND = 'vac_management.uploads.CloudinaryBackend'
+UPLOAD_WORKERS = 4
+UPLOAD_SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+UPLOAD_MAX_DIMENSION = 1600
+
 CLIENT_ID = f"{os.getenv('CLIENT_ID')}"
 CLIENT_SECRET = f"{os.getenv('CLIENT_SECRET')}"
\ No newline at end of file
@@ -15,9 +15,13 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+import os
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 from django.urls import path, include, re_path
+from vac_management import thumbnails
 from vac_management.admin import admin_site
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
@@ -50,4 +54,8 @@ urlpatterns = [
             schema_view.with_ui('redoc', cache_timeout=0),
             name='schema-redoc'),
     path('o/', include('oauth2_provider.urls', namespace='oauth2_provider')),
-]
\ No newline at end of file
+]
+
+# only the image variants under MEDIA_ROOT, served by the web server in production
+urlpatterns += static(f'{settings.MEDIA_URL}{thumbnails.variants_dir()}/',
+                      document_root=os.path.join(settings.MEDIA_ROOT, thumbnails.variants_dir()))
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class VaccinationManagementConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vac_management'
+
+    def ready(self):
+        from vac_management import signals
@@ -0,0 +1,146 @@
+from collections import Counter
+from django.db import transaction
+from django.utils import timezone
+from vac_management import inventory, rollups, serializers, timeline
+from vac_management.caching import model_versions
+from vac_management.models import Appointment, AppointmentVaccine, Doctor, Vaccine
+
+BULK_MAX_ITEMS = 1000
+BULK_BATCH_SIZE = 500
+STATUS_TRANSITIONS = {
+    'scheduled': ('completed', 'cancelled'),
+}
+
+
+class BulkError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        # one dict per input item, empty for items that are valid
+        self.errors = errors
+
+
+def validate_items(serializer_class, items):
+    validated, errors = [], []
+    for item in items:
+        serializer = serializer_class(data=item)
+        if serializer.is_valid():
+            validated.append(serializer.validated_data)
+            errors.append({})
+        else:
+            validated.append(None)
+            errors.append(dict(serializer.errors))
+    return validated, errors
+
+
+def existing_ids(model, ids):
+    return set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+
+
+def appointment_vaccine_snapshot(ids):
+    return rollups.snapshot_scopes([(rollups.appointment_vaccine_rows, AppointmentVaccine.objects.filter(id__in=ids))])
+
+
+def bulk_create_appointment_vaccines(items):
+    validated, errors = validate_items(serializers.AppointmentVaccineBulkCreateSerializer, items)
+    rows = [data for data in validated if data is not None]
+
+    related = {
+        'appointment': existing_ids(Appointment, {data['appointment'] for data in rows}),
+        'vaccine': existing_ids(Vaccine, {data['vaccine'] for data in rows}),
+        'doctor': existing_ids(Doctor, {data['doctor'] for data in rows}),
+    }
+    taken = set(AppointmentVaccine.objects
+                .filter(appointment_id__in=related['appointment'])
+                .values_list('appointment_id', 'vaccine_id', 'doctor_id'))
+
+    for i, data in enumerate(validated):
+        if data is None:
+            continue
+        for field, ids in related.items():
+            if data[field] not in ids:
+                errors[i][field] = [f'Invalid pk "{data[field]}" - object does not exist.']
+        key = (data['appointment'], data['vaccine'], data['doctor'])
+        if key in taken:
+            errors[i]['non_field_errors'] = ['The fields appointment, vaccine, doctor must make a unique set.']
+        taken.add(key)
+
+    if any(errors):
+        raise BulkError(errors)
+
+    objs = [AppointmentVaccine(appointment_id=data['appointment'], vaccine_id=data['vaccine'],
+                               doctor_id=data['doctor'], dose_quantity_used=data['dose_quantity_used'],
+                               status=data['status'], notes=data.get('notes'), cost=data.get('cost'))
+            for data in rows]
+
+    with transaction.atomic():
+        AppointmentVaccine.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+        if all(obj.pk for obj in objs):
+            ids = [obj.pk for obj in objs]
+        else:
+            # MySQL does not return ids from a bulk insert, the unique key finds them
+            lookup = {(a, v, d): pk for pk, a, v, d in AppointmentVaccine.objects
+                      .filter(appointment_id__in={obj.appointment_id for obj in objs})
+                      .values_list('id', 'appointment_id', 'vaccine_id', 'doctor_id')}
+            ids = [lookup[(obj.appointment_id, obj.vaccine_id, obj.doctor_id)] for obj in objs]
+
+        # bulk_create sends no signals, the rollups, stock, timeline and list validators are updated here
+        rollups.apply_delta(Counter(), appointment_vaccine_snapshot(ids))
+        movements = []
+        for obj, pk in zip(objs, ids):
+            movements.extend(inventory.build_movements(None, inventory.appointment_vaccine_holdings(obj),
+                                                       appointment_vaccine_id=pk))
+        inventory.apply_movements(movements)
+        timeline.refresh('appointment_vaccine', ids)
+        transaction.on_commit(lambda: model_versions.bump(AppointmentVaccine), robust=True)
+
+    return ids
+
+
+def bulk_update_status(items):
+    validated, errors = validate_items(serializers.AppointmentVaccineStatusSerializer, items)
+    seen = set()
+    for i, data in enumerate(validated):
+        if data is None:
+            continue
+        if data['id'] in seen:
+            errors[i]['id'] = ['Duplicate id in this request.']
+        seen.add(data['id'])
+
+    with transaction.atomic():
+        objs = (AppointmentVaccine.objects.select_for_update()
+                .filter(active=True).in_bulk({data['id'] for data in validated if data is not None}))
+
+        changed = []
+        for i, data in enumerate(validated):
+            if data is None or errors[i]:
+                continue
+            obj = objs.get(data['id'])
+            if obj is None:
+                errors[i]['id'] = ['Not found.']
+            elif obj.status != data['status']:
+                if data['status'] not in STATUS_TRANSITIONS.get(obj.status, ()):
+                    errors[i]['status'] = [f'Cannot change status from "{obj.status}" to "{data["status"]}".']
+                else:
+                    changed.append((obj, data['status']))
+
+        if any(errors):
+            raise BulkError(errors)
+
+        ids = [obj.pk for obj, _ in changed]
+        before = appointment_vaccine_snapshot(ids)
+        movements = []
+        now = timezone.now()
+        for obj, status in changed:
+            held = inventory.appointment_vaccine_holdings(obj)
+            obj.status = status
+            obj.updated_date = now
+            movements.extend(inventory.build_movements(held, inventory.appointment_vaccine_holdings(obj),
+                                                       appointment_vaccine_id=obj.pk))
+        AppointmentVaccine.objects.bulk_update([obj for obj, _ in changed], ['status', 'updated_date'],
+                                               batch_size=BULK_BATCH_SIZE)
+        rollups.apply_delta(before, appointment_vaccine_snapshot(ids))
+        inventory.apply_movements(movements)
+        timeline.refresh('appointment_vaccine', ids)
+        transaction.on_commit(lambda: model_versions.bump(AppointmentVaccine), robust=True)
+
+    return ids
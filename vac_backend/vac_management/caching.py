@@ -0,0 +1,209 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+from vac_management.models import ModelVersion
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+CATALOG_LOCAL_CACHE_SIZE = getattr(settings, 'CATALOG_LOCAL_CACHE_SIZE', 512)
+
+
+def new_version():
+    return {'version': f'{time.time_ns():x}', 'modified': int(time.time())}
+
+
+class LocalLRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class CatalogCache:
+    def __init__(self, maxsize=CATALOG_LOCAL_CACHE_SIZE, timeout=CATALOG_CACHE_TIMEOUT):
+        self.local = LocalLRU(maxsize)
+        self.timeout = timeout
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def get_version(self):
+        version = cache.get(CATALOG_VERSION_KEY)
+        if version is None:
+            # lost or never set: start a new version, which also drops every cached entry
+            version = new_version()
+            if not cache.add(CATALOG_VERSION_KEY, version, None):
+                version = cache.get(CATALOG_VERSION_KEY, version)
+        return version
+
+    def bump_version(self):
+        cache.set(CATALOG_VERSION_KEY, new_version(), None)
+
+    def get_or_build(self, key, version, builder):
+        # keys embed the version, so a bump makes old entries unreachable
+        full_key = f'catalog:{version["version"]}:{key}'
+        value = self.local.get(full_key)
+        if value is not None:
+            self.count('local_hits')
+            return value
+
+        value = cache.get(full_key)
+        if value is not None:
+            self.count('shared_hits')
+        else:
+            self.count('misses')
+            value = builder()
+            cache.set(full_key, value, self.timeout)
+        self.local.set(full_key, value)
+        return value
+
+    def clear(self):
+        self.local.clear()
+        cache.delete(CATALOG_VERSION_KEY)
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        stats['hit_rate'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0
+        stats['version'] = self.get_version()['version']
+        return stats
+
+
+catalog_cache = CatalogCache()
+
+
+def not_modified(request, etag, modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if modified is None:
+        return False
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since') or '')
+    return if_modified_since is not None and modified <= if_modified_since
+
+
+def catalog_response(request, builder, status_code=status.HTTP_200_OK):
+    version = catalog_cache.get_version()
+    etag = quote_etag(version['version'])
+    headers = {'ETag': etag, 'Last-Modified': http_date(version['modified'])}
+
+    if not_modified(request, etag, version['modified']):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = hashlib.sha1(request.build_absolute_uri().encode('utf-8')).hexdigest()
+    data = catalog_cache.get_or_build(key, version, builder)
+    return Response(data, status=status_code, headers=headers)
+
+
+class CatalogCacheMixin:
+    # read-through cache for catalog GETs; writes go through the model signals that bump the version
+    def list(self, request, *args, **kwargs):
+        return catalog_response(request, lambda: super(CatalogCacheMixin, self).list(request, *args, **kwargs).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        return catalog_response(request,
+                                lambda: super(CatalogCacheMixin, self).retrieve(request, *args, **kwargs).data)
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:32])
+
+
+class ModelVersions:
+    # a version per model, bumped after commit by the signals on every write. Multi-table children share
+    # their parent's, a citizen saved through BaseUser changes the same rows
+    def label(self, model):
+        model = model._meta.concrete_model
+        return [model, *model._meta.get_parent_list()][-1]._meta.label_lower
+
+    def get_many(self, models):
+        # one indexed read; a model never written since the table exists is at version 0
+        labels = list(dict.fromkeys(self.label(model) for model in models))
+        rows = {label: (version, modified) for label, version, modified in
+                ModelVersion.objects.filter(label__in=labels).values_list('label', 'version', 'updated_date')}
+        return [{'version': str(rows[label][0]) if label in rows else '0',
+                 'modified': int(rows[label][1].timestamp()) if label in rows else None} for label in labels]
+
+    def bump(self, *models):
+        labels = list(dict.fromkeys(self.label(model) for model in models))
+        now = timezone.now()
+        with transaction.atomic():
+            ModelVersion.objects.bulk_create([ModelVersion(label=label, updated_date=now) for label in labels],
+                                             ignore_conflicts=True)
+            ModelVersion.objects.filter(label__in=labels).update(version=F('version') + 1, updated_date=now)
+
+
+model_versions = ModelVersions()
+
+
+class ConditionalGetMixin:
+    # validators come from the versions of every model the representation is read from, the row and its
+    # select_related relations: a 304 costs one small query, and deletes and renamed users change the ETag too
+    def get_validator_models(self):
+        models = [self.queryset.model]
+        for path in (*getattr(self, 'select_related_fields', ()), *getattr(self, 'prefetch_related_fields', ())):
+            model = self.queryset.model
+            for name in path.split('__'):
+                model = model._meta.get_field(name).related_model
+                models.append(model)
+        return models
+
+    def conditional_headers(self, request):
+        versions = model_versions.get_many(self.get_validator_models())
+        modified = max((version['modified'] for version in versions if version['modified'] is not None),
+                       default=None)
+        headers = {'ETag': make_etag(request.get_full_path(), *[version['version'] for version in versions])}
+        if modified is not None:
+            headers['Last-Modified'] = http_date(modified)
+        return headers, modified
+
+    def list(self, request, *args, **kwargs):
+        headers, modified = self.conditional_headers(request)
+        if not_modified(request, headers['ETag'], modified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        response = super().list(request, *args, **kwargs)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        headers, modified = self.conditional_headers(request)
+        if not_modified(request, headers['ETag'], modified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        response = super().retrieve(request, *args, **kwargs)
+        for name, value in headers.items():
+            response[name] = value
+        return response
@@ -0,0 +1,291 @@
+import csv
+import io
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from vac_management import perms
+from vac_management.models import Appointment, AppointmentVaccine, CampaignCitizen
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class Export:
+    # columns are (header, lookup) pairs read with values_list(), filters map a parameter to a lookup
+    def __init__(self, name, queryset, columns, filters):
+        self.name = name
+        self.queryset = queryset
+        self.columns = columns
+        self.filters = filters
+
+    def get_queryset(self, params):
+        queryset = self.queryset.all()
+        for param, (lookup, parse) in self.filters.items():
+            value = params.get(param)
+            if value in (None, ''):
+                continue
+            parsed = parse(value)
+            if parsed is None:
+                raise ExportError(f'Invalid value for {param}: "{value}".')
+            queryset = queryset.filter(**{lookup: parsed})
+        return queryset
+
+    def iter_chunks(self, queryset, chunk_size=EXPORT_CHUNK_SIZE):
+        # keyset pages on the primary key: the MySQL drivers buffer a whole result set even
+        # under .iterator(), separate bounded queries keep memory flat at any row count
+        lookups = [lookup for _, lookup in self.columns]
+        last = None
+        while True:
+            page = queryset.order_by('pk')
+            if last is not None:
+                page = page.filter(pk__gt=last)
+            rows = list(page.values_list('pk', *lookups)[:chunk_size])
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [row[1:] for row in rows]
+            if len(rows) < chunk_size:
+                return
+
+    def model_field(self, lookup):
+        model, field = self.queryset.model, None
+        for part in lookup.split('__'):
+            try:
+                field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                raise ExportError(f'{self.name}: unknown column {lookup}')
+            model = field.related_model
+        # citizens, staff and doctors are keyed by a parent link, follow it to the column type
+        while field.is_relation:
+            field = field.target_field
+        return field
+
+    def arrow_schema(self):
+        return pyarrow.schema([(header, arrow_type(self.model_field(lookup))) for header, lookup in self.columns])
+
+    def headers(self):
+        return [header for header, _ in self.columns]
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_text(value):
+    return value.strip() or None
+
+
+def parse_date_param(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+
+def arrow_type(field):
+    if isinstance(field, (models.AutoField, models.IntegerField)):
+        return pyarrow.int64()
+    if isinstance(field, models.FloatField):
+        return pyarrow.float64()
+    if isinstance(field, models.BooleanField):
+        return pyarrow.bool_()
+    if isinstance(field, models.DateTimeField):
+        return pyarrow.timestamp('us', tz='UTC')
+    if isinstance(field, models.DateField):
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+EXPORTS = {
+    'appointments': Export(
+        'appointments',
+        Appointment.objects.filter(active=True),
+        [
+            ('id', 'id'),
+            ('scheduled_date', 'scheduled_date'),
+            ('location', 'location'),
+            ('citizen_id', 'citizen_id'),
+            ('citizen_first_name', 'citizen__first_name'),
+            ('citizen_last_name', 'citizen__last_name'),
+            ('citizen_email', 'citizen__email'),
+            ('citizen_phone_number', 'citizen__phone_number'),
+            ('staff_id', 'staff_id'),
+            ('staff_shift', 'staff__shift'),
+            ('notes', 'notes'),
+            ('created_date', 'created_date'),
+        ],
+        {
+            'citizen_id': ('citizen_id', parse_int),
+            'staff_id': ('staff_id', parse_int),
+            'location': ('location__icontains', parse_text),
+            'date_from': ('scheduled_date__gte', parse_date_param),
+            'date_to': ('scheduled_date__lte', parse_date_param),
+        },
+    ),
+    'appointmentvaccine': Export(
+        'appointmentvaccine',
+        AppointmentVaccine.objects.filter(active=True),
+        [
+            ('id', 'id'),
+            ('appointment_id', 'appointment_id'),
+            ('scheduled_date', 'appointment__scheduled_date'),
+            ('location', 'appointment__location'),
+            ('citizen_id', 'appointment__citizen_id'),
+            ('citizen_first_name', 'appointment__citizen__first_name'),
+            ('citizen_last_name', 'appointment__citizen__last_name'),
+            ('vaccine_id', 'vaccine_id'),
+            ('vaccine_name', 'vaccine__vaccine_name'),
+            ('category_name', 'vaccine__category__category_name'),
+            ('doctor_id', 'doctor_id'),
+            ('dose_quantity_used', 'dose_quantity_used'),
+            ('status', 'status'),
+            ('cost', 'cost'),
+            ('notes', 'notes'),
+            ('updated_date', 'updated_date'),
+        ],
+        {
+            'status': ('status', parse_text),
+            'vaccine_id': ('vaccine_id', parse_int),
+            'citizen_id': ('appointment__citizen_id', parse_int),
+            'location': ('appointment__location__icontains', parse_text),
+            'date_from': ('appointment__scheduled_date__gte', parse_date_param),
+            'date_to': ('appointment__scheduled_date__lte', parse_date_param),
+        },
+    ),
+    'campaigncitizen': Export(
+        'campaigncitizen',
+        CampaignCitizen.objects.filter(active=True),
+        [
+            ('id', 'id'),
+            ('campaign_id', 'campaign_id'),
+            ('campaign_name', 'campaign__campaign_name'),
+            ('citizen_id', 'citizen_id'),
+            ('citizen_first_name', 'citizen__first_name'),
+            ('citizen_last_name', 'citizen__last_name'),
+            ('citizen_email', 'citizen__email'),
+            ('injection_date', 'injection_date'),
+            ('notes', 'notes'),
+        ],
+        {
+            'campaign_id': ('campaign_id', parse_int),
+            'citizen_id': ('citizen_id', parse_int),
+            'date_from': ('injection_date__gte', parse_date_param),
+            'date_to': ('injection_date__lte', parse_date_param),
+        },
+    ),
+}
+
+
+class Echo:
+    # csv.writer target that hands each line back instead of storing it
+    def write(self, value):
+        return value
+
+
+class ChunkSink(io.RawIOBase):
+    # write-only file for the Parquet writer, drained after every row group
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def stream_csv(export, queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow(export.headers())
+    for rows in export.iter_chunks(queryset, chunk_size):
+        yield ''.join(writer.writerow([csv_value(value) for value in row]) for row in rows)
+
+
+def stream_parquet(export, queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    # one row group per chunk, the bytes are sent as soon as the group is written
+    schema = export.arrow_schema()
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in export.iter_chunks(queryset, chunk_size):
+        columns = list(zip(*rows))
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream(export, file_format, params, chunk_size=EXPORT_CHUNK_SIZE):
+    if file_format not in EXPORT_FORMATS:
+        raise ExportError(f'Unknown format "{file_format}", expected one of {", ".join(EXPORT_FORMATS)}.')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ExportError('Parquet export needs pyarrow installed.')
+    queryset = export.get_queryset(params)
+    if file_format == 'csv':
+        return stream_csv(export, queryset, chunk_size)
+    return stream_parquet(export, queryset, chunk_size)
+
+
+def filename(export, file_format):
+    return f'{export.name}-{timezone.localdate():%Y%m%d}.{file_format}'
+
+
+def streaming_response(export, file_format, params, chunk_size=EXPORT_CHUNK_SIZE):
+    response = StreamingHttpResponse(stream(export, file_format, params, chunk_size),
+                                     content_type=EXPORT_FORMATS[file_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename(export, file_format)}"'
+    return response
+
+
+class ExportMixin:
+    # GET <list url>/export/csv/ or /export/parquet/ with the filters of the export
+    export_name = None
+
+    @action(methods=['get'], url_path=r'export/(?P<file_format>[a-z]+)', detail=False,
+            permission_classes=[perms.IsSuperuserStaffPermission])
+    def export(self, request, file_format=None):
+        try:
+            return streaming_response(EXPORTS[self.export_name], file_format, request.query_params)
+        except ExportError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
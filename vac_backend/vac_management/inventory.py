@@ -0,0 +1,154 @@
+from collections import defaultdict
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from vac_management.models import AppointmentVaccine, StockMovement, Vaccine, VaccineStock
+
+STOCK_CACHE_TIMEOUT = 60
+
+# effect of one dose of each movement kind on (on_hand, reserved)
+EFFECTS = {
+    'receipt': (1, 0),
+    'reserve': (0, 1),
+    'release': (0, -1),
+    'consume': (-1, -1),
+    'issue': (-1, 0),
+    'return': (1, 0),
+}
+
+
+class InsufficientStock(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Not enough doses in stock.'
+    default_code = 'insufficient_stock'
+
+
+def stock_cache_key(vaccine_id):
+    return f'stock:{vaccine_id}'
+
+
+def holdings(vaccine_id, status, quantity, active=True):
+    # (vaccine_id, reserved, consumed) doses held by a row; campaign rows pass status=None
+    if not active or vaccine_id is None or not quantity:
+        return None
+    if status == 'scheduled':
+        return vaccine_id, quantity, 0
+    if status in ('completed', None):
+        return vaccine_id, 0, quantity
+    return None
+
+
+def appointment_vaccine_holdings(av):
+    return holdings(av.vaccine_id, av.status, av.dose_quantity_used, av.active)
+
+
+def campaign_vaccine_holdings(cv):
+    return holdings(cv.vaccine_id, None, cv.dose_quantity_used, cv.active)
+
+
+def plan_movements(before, after):
+    changes = defaultdict(lambda: [0, 0])
+    for held, sign in ((before, -1), (after, 1)):
+        if held:
+            vaccine_id, reserved, consumed = held
+            changes[vaccine_id][0] += sign * reserved
+            changes[vaccine_id][1] += sign * consumed
+
+    movements = []
+    for vaccine_id, (reserved, consumed) in changes.items():
+        if consumed > 0:
+            # doses given out of this row's own reservation
+            from_reservation = min(consumed, max(-reserved, 0))
+            if from_reservation:
+                movements.append((vaccine_id, 'consume', from_reservation))
+                reserved += from_reservation
+            if consumed > from_reservation:
+                movements.append((vaccine_id, 'issue', consumed - from_reservation))
+        elif consumed < 0:
+            movements.append((vaccine_id, 'return', -consumed))
+
+        if reserved > 0:
+            movements.append((vaccine_id, 'reserve', reserved))
+        elif reserved < 0:
+            movements.append((vaccine_id, 'release', -reserved))
+    return movements
+
+
+def build_movements(before, after, **links):
+    return [StockMovement(vaccine_id=vaccine_id, kind=kind, quantity=quantity, **links)
+            for vaccine_id, kind, quantity in plan_movements(before, after)]
+
+
+def ensure_stock(vaccine_ids, pending_reserved=None):
+    # stock rows are opened lazily from Vaccine.dose_quantity, the count kept by hand so far, with the doses
+    # of appointment vaccines scheduled before the ledger existed already reserved. Callers write their rows
+    # before applying the movements, so a reservation still pending in `pending_reserved` is left out
+    existing = set(VaccineStock.objects.filter(vaccine_id__in=vaccine_ids).values_list('vaccine_id', flat=True))
+    missing = set(vaccine_ids) - existing
+    if not missing:
+        return
+    scheduled = dict(AppointmentVaccine.objects
+                     .filter(vaccine_id__in=missing, active=True, status='scheduled')
+                     .order_by()
+                     .values_list('vaccine_id')
+                     .annotate(doses=Sum('dose_quantity_used')))
+    for vaccine in Vaccine.objects.filter(id__in=missing):
+        reserved = max((scheduled.get(vaccine.id) or 0) - (pending_reserved or {}).get(vaccine.id, 0), 0)
+        # the reserved doses are on hand even where the count by hand says otherwise
+        on_hand = max(vaccine.dose_quantity, reserved)
+        stock, created = VaccineStock.objects.get_or_create(vaccine=vaccine,
+                                                            defaults={'on_hand': on_hand, 'reserved': reserved})
+        if created:
+            StockMovement.objects.bulk_create(
+                [StockMovement(vaccine=vaccine, kind=kind, quantity=quantity, note=note)
+                 for kind, quantity, note in (('receipt', on_hand, 'Opening balance'),
+                                              ('reserve', reserved, 'Opening reservations'))
+                 if quantity])
+
+
+def apply_movements(movements):
+    if not movements:
+        return
+
+    totals = defaultdict(lambda: [0, 0])
+    for movement in movements:
+        on_hand, reserved = EFFECTS[movement.kind]
+        totals[movement.vaccine_id][0] += on_hand * movement.quantity
+        totals[movement.vaccine_id][1] += reserved * movement.quantity
+
+    with transaction.atomic():
+        ensure_stock(list(totals), {vaccine_id: reserved for vaccine_id, (_, reserved) in totals.items()})
+        # one conditional UPDATE per vaccine, in id order so concurrent batches lock rows alike;
+        # it matches only while the new totals stay within stock
+        for vaccine_id, (on_hand, reserved) in sorted(totals.items()):
+            updated = (VaccineStock.objects
+                       .filter(vaccine_id=vaccine_id, reserved__gte=-reserved,
+                               on_hand__gte=F('reserved') + reserved - on_hand)
+                       .update(on_hand=F('on_hand') + on_hand, reserved=F('reserved') + reserved))
+            if not updated:
+                raise InsufficientStock(f'Not enough doses in stock for vaccine {vaccine_id}.')
+
+        StockMovement.objects.bulk_create(movements)
+        # again after commit, a reader may have cached the old totals in between
+        keys = [stock_cache_key(vaccine_id) for vaccine_id in totals]
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def receive(vaccine_id, quantity, note=None):
+    apply_movements([StockMovement(vaccine_id=vaccine_id, kind='receipt', quantity=quantity, note=note)])
+
+
+def get_stock(vaccine_id):
+    key = stock_cache_key(vaccine_id)
+    data = cache.get(key)
+    if data is None:
+        ensure_stock([vaccine_id])
+        stock = VaccineStock.objects.filter(vaccine_id=vaccine_id).values('on_hand', 'reserved').first()
+        if stock is None:
+            return None
+        data = {'vaccine': vaccine_id, **stock, 'available': stock['on_hand'] - stock['reserved']}
+        cache.set(key, data, STOCK_CACHE_TIMEOUT)
+    return data
@@ -0,0 +1,85 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from vac_management import reports
+from vac_management.models import AppointmentVaccine
+from vac_management.rollups import PERIODS
+
+
+def legacy_completion_rate(period='month'):
+    # the original per-(period, status) fetch merged in Python, kept as a reference
+    truncate_func = PERIODS[period]
+    AppointmentVaccine.objects.filter(status='completed').count()
+    AppointmentVaccine.objects.filter(status='cancelled').count()
+    queryset = (
+        AppointmentVaccine.objects.filter(active=True)
+        .annotate(period=truncate_func('appointment__scheduled_date'))
+        .values('period', 'status')
+        .annotate(count=Count('id'))
+    )
+
+    summary = {}
+    for item in queryset:
+        period = item['period'].isoformat()
+        if period not in summary:
+            summary[period] = {
+                'total_completed': 0,
+                'total_cancelled': 0,
+                'total_appointments': 0,
+                'completion_rate_percent': 0,
+            }
+
+        if item['status'] == 'completed':
+            summary[period]['total_completed'] += item['count']
+        elif item['status'] == 'cancelled':
+            summary[period]['total_cancelled'] += item['count']
+
+        summary[period]['total_appointments'] += item['count']
+
+    for stats in summary.values():
+        total = stats['total_appointments']
+        if total > 0:
+            stats['completion_rate_percent'] = round(stats['total_completed'] / total * 100, 2)
+
+    return [{'period': period, **stats} for period, stats in sorted(summary.items())]
+
+
+class Command(BaseCommand):
+    help = 'Compare the legacy and the single-pass completion rate implementations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', default='month', choices=list(PERIODS))
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def measure(self, func, repeat):
+        with CaptureQueriesContext(connection) as ctx:
+            result = func()
+        queries = len(ctx.captured_queries)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        return result, queries, elapsed
+
+    def handle(self, *args, **options):
+        period, repeat = options['period'], options['repeat']
+        implementations = {
+            'legacy': lambda: legacy_completion_rate(period),
+            'rollup': lambda: reports.completion_rate(period),
+            'direct': lambda: reports.completion_rate_from_rows(period),
+        }
+
+        results = {}
+        for name, func in implementations.items():
+            result, queries, elapsed = self.measure(func, repeat)
+            results[name] = result
+            self.stdout.write(f'{name:<8} {elapsed:>10.2f} ms  {queries} queries  {len(result)} periods')
+
+        if results['legacy'] != results['direct']:
+            raise CommandError('Single-pass results differ from the legacy implementation')
+        if results['legacy'] != results['rollup']:
+            raise CommandError('Rollup results differ from the legacy implementation, run rebuild_stats')
+        self.stdout.write(self.style.SUCCESS('Results match'))
@@ -0,0 +1,57 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+from vac_management import views
+
+ENDPOINTS = {
+    'appointments': views.AppointmentViewSet,
+    'appointmentvaccine': views.AppointmentVaccineViewSet,
+    'campaigncitizen': views.CampaignCitizenViewSet,
+    'campaignvaccine': views.CampaignVaccineViewSet,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare serializer and fast read rendering of list endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--endpoint', choices=list(ENDPOINTS))
+
+    def fetch(self, view, url, params):
+        response = view(APIRequestFactory().get(url, params))
+        response.render()
+        return response
+
+    def measure(self, view, url, params, repeat):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.fetch(view, url, params)
+        queries = len(ctx.captured_queries)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            self.fetch(view, url, params)
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        return json.loads(response.content), queries, elapsed
+
+    def handle(self, *args, **options):
+        names = [options['endpoint']] if options['endpoint'] else list(ENDPOINTS)
+        for name in names:
+            view = ENDPOINTS[name].as_view({'get': 'list'})
+            url = f'/{name}/'
+            params = {'page_size': options['page_size']}
+
+            results = {}
+            for mode, extra in (('serializer', {}), ('fast', {'fast': 'true'})):
+                data, queries, elapsed = self.measure(view, url, {**params, **extra}, options['repeat'])
+                results[mode] = data['results']
+                self.stdout.write(f'{name:<20} {mode:<10} {elapsed:>10.2f} ms  {queries} queries  '
+                                  f'{len(data["results"])} rows')
+
+            if results['serializer'] != results['fast']:
+                raise CommandError(f'{name}: fast read output differs from the serializer')
+        self.stdout.write(self.style.SUCCESS('Results match'))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from vac_management import exports
+
+
+class Command(BaseCommand):
+    help = 'Stream appointments, appointment vaccines or campaign participants to a CSV or Parquet file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=list(exports.EXPORTS))
+        parser.add_argument('--file-format', choices=list(exports.EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', help='defaults to stdout for csv')
+        parser.add_argument('--chunk-size', type=int, default=exports.EXPORT_CHUNK_SIZE)
+        parser.add_argument('--filter', action='append', default=[], metavar='NAME=VALUE',
+                            help='any filter of the export endpoint, e.g. --filter date_from=2025-01-01')
+
+    def handle(self, *args, **options):
+        export = exports.EXPORTS[options['export']]
+        params = {}
+        for item in options['filter']:
+            name, sep, value = item.partition('=')
+            if not sep or name not in export.filters:
+                raise CommandError(f'Unknown filter "{item}", expected one of {", ".join(export.filters)}.')
+            params[name] = value
+
+        file_format = options['file_format']
+        if file_format == 'parquet' and not options['output']:
+            raise CommandError('Parquet output needs --output.')
+        try:
+            chunks = exports.stream(export, file_format, params, options['chunk_size'])
+        except exports.ExportError as e:
+            raise CommandError(str(e))
+
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        if file_format == 'csv':
+            out = open(options['output'], 'w', newline='', encoding='utf-8')
+        else:
+            out = open(options['output'], 'wb')
+        with out:
+            for chunk in chunks:
+                out.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f'Exported {export.name} to {options["output"]}'))
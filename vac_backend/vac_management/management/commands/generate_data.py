@@ -0,0 +1,203 @@
+import random
+import time
+from datetime import date, timedelta
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from vac_management import rollups, search, timeline
+from vac_management.caching import catalog_cache, model_versions
+from vac_management.models import (Appointment, AppointmentVaccine, BaseUser, Campaign, CampaignCitizen,
+                                   CampaignVaccine, Citizen, Doctor, Staff, Vaccine, VaccineCategory)
+from vac_management.signals import VERSIONED_MODELS
+
+FAMILY_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ']
+GIVEN_NAMES = ['An', 'Bình', 'Châu', 'Dũng', 'Giang', 'Hà', 'Hải', 'Hương', 'Khánh', 'Linh', 'Minh', 'Nam',
+               'Ngọc', 'Phúc', 'Quân', 'Sơn', 'Thảo', 'Trang', 'Tuấn', 'Vy']
+LOCATIONS = ['Hồ Chí Minh', 'Hà Nội', 'Đà Nẵng', 'Cần Thơ', 'Hải Phòng', 'Huế', 'Nha Trang', 'Biên Hòa',
+             'Vũng Tàu', 'Quy Nhơn']
+CATEGORIES = ['Covid-19', 'Cúm', 'Viêm gan', 'Sởi - Quai bị - Rubella', 'Bạch hầu - Ho gà - Uốn ván', 'Phế cầu',
+              'HPV', 'Thủy đậu', 'Dại', 'Viêm não Nhật Bản']
+SPECIALTIES = ['Pediatrics', 'Internal Medicine', 'Family Medicine', 'Infectious Diseases']
+# weights of completed, scheduled and cancelled appointment vaccines
+STATUS_WEIGHTS = (('completed', 6), ('scheduled', 3), ('cancelled', 1))
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic citizens, appointments and campaigns with bulk inserts, at any scale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--citizens', type=int, default=10000)
+        parser.add_argument('--staff', type=int, default=50)
+        parser.add_argument('--doctors', type=int, default=50)
+        parser.add_argument('--vaccines', type=int, default=60)
+        parser.add_argument('--campaigns', type=int, default=20)
+        parser.add_argument('--appointments', type=int, default=50000)
+        parser.add_argument('--appointment-vaccines', type=int, default=100000)
+        parser.add_argument('--campaign-citizens', type=int, default=20000)
+        parser.add_argument('--days', type=int, default=730, help='appointments spread over this many days')
+        parser.add_argument('--start-date', type=date.fromisoformat, default=date(2024, 1, 1))
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-derived', action='store_true',
+                            help='do not rebuild the statistics rollups, the search index and the timeline')
+
+    def next_id(self, model):
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+    def insert(self, model, rows, label):
+        # rows carry their primary keys, so related rows can point at them without reading them back
+        created, batch = 0, []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                created += self.flush(model, batch)
+                batch = []
+        created += self.flush(model, batch)
+        self.stdout.write(f'{label:<22} {created:>10} rows  {time.perf_counter() - self.started:>8.1f} s')
+
+    def flush(self, model, batch):
+        if not batch:
+            return 0
+        with transaction.atomic():
+            model.objects.bulk_create(batch)
+        return len(batch)
+
+    def insert_children(self, model, rows, label):
+        # bulk_create refuses multi-table children, the parent rows go first and the child rows by hand
+        fields = list(model._meta.local_concrete_fields)
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)))
+
+        created, parents, children = 0, [], []
+        for parent, child in rows:
+            parents.append(parent)
+            children.append([field.get_db_prep_save(getattr(child, field.attname), connection) for field in fields])
+            if len(parents) >= self.batch_size:
+                created += self.flush_children(sql, parents, children)
+                parents, children = [], []
+        created += self.flush_children(sql, parents, children)
+        self.stdout.write(f'{label:<22} {created:>10} rows  {time.perf_counter() - self.started:>8.1f} s')
+
+    def flush_children(self, sql, parents, children):
+        if not parents:
+            return 0
+        with transaction.atomic():
+            BaseUser.objects.bulk_create(parents)
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, children)
+        return len(parents)
+
+    def users(self, model, role, first_id, count, **extra):
+        for pk in range(first_id, first_id + count):
+            fields = {
+                'id': pk,
+                'username': f'{role}_{pk}',
+                'password': self.password,
+                'first_name': self.random.choice(GIVEN_NAMES),
+                'last_name': self.random.choice(FAMILY_NAMES),
+                'email': f'{role}_{pk}@example.com',
+                'phone_number': f'09{pk % 10 ** 8:08d}',
+                'gender': self.random.choice(('male', 'female')),
+                'date_of_birth': date(1950, 1, 1) + timedelta(days=self.random.randrange(365 * 70)),
+                'address': self.random.choice(LOCATIONS),
+            }
+            child = model(baseuser_ptr_id=pk, **{name: value(pk) if callable(value) else value
+                                                 for name, value in extra.items()})
+            yield BaseUser(**fields), child
+
+    def handle(self, *args, **options):
+        if options['vaccines'] < 1 or options['doctors'] < 1 or min(options['citizens'], options['staff']) < 1:
+            raise CommandError('At least one citizen, staff member, doctor and vaccine are needed.')
+        self.batch_size = options['batch_size']
+        self.random = random.Random(options['seed'])
+        self.password = make_password('synthetic')
+        self.started = time.perf_counter()
+        rnd = self.random
+
+        user_id = self.next_id(BaseUser)
+        citizen_ids = range(user_id, user_id + options['citizens'])
+        staff_ids = range(citizen_ids.stop, citizen_ids.stop + options['staff'])
+        doctor_ids = range(staff_ids.stop, staff_ids.stop + options['doctors'])
+        shifts = [choice for choice, _ in Staff.SHIFT_CHOICES]
+
+        self.insert_children(Citizen, self.users(Citizen, 'citizen', citizen_ids.start, len(citizen_ids)),
+                             'citizens')
+        self.insert_children(Staff, self.users(Staff, 'staff', staff_ids.start, len(staff_ids),
+                                               shift=lambda pk: shifts[pk % len(shifts)]), 'staff')
+        self.insert_children(Doctor, self.users(Doctor, 'doctor', doctor_ids.start, len(doctor_ids),
+                                                specialty=lambda pk: SPECIALTIES[pk % len(SPECIALTIES)],
+                                                years_of_experience=lambda pk: pk % 30), 'doctors')
+
+        existing = set(VaccineCategory.objects.values_list('category_name', flat=True))
+        VaccineCategory.objects.bulk_create([VaccineCategory(category_name=name)
+                                             for name in CATEGORIES if name not in existing])
+        category_ids = list(VaccineCategory.objects.values_list('id', flat=True))
+
+        vaccine_id = self.next_id(Vaccine)
+        vaccine_ids = range(vaccine_id, vaccine_id + options['vaccines'])
+        prices = {pk: rnd.choice((150000, 250000, 450000, 800000, 1200000)) / 1000 for pk in vaccine_ids}
+        self.insert(Vaccine, (Vaccine(id=pk, category_id=category_ids[pk % len(category_ids)],
+                                      vaccine_name=f'Vaccine {pk}', dose_quantity=100000,
+                                      instruction=f'Tiêm bắp, {1 + pk % 3} liều', unit_price=prices[pk])
+                              for pk in vaccine_ids), 'vaccines')
+
+        campaign_id = self.next_id(Campaign)
+        campaign_ids = range(campaign_id, campaign_id + options['campaigns'])
+        start = options['start_date']
+        campaign_starts = {pk: start + timedelta(days=rnd.randrange(options['days'])) for pk in campaign_ids}
+        self.insert(Campaign, (Campaign(id=pk, campaign_name=f'Chiến dịch tiêm chủng {pk}',
+                                        start_date=campaign_starts[pk],
+                                        end_date=campaign_starts[pk] + timedelta(days=30),
+                                        description=f'Tiêm chủng mở rộng tại {LOCATIONS[pk % len(LOCATIONS)]}',
+                                        location=LOCATIONS[pk % len(LOCATIONS)], target_population=10000)
+                               for pk in campaign_ids), 'campaigns')
+        if campaign_ids:
+            self.insert(CampaignVaccine, (CampaignVaccine(campaign_id=pk, vaccine_id=rnd.choice(vaccine_ids),
+                                                          dose_quantity_used=rnd.randrange(100, 1000))
+                                          for pk in campaign_ids), 'campaign vaccines')
+            self.insert(CampaignCitizen, (CampaignCitizen(
+                campaign_id=(pk := rnd.choice(campaign_ids)), citizen_id=rnd.choice(citizen_ids),
+                injection_date=campaign_starts[pk] + timedelta(days=rnd.randrange(30)))
+                for _ in range(options['campaign_citizens'])), 'campaign citizens')
+
+        appointment_id = self.next_id(Appointment)
+        appointment_ids = range(appointment_id, appointment_id + options['appointments'])
+        self.insert(Appointment, (Appointment(id=pk, citizen_id=rnd.choice(citizen_ids),
+                                              staff_id=rnd.choice(staff_ids),
+                                              scheduled_date=start + timedelta(days=rnd.randrange(options['days'])),
+                                              location=rnd.choice(LOCATIONS))
+                                  for pk in appointment_ids), 'appointments')
+
+        if appointment_ids:
+            # the n-th round over the appointments gives each one its n-th distinct vaccine
+            rounds = min(-(-options['appointment_vaccines'] // len(appointment_ids)), len(vaccine_ids))
+            statuses, weights = zip(*STATUS_WEIGHTS)
+
+            def appointment_vaccines():
+                for i in range(min(options['appointment_vaccines'], rounds * len(appointment_ids))):
+                    pk = appointment_ids[i % len(appointment_ids)]
+                    vaccine = vaccine_ids[(pk + i // len(appointment_ids)) % len(vaccine_ids)]
+                    dose = rnd.choice((1, 1, 1, 2))
+                    yield AppointmentVaccine(appointment_id=pk, vaccine_id=vaccine, doctor_id=rnd.choice(doctor_ids),
+                                             dose_quantity_used=dose, status=rnd.choices(statuses, weights)[0],
+                                             cost=prices[vaccine] * dose)
+
+            self.insert(AppointmentVaccine, appointment_vaccines(), 'appointment vaccines')
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [BaseUser, Vaccine, Campaign, Appointment]):
+                cursor.execute(sql)
+
+        # bulk inserts send no signals, the list validators and cached catalog pages would still match before
+        model_versions.bump(*VERSIONED_MODELS)
+        catalog_cache.bump_version()
+        if not options['skip_derived']:
+            # bulk inserts send no signals
+            self.stdout.write(f'rebuilt {rollups.rebuild(batch_size=self.batch_size)} rollup rows')
+            self.stdout.write(f'indexed {search.rebuild(batch_size=self.batch_size)} search terms')
+            self.stdout.write(f'rebuilt {timeline.rebuild(batch_size=self.batch_size)} timeline events')
+        self.stdout.write(self.style.SUCCESS(f'Generated data in {time.perf_counter() - self.started:.1f} s'))
@@ -0,0 +1,65 @@
+import tempfile
+import urllib.request
+from pathlib import PurePosixPath
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from vac_management import thumbnails, uploads
+from vac_management.models import BaseUser, Campaign, Vaccine
+
+IMAGE_FIELDS = ((Vaccine, 'image'), (Campaign, 'image'), (BaseUser, 'avatar'))
+
+
+class Command(BaseCommand):
+    help = 'Create the variants of images stored before variants existed, re-ingesting them under their digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help='stop after this many images')
+        parser.add_argument('--timeout', type=int, default=30, help='seconds to download one original')
+
+    def download(self, value, timeout):
+        with urllib.request.urlopen(value.url, timeout=timeout) as response:
+            return response.read()
+
+    def missing(self):
+        for model, field in IMAGE_FIELDS:
+            queryset = model.objects.exclude(**{f'{field}__isnull': True}).filter(**{f'{field}_variants__isnull': True})
+            for instance in queryset.only('pk', field).order_by('pk').iterator():
+                value = getattr(instance, field)
+                if value:
+                    yield instance, field, value
+
+    def handle(self, *args, **options):
+        generated, queued, failed = 0, 0, 0
+        for instance, field, value in self.missing():
+            if options['limit'] is not None and generated + queued + failed >= options['limit']:
+                break
+            label = f'{instance._meta.label} {instance.pk}'
+            try:
+                data = self.download(value, options['timeout'])
+            except OSError as e:
+                self.stderr.write(f'{label}: {e}')
+                failed += 1
+                continue
+
+            digest = thumbnails.source_digest(value)
+            if digest is None:
+                # the upload pipeline stores it again under its digest and generates the variants
+                uploads.queue(instance, field, ContentFile(data, name=PurePosixPath(value.url).name))
+                queued += 1
+                continue
+            with tempfile.NamedTemporaryFile() as original:
+                original.write(data)
+                original.flush()
+                try:
+                    stored = thumbnails.generate(original.name, digest)
+                    if stored:
+                        setattr(instance, f'{field}_variants', stored)
+                        instance.save(update_fields=[f'{field}_variants'])
+                    generated += 1
+                except OSError as e:
+                    self.stderr.write(f'{label}: {e}')
+                    failed += 1
+
+        uploads.pool.wait()
+        self.stdout.write(self.style.SUCCESS(f'Generated variants of {generated} images, re-ingested {queued}, '
+                                             f'{failed} failed'))
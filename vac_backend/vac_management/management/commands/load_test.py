@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from vac_management.management.commands.run_benchmarks import summarize
+from vac_management.models import AppointmentVaccine
+
+PROFILES = ('wsgi', 'asgi')
+GUNICORN_CONFIG = Path(settings.BASE_DIR) / 'gunicorn.conf.py'
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # customers, ephemeral keys and payment intents, replaying responses by Idempotency-Key like Stripe;
+    # every call but the customer's takes `delay` seconds
+    objects = {}
+    replies = {}
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+    delay = 0.1
+
+    def do_POST(self):
+        cls = FakeStripeHandler
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        key = self.headers.get('Idempotency-Key')
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            if self.path != '/v1/customers':
+                time.sleep(cls.delay)
+            with cls.lock:
+                if key and key in cls.replies:
+                    code, body = cls.replies[key]
+                else:
+                    code, body = self.create(params)
+                    if key:
+                        cls.replies[key] = code, body
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except ConnectionError:
+            # the client gave up, e.g. the other call of the payment sheet failed
+            pass
+
+    def create(self, params):
+        kind = {'/v1/customers': 'customer', '/v1/ephemeral_keys': 'ephemeral_key',
+                '/v1/payment_intents': 'payment_intent'}[self.path]
+        if params.get('currency') == 'xxx':
+            return 400, {'error': {'type': 'invalid_request_error', 'message': 'Invalid currency: xxx'}}
+        created = self.objects.setdefault(kind, [])
+        obj = {'id': f'{kind}_{len(created) + 1}', 'object': kind, 'params': params}
+        if kind == 'ephemeral_key':
+            obj['secret'] = f'ek_test_{len(created) + 1}'
+        elif kind == 'payment_intent':
+            obj.update(client_secret=f'{obj["id"]}_secret', status='requires_payment_method',
+                       amount=int(params['amount']))
+        created.append(obj)
+        return 200, obj
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections under load, the retransmits would be measured as latency
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_fake_stripe(delay):
+    FakeStripeHandler.objects, FakeStripeHandler.replies, FakeStripeHandler.max_in_flight = {}, {}, 0
+    FakeStripeHandler.delay = delay
+    server = FakeStripeServer(('127.0.0.1', 0), FakeStripeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = ('Requests per second per worker of the payment sheet under the WSGI and the ASGI profile of '
+            'gunicorn.conf.py, against a fake Stripe with the given upstream latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=PROFILES, action='append', help='default: both')
+        parser.add_argument('--latency', type=float, default=0.5, help='seconds per Stripe call')
+        parser.add_argument('--concurrency', type=int, default=64, help='requests in flight')
+        parser.add_argument('--duration', type=float, default=10, help='seconds of load per profile')
+        parser.add_argument('--warmup', type=int, default=3, help='requests sent before measuring')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--threads', type=int, default=4, help='threads per WSGI worker')
+        parser.add_argument('--output', help='write the results to this JSON file')
+
+    def start_server(self, profile, port, stripe_url, options):
+        env = {**os.environ, 'GUNICORN_PROFILE': profile, 'GUNICORN_BIND': f'127.0.0.1:{port}',
+               'GUNICORN_WORKERS': str(options['workers']), 'GUNICORN_THREADS': str(options['threads']),
+               'STRIPE_API_BASE': stripe_url, 'STRIPE_SECRET_KEY': 'sk_test_load'}
+        process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', str(GUNICORN_CONFIG)],
+                                   cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'gunicorn ({profile}) exited with {process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.kill()
+        raise CommandError(f'gunicorn ({profile}) did not start')
+
+    async def load(self, url, body, headers, options):
+        import httpx
+
+        timings, statuses = [], {}
+
+        async def user(client, deadline):
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    status = (await client.post(url, json=body)).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                timings.append((time.perf_counter() - start) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        limits = httpx.Limits(max_connections=options['concurrency'])
+        async with httpx.AsyncClient(limits=limits, headers=headers, timeout=60) as client:
+            # the first requests import the views and open the connections
+            for _ in range(options['warmup']):
+                await client.post(url, json=body)
+            deadline = time.monotonic() + options['duration']
+            started = time.monotonic()
+            await asyncio.gather(*(user(client, deadline) for _ in range(options['concurrency'])))
+            elapsed = time.monotonic() - started
+        return timings, statuses, elapsed
+
+    def handle(self, *args, **options):
+        item = (AppointmentVaccine.objects.filter(active=True, cost__gt=0).exclude(status='cancelled')
+                .values_list('id', 'appointment__citizen_id').first())
+        if item is None:
+            raise CommandError('No appointment vaccine to pay for, run generate_data first.')
+        item, citizen_id = item
+        # the payment sheet is the citizen's own
+        token = AccessToken.objects.create(user_id=citizen_id, token=f'load-test-{time.time_ns()}', scope='read write',
+                                           expires=timezone.now() + timedelta(hours=1))
+        headers = {'Authorization': f'Bearer {token.token}'}
+
+        stripe_server = start_fake_stripe(options['latency'])
+        stripe_url = f'http://127.0.0.1:{stripe_server.server_port}'
+        results = {}
+        try:
+            for profile in options['profile'] or PROFILES:
+                port = free_port()
+                process = self.start_server(profile, port, stripe_url, options)
+                try:
+                    timings, statuses, elapsed = asyncio.run(
+                        self.load(f'http://127.0.0.1:{port}/payment-sheet/', {'vaccine_id': item}, headers, options))
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+                ok = statuses.get(200, 0)
+                results[profile] = result = {
+                    'requests': len(timings),
+                    'statuses': {str(status): count for status, count in statuses.items()},
+                    'rps': round(ok / elapsed, 2),
+                    'rps_per_worker': round(ok / elapsed / options['workers'], 2),
+                    **summarize(timings),
+                }
+                self.stdout.write(f'{profile:<5} {result["rps_per_worker"]:>9.2f} req/s per worker '
+                                  f'{result["p50_ms"]:>9.1f} ms p50 {result["p95_ms"]:>9.1f} ms p95  '
+                                  f'{result["statuses"]}')
+        finally:
+            stripe_server.shutdown()
+            stripe_server.server_close()
+            token.delete()
+
+        if len(results) == len(PROFILES) and results['wsgi']['rps']:
+            self.stdout.write(f'asgi/wsgi: {results["asgi"]["rps"] / results["wsgi"]["rps"]:.1f}x')
+        if options['output']:
+            report = {'latency': options['latency'], 'concurrency': options['concurrency'],
+                      'workers': options['workers'], 'threads': options['threads'], 'results': results}
+            Path(options['output']).write_text(json.dumps(report, indent=2, sort_keys=True))
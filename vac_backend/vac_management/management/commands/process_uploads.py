@@ -0,0 +1,19 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from vac_management import uploads
+from vac_management.models import PendingAsset
+
+
+class Command(BaseCommand):
+    help = 'Upload the queued images left behind by a restarted process, optionally retrying the failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=60, help='seconds since the upload was queued')
+        parser.add_argument('--retry-failed', action='store_true')
+
+    def handle(self, *args, **options):
+        assets = uploads.requeue(older_than=timedelta(seconds=options['older_than']),
+                                 retry_failed=options['retry_failed'])
+        processed = [asset.pk for asset in assets if asset is not None]
+        failed = PendingAsset.objects.filter(pk__in=processed, status='failed').count()
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(processed)} uploads ({failed} failed)'))
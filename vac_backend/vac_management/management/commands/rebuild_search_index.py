@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from vac_management import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index of vaccines, categories and campaigns from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search index ({created} terms)'))
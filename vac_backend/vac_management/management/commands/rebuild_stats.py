@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from vac_management import rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the statistics rollup tables from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = rollups.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt statistics rollups ({created} rows)'))
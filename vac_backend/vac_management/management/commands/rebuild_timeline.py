@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from vac_management import timeline
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the vaccination timeline of every citizen from appointment vaccines and campaign citizens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = timeline.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt timeline ({created} events)'))
@@ -0,0 +1,233 @@
+import json
+import statistics
+import sys
+import time
+from contextlib import nullcontext
+from datetime import date, timedelta
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+from rest_framework.test import APIClient
+from vac_management.caching import catalog_cache
+from vac_management.models import Appointment, AppointmentVaccine, BaseUser, CampaignCitizen, Citizen, Vaccine
+from vac_management.urls import router
+
+# routes whose URL needs arguments, filled from the sampled data
+CASE_URLS = {
+    'vaccine-get-by-name': '/vaccines/by-name/{vaccine_name}/',
+    'appointment-get-by-citizen': '/appointments/by-citizen/?citizen_id={citizen_id}',
+    'appointment-history': '/appointments/history/?citizen_id={citizen_id}',
+    'appointment-export': '/appointments/export/csv/?date_from={day}&date_to={day}',
+    'appointmentvaccine-export': '/appointmentvaccine/export/csv/?date_from={day}&date_to={day}',
+    'campaigncitizen-export': '/campaigncitizen/export/csv/?date_from={day}&date_to={day}',
+    'search-list': '/search/?q=vaccine',
+}
+# routes outside the router
+EXTRA_CASES = {
+    'metrics': '/metrics/',
+}
+# registered twice under another prefix
+SKIPPED_PREFIXES = ('vaccinetypes',)
+DAGS_DIR = Path(settings.BASE_DIR) / 'airflow' / 'dags'
+
+
+class Command(BaseCommand):
+    help = 'Time every list, detail and stats endpoint and the Airflow extraction, against a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--only', help='run the cases whose name contains this text')
+        parser.add_argument('--cold-cache', action='store_true', help='clear the catalog cache before each request')
+        parser.add_argument('--output', help='write the results to this JSON file')
+        parser.add_argument('--compare', help='fail on regressions against this JSON baseline')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown, 0.2 = 20%%')
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help='p95 slowdowns below this are noise whatever the ratio')
+
+    def sample_context(self):
+        busiest = (Appointment.objects.filter(active=True).values('scheduled_date')
+                   .annotate(total=Count('id')).order_by('-total').first())
+        citizen = Appointment.objects.filter(active=True).values_list('citizen_id', flat=True).first()
+        return {
+            'day': (busiest['scheduled_date'] if busiest else timezone.localdate()).isoformat(),
+            'citizen_id': citizen or Citizen.objects.values_list('id', flat=True).first(),
+            'vaccine_name': Vaccine.objects.filter(active=True).values_list('vaccine_name', flat=True).first(),
+        }
+
+    def discover_cases(self, context):
+        cases, skipped = {}, []
+        for prefix, viewset, basename in router.registry:
+            if prefix in SKIPPED_PREFIXES:
+                continue
+            queryset = getattr(viewset, 'queryset', None)
+            lookup = getattr(viewset, 'lookup_field', 'pk')
+            pk = queryset.order_by('pk').values_list(lookup, flat=True).first() if queryset is not None else None
+
+            if hasattr(viewset, 'list'):
+                cases[f'{basename}-list'] = CASE_URLS.get(f'{basename}-list', f'/{prefix}/').format(**context)
+            if hasattr(viewset, 'retrieve') and pk is not None:
+                cases[f'{basename}-detail'] = f'/{prefix}/{pk}/'
+
+            for action in viewset.get_extra_actions():
+                name = f'{basename}-{action.url_name}'
+                if 'get' not in action.mapping:
+                    continue
+                if name in CASE_URLS:
+                    cases[name] = CASE_URLS[name].format(**context)
+                elif '(?P' in action.url_path or (action.detail and pk is None):
+                    skipped.append(name)
+                elif action.detail:
+                    cases[name] = f'/{prefix}/{pk}/{action.url_path}/'
+                else:
+                    cases[name] = f'/{prefix}/{action.url_path}/'
+        cases.update(EXTRA_CASES)
+        return cases, skipped
+
+    def get_user(self):
+        user = BaseUser.objects.filter(is_superuser=True, is_active=True).order_by('pk').first()
+        if user is None:
+            user = BaseUser.objects.create(username='benchmark', is_staff=True, is_superuser=True,
+                                           phone_number='0000000000')
+            self.stderr.write('Created superuser "benchmark" for the authenticated endpoints')
+        return user
+
+    def fetch(self, client, url, cold_cache):
+        if cold_cache:
+            catalog_cache.clear()
+        start = time.perf_counter()
+        response = client.get(url)
+        # counted by the metrics middleware; a streamed body runs its queries after the view returns
+        sample = getattr(response.wsgi_request, '_metrics_sample', None)
+        if response.streaming:
+            with connection.execute_wrapper(sample) if sample else nullcontext():
+                for _ in response.streaming_content:
+                    pass
+        elapsed = (time.perf_counter() - start) * 1000
+        return response.status_code, elapsed, sample
+
+    def run_request(self, client, url, options):
+        for _ in range(options['warmup']):
+            self.fetch(client, url, options['cold_cache'])
+        timings, status, sample = [], None, None
+        for _ in range(options['repeat']):
+            status, elapsed, sample = self.fetch(client, url, options['cold_cache'])
+            timings.append(elapsed)
+        return {
+            'url': url,
+            'status': status,
+            'queries': sample.query_count if sample else None,
+            'db_ms': round(sample.db_duration * 1000, 3) if sample else None,
+            **summarize(timings),
+        }
+
+    def run_extraction(self, day, options):
+        # the statements of the Airflow extraction task, read the way it reads them
+        if str(DAGS_DIR) not in sys.path:
+            sys.path.append(str(DAGS_DIR))
+        try:
+            from utils.valid_appointment_extraction import BATCH_SIZE, SUMMARY_QUERY, VALID_APPOINTMENTS_QUERY
+        except ImportError as e:
+            self.stderr.write(f'Skipping the Airflow extraction: {e}')
+            return None
+
+        params = (day, day + timedelta(days=1))
+
+        def extract():
+            with connection.cursor() as cursor:
+                cursor.execute(SUMMARY_QUERY, params)
+                cursor.fetchone()
+                cursor.execute(VALID_APPOINTMENTS_QUERY, params)
+                rows = 0
+                while batch := cursor.fetchmany(BATCH_SIZE):
+                    rows += len(batch)
+            return rows
+
+        for _ in range(options['warmup']):
+            extract()
+        timings = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            rows = extract()
+            timings.append((time.perf_counter() - start) * 1000)
+        return {'url': f'airflow extraction {day}', 'status': None, 'queries': 2, 'db_ms': None, 'rows': rows,
+                **summarize(timings)}
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+        context = self.sample_context()
+        cases, skipped = self.discover_cases(context)
+        client = APIClient()
+        client.force_authenticate(self.get_user())
+
+        results = {}
+        for name, url in cases.items():
+            if options['only'] and options['only'] not in name:
+                continue
+            results[name] = result = self.run_request(client, url, options)
+            self.stdout.write(format_result(name, result))
+
+        if not options['only'] or options['only'] in 'airflow-extraction':
+            result = self.run_extraction(date.fromisoformat(context['day']), options)
+            if result is not None:
+                results['airflow-extraction'] = result
+                self.stdout.write(format_result('airflow-extraction', result))
+        for name in skipped:
+            self.stderr.write(f'Skipped {name}: its URL takes arguments, add it to CASE_URLS')
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'repeat': options['repeat'],
+            'cold_cache': options['cold_cache'],
+            'rows': {model.__name__: model.objects.count()
+                     for model in (Citizen, Appointment, AppointmentVaccine, CampaignCitizen)},
+            'results': results,
+        }
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2, sort_keys=True))
+            self.stdout.write(f'Wrote {len(results)} results to {options["output"]}')
+
+        failed = [name for name, result in results.items() if result['status'] and result['status'] >= 500]
+        if failed:
+            raise CommandError(f'Server errors from {", ".join(failed)}')
+        if options['compare']:
+            baseline = json.loads(Path(options['compare']).read_text())
+            regressions = compare(baseline, report, options['tolerance'], options['min_delta_ms'])
+            for line in regressions:
+                self.stdout.write(self.style.ERROR(line))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["compare"]}')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {options["compare"]}'))
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    p95 = statistics.quantiles(ordered, n=20, method='inclusive')[-1] if len(ordered) > 1 else ordered[0]
+    return {'p50_ms': round(statistics.median(ordered), 3), 'p95_ms': round(p95, 3)}
+
+
+def format_result(name, result):
+    queries = '-' if result['queries'] is None else result['queries']
+    return (f'{name:<45} {result["p50_ms"]:>9.2f} ms p50 {result["p95_ms"]:>9.2f} ms p95 '
+            f'{queries:>5} queries  {result["status"] or ""}')
+
+
+def compare(baseline, report, tolerance, min_delta_ms):
+    regressions = []
+    for name, result in report['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if before['status'] != result['status']:
+            regressions.append(f'{name}: status {before["status"]} -> {result["status"]}')
+        if before['queries'] is not None and result['queries'] is not None and result['queries'] > before['queries']:
+            regressions.append(f'{name}: {before["queries"]} -> {result["queries"]} queries')
+        slower = result['p95_ms'] - before['p95_ms']
+        if slower > min_delta_ms and result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {before["p95_ms"]:.2f} -> {result["p95_ms"]:.2f} ms')
+    return regressions
@@ -0,0 +1,235 @@
+import bisect
+import heapq
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from vac_management import perms
+from vac_management.caching import catalog_cache
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+SLOW_QUERIES_LOGGED = 5
+
+
+class Histogram:
+    # cumulative buckets per label set, rendered in the Prometheus text format
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total:g}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{format_labels(labels)} {value:g}' for labels, value in sorted(self.series.items()))
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    # per process; every worker is scraped on its own, as with the Prometheus client's default registry
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter('http_requests_total', 'Requests by route, method and status.')
+        self.duration = Histogram('http_request_duration_seconds', 'Wall time of the request.', DURATION_BUCKETS)
+        self.queries = Histogram('http_request_db_queries', 'Database queries per request.', QUERY_BUCKETS)
+        self.db_duration = Histogram('http_request_db_duration_seconds', 'Time spent in database queries.',
+                                     DURATION_BUCKETS)
+        self.render_duration = Histogram('http_request_render_duration_seconds',
+                                         'Time spent serializing the response body.', DURATION_BUCKETS)
+        self.size = Histogram('http_response_size_bytes', 'Size of the response body.', SIZE_BUCKETS)
+
+    def record(self, sample):
+        labels = (('route', sample.route), ('method', sample.method))
+        with self.lock:
+            self.requests.inc((*labels, ('status', sample.status)))
+            self.duration.observe(labels, sample.duration)
+            self.queries.observe(labels, sample.query_count)
+            self.db_duration.observe(labels, sample.db_duration)
+            if sample.render_duration is not None:
+                self.render_duration.observe(labels, sample.render_duration)
+            if sample.size is not None:
+                self.size.observe(labels, sample.size)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in self.metrics():
+                lines.extend(metric.render())
+        stats = catalog_cache.get_stats()
+        lines.append('# HELP catalog_cache_lookups_total Catalog cache lookups by outcome.')
+        lines.append('# TYPE catalog_cache_lookups_total counter')
+        for outcome in ('local_hits', 'shared_hits', 'misses'):
+            lines.append(f'catalog_cache_lookups_total{format_labels((("outcome", outcome),))} {stats[outcome]}')
+        return '\n'.join(lines) + '\n'
+
+    def metrics(self):
+        return self.requests, self.duration, self.queries, self.db_duration, self.render_duration, self.size
+
+    def clear(self):
+        with self.lock:
+            for metric in self.metrics():
+                metric.series = {}
+
+
+registry = Registry()
+
+
+class RequestSample:
+    def __init__(self, request):
+        self.method = request.method
+        self.path = request.path
+        self.route = 'unmatched'
+        self.status = None
+        self.duration = 0
+        self.query_count = 0
+        self.db_duration = 0
+        self.render_duration = None
+        self.size = None
+        # the slowest statements only, a slow request may run thousands
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.query_count += 1
+            self.db_duration += elapsed
+            entry = (elapsed, self.query_count, sql)
+            if len(self.slowest) < SLOW_QUERIES_LOGGED:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+
+def route_name(request):
+    # DRF router names, e.g. appointment-list or appointment-completion-rate
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.view_name or match._func_path
+
+
+class MetricsMiddleware:
+    # async capable, an async view under ASGI runs without a hop through a thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        sample = RequestSample(request)
+        request._metrics_sample = sample
+        start = time.perf_counter()
+        with self.wrap_connections(sample):
+            response = self.get_response(request)
+        return self.finish(request, sample, response, start)
+
+    async def __acall__(self, request):
+        sample = RequestSample(request)
+        request._metrics_sample = sample
+        start = time.perf_counter()
+        # connections follow the request context into the threads of the async ORM calls
+        with self.wrap_connections(sample):
+            response = await self.get_response(request)
+        return self.finish(request, sample, response, start)
+
+    def wrap_connections(self, sample):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(sample))
+        return stack
+
+    def finish(self, request, sample, response, start):
+        sample.duration = time.perf_counter() - start
+        sample.route = route_name(request)
+        sample.status = response.status_code
+        if not response.streaming:
+            sample.size = len(response.content)
+        registry.record(sample)
+        self.log_slow(sample)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses render right after this hook; the callback closes the measurement
+        sample = getattr(request, '_metrics_sample', None)
+        if sample is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                sample.render_duration = time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def log_slow(self, sample):
+        threshold = getattr(settings, 'METRICS_SLOW_REQUEST_MS', 500) / 1000
+        if sample.duration < threshold or random.random() >= getattr(settings, 'METRICS_SLOW_SAMPLE_RATE', 1.0):
+            return
+        statements = '\n'.join(f'  #{index} {elapsed * 1000:.1f} ms: {sql}'
+                               for elapsed, index, sql in sorted(sample.slowest, reverse=True))
+        logger.warning('Slow request %s %s (%s): %.1f ms, %d queries in %.1f ms\n%s',
+                       sample.method, sample.path, sample.route, sample.duration * 1000, sample.query_count,
+                       sample.db_duration * 1000, statements)
+
+
+@api_view(['GET'])
+@permission_classes([perms.IsSuperuserStaffPermission])
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,4 +1,7 @@
+import uuid
+from datetime import date
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from ckeditor.fields import RichTextField
 from cloudinary.models import CloudinaryField
@@ -23,6 +26,8 @@ class BaseUser(AbstractUser):
 
     date_of_birth = models.DateField(null=True)
     avatar = CloudinaryField(null=True)
+    # {name: path under MEDIA_ROOT} of the generated variants, set with the image by the upload pipeline
+    avatar_variants = models.JSONField(null=True, blank=True, editable=False)
     phone_number = models.CharField(max_length=25)
     address = models.CharField(max_length=255, null=True)
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES, null=True)
@@ -33,6 +38,8 @@ class BaseUser(AbstractUser):
 
 class Citizen(BaseUser):
     health_note = models.CharField(max_length=255, null=True)
+    # created on the first payment and reused, so saved cards follow the citizen
+    stripe_customer_id = models.CharField(max_length=255, null=True, blank=True, unique=True)
 
     class Meta:
         ordering = ['-id']
@@ -84,6 +91,7 @@ class Vaccine(BaseModel):
     vaccine_name = models.CharField(max_length=100)
     dose_quantity = models.IntegerField()
     image = CloudinaryField(null=True)
+    image_variants = models.JSONField(null=True, blank=True, editable=False)
     instruction = models.TextField()
     unit_price = models.FloatField()
 
@@ -101,6 +109,13 @@ class Appointment(BaseModel):
     location = models.CharField(max_length=255)
     notes = models.TextField(null=True, blank=True)
 
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['scheduled_date', 'active']),
+            models.Index(fields=['citizen', 'active']),
+        ]
+
     def __str__(self):
         return f"Citizen {self.citizen}," \
                f"Staff {self.staff}," \
@@ -121,7 +136,13 @@ class AppointmentVaccine(BaseModel):
     notes = models.TextField(null=True, blank=True)
     cost = models.FloatField(null=True, blank=True)
 
-    unique_together = ('appointment', 'vaccine', 'doctor')
+    class Meta:
+        ordering = ['-id']
+        unique_together = ('appointment', 'vaccine', 'doctor')
+        indexes = [
+            models.Index(fields=['status', 'active']),
+            models.Index(fields=['vaccine', 'status']),
+        ]
 
     def __str__(self):
         return self.appointment.__str__
@@ -141,6 +162,7 @@ class Campaign(BaseModel):
     description = models.TextField(max_length=255)
     location = models.CharField(max_length=255, null=True, blank=True)
     image = CloudinaryField(null=True)
+    image_variants = models.JSONField(null=True, blank=True, editable=False)
     target_population = models.IntegerField(null=True, blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='planned')
 
@@ -157,8 +179,279 @@ class CampaignCitizen(BaseModel):
     injection_date = models.DateField(blank=True)
     notes = models.TextField(null=True, blank=True)
 
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['injection_date']),
+        ]
+
 
 class CampaignVaccine(BaseModel):
     vaccine = models.ForeignKey(Vaccine, on_delete=models.CASCADE)
     campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE)
     dose_quantity_used = models.IntegerField()
+
+
+class VaccinationDailyStat(models.Model):
+    SOURCE_CHOICES = (
+        ('appointment_vaccine', 'Appointment vaccine'),
+        ('campaign_vaccine', 'Campaign vaccine'),
+    )
+
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    day = models.DateField()
+    status = models.CharField(max_length=10, blank=True, default='')
+    category = models.ForeignKey(VaccineCategory, on_delete=models.CASCADE, null=True)
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, null=True)
+    total = models.IntegerField(default=0)
+    doses = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'day', 'status']),
+        ]
+        # one row per bucket; NULL never equals NULL in a unique index, so the nullable keys are coalesced
+        constraints = [
+            models.UniqueConstraint(models.F('source'), models.F('day'), models.F('status'),
+                                    Coalesce('category', 0), Coalesce('campaign', 0),
+                                    name='vaccinationdailystat_unique_bucket'),
+        ]
+
+
+class CitizenPeriodStat(models.Model):
+    SOURCE_CHOICES = (
+        ('appointment', 'Appointment'),
+        ('campaign', 'Campaign'),
+    )
+    PERIOD_CHOICES = (
+        ('month', 'Month'),
+        ('quarter', 'Quarter'),
+        ('year', 'Year'),
+        ('all', 'All time'),
+    )
+
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    period_type = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    period_start = models.DateField(null=True)
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, null=True)
+    citizen = models.ForeignKey(Citizen, on_delete=models.CASCADE)
+    total = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'period_type', 'period_start']),
+        ]
+        constraints = [
+            models.UniqueConstraint(models.F('source'), models.F('period_type'),
+                                    Coalesce('period_start', models.Value(date(1970, 1, 1))),
+                                    Coalesce('campaign', 0), models.F('citizen'),
+                                    name='citizenperiodstat_unique_bucket'),
+        ]
+
+
+class ReminderDelivery(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE)
+    scheduled_date = models.DateField()
+    template = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    claim_token = models.CharField(max_length=100, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('appointment', 'scheduled_date', 'template')
+
+
+class VaccineStock(models.Model):
+    # running totals of the StockMovement ledger, available = on_hand - reserved
+    vaccine = models.OneToOneField(Vaccine, on_delete=models.CASCADE, related_name='stock')
+    on_hand = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(condition=models.Q(reserved__gte=0) & models.Q(on_hand__gte=models.F('reserved')),
+                                   name='vaccinestock_not_oversold'),
+        ]
+
+
+class StockMovement(models.Model):
+    KIND_CHOICES = (
+        ('receipt', 'Receipt'),
+        ('reserve', 'Reserve'),
+        ('release', 'Release'),
+        ('consume', 'Consume'),
+        ('issue', 'Issue'),
+        ('return', 'Return'),
+    )
+
+    vaccine = models.ForeignKey(Vaccine, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    quantity = models.IntegerField()
+    appointment_vaccine = models.ForeignKey(AppointmentVaccine, on_delete=models.SET_NULL, null=True, blank=True)
+    campaign_vaccine = models.ForeignKey(CampaignVaccine, on_delete=models.SET_NULL, null=True, blank=True)
+    note = models.CharField(max_length=255, null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['vaccine', 'created_date']),
+        ]
+
+
+class AppointmentSlot(models.Model):
+    # booking quota per (location, date, shift); shift '' holds appointments without staff
+    location = models.CharField(max_length=255)
+    date = models.DateField()
+    shift = models.CharField(max_length=10, choices=Staff.SHIFT_CHOICES, blank=True, default='')
+    capacity = models.IntegerField()
+    booked = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['date', 'location', 'shift']
+        unique_together = ('location', 'date', 'shift')
+        constraints = [
+            models.CheckConstraint(condition=models.Q(booked__gte=0), name='appointmentslot_booked_positive'),
+        ]
+
+    def __str__(self):
+        return f"{self.location} {self.date} {self.shift}"
+
+
+class SlotWaitlistEntry(models.Model):
+    # a booking queued for a full slot, turned into an Appointment when a place frees up
+    slot = models.ForeignKey(AppointmentSlot, on_delete=models.CASCADE, related_name='waitlist')
+    citizen = models.ForeignKey(Citizen, on_delete=models.CASCADE)
+    staff = models.ForeignKey(Staff, on_delete=models.CASCADE, null=True, blank=True)
+    location = models.CharField(max_length=255)
+    notes = models.TextField(null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+
+class SearchTerm(models.Model):
+    # inverted index over the catalog: one row per accent-folded term of a document, kept in sync by signals
+    DOC_CHOICES = (
+        ('vaccine', 'Vaccine'),
+        ('campaign', 'Campaign'),
+        ('category', 'Category'),
+    )
+
+    doc_type = models.CharField(max_length=10, choices=DOC_CHOICES)
+    object_id = models.IntegerField()
+    term = models.CharField(max_length=64)
+    weight = models.IntegerField(default=1)
+
+    class Meta:
+        unique_together = ('doc_type', 'object_id', 'term')
+        indexes = [
+            models.Index(fields=['term', 'doc_type']),
+        ]
+
+
+class PendingAsset(models.Model):
+    # an image spooled to local disk, uploaded by the background workers into <model>.<field> of one row
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('uploading', 'Uploading'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    model = models.CharField(max_length=100)
+    object_id = models.IntegerField()
+    field = models.CharField(max_length=50)
+    spool_path = models.CharField(max_length=255)
+    # sha256 of the content, the name the image is stored under
+    digest = models.CharField(max_length=64, blank=True, default='')
+    original_name = models.CharField(max_length=255, null=True, blank=True)
+    size = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    public_id = models.CharField(max_length=255, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_date']),
+            models.Index(fields=['model', 'object_id']),
+        ]
+
+
+class Payment(models.Model):
+    # one Stripe PaymentIntent, for one or several appointment vaccines of a citizen
+    citizen = models.ForeignKey(Citizen, on_delete=models.CASCADE)
+    appointment_vaccines = models.ManyToManyField(AppointmentVaccine, related_name='payments')
+    intent_id = models.CharField(max_length=255, unique=True)
+    idempotency_key = models.CharField(max_length=255)
+    # in the smallest unit of the currency, as Stripe takes it
+    amount = models.IntegerField()
+    currency = models.CharField(max_length=3)
+    status = models.CharField(max_length=30)
+    created_date = models.DateTimeField(auto_now_add=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['citizen', 'created_date']),
+        ]
+
+
+class VaccinationEvent(models.Model):
+    # a citizen's appointment vaccines and campaign injections in one table, with the names they show under
+    # copied in, so the whole history is one range read of the (citizen, event_date) index
+    SOURCE_CHOICES = (
+        ('appointment_vaccine', 'Appointment vaccine'),
+        ('campaign_citizen', 'Campaign citizen'),
+    )
+
+    citizen = models.ForeignKey(Citizen, on_delete=models.CASCADE)
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    source_id = models.IntegerField()
+    event_date = models.DateField()
+    status = models.CharField(max_length=10, blank=True, default='')
+    vaccine_id = models.IntegerField(null=True)
+    vaccine_name = models.CharField(max_length=100, null=True)
+    category_id = models.IntegerField(null=True)
+    category_name = models.CharField(max_length=100, null=True)
+    doctor_id = models.IntegerField(null=True)
+    doctor_name = models.CharField(max_length=300, null=True)
+    location = models.CharField(max_length=255, null=True)
+    appointment_id = models.IntegerField(null=True)
+    campaign_id = models.IntegerField(null=True)
+    campaign_name = models.CharField(max_length=100, null=True)
+    dose_quantity = models.IntegerField(null=True)
+    cost = models.FloatField(null=True)
+    notes = models.TextField(null=True)
+
+    class Meta:
+        unique_together = ('source', 'source_id')
+        indexes = [
+            models.Index(fields=['citizen', 'event_date']),
+            models.Index(fields=['vaccine_id']),
+            models.Index(fields=['doctor_id']),
+            models.Index(fields=['campaign_id']),
+        ]
+
+
+class ModelVersion(models.Model):
+    # bumped after every committed write to a model, read by the conditional GET validators;
+    # in the database so every worker and management command sees the same one
+    label = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated_date = models.DateTimeField()
@@ -1,15 +1,35 @@
 from rest_framework import pagination
 
 
+class KeysetPaginator(pagination.CursorPagination):
+    # ordering must be unique, DRF falls back to an offset among equal values
+    ordering = '-id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true'):
+            self.count = queryset.count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data = {'count': self.count, **response.data}
+        return response
+
+
 class VaccinePaginator(pagination.PageNumberPagination):
     page_size = 6
 
 
-class AppointmentPaginator(pagination.PageNumberPagination):
+class AppointmentPaginator(KeysetPaginator):
     page_size = 3
 
 
-class AppointmentVaccinesPaginator(pagination.PageNumberPagination):
+class AppointmentVaccinesPaginator(KeysetPaginator):
     page_size = 3
 
 
@@ -17,5 +37,9 @@ class CampaignPaginator(pagination.PageNumberPagination):
     page_size = 3
 
 
-class UsersPaginator(pagination.PageNumberPagination):
+class SlotPaginator(pagination.PageNumberPagination):
+    page_size = 20
+
+
+class UsersPaginator(KeysetPaginator):
     page_size = 3
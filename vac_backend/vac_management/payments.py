@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import threading
+import weakref
+from decimal import ROUND_HALF_UP, Decimal
+import stripe
+from django.conf import settings
+from django.db import IntegrityError
+from vac_management.models import AppointmentVaccine, Citizen, Doctor, Payment, Staff
+
+PAYMENT_MAX_ITEMS = 50
+# Stripe rejects longer idempotency keys
+IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class PaymentError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StripeGateway:
+    # one async client per event loop: its httpx connection pool belongs to the loop. Under ASGI that is
+    # one client per worker; under WSGI every async view runs in a loop of its own
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = weakref.WeakKeyDictionary()
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.clients.get(loop)
+            if client is None:
+                base = getattr(settings, 'STRIPE_API_BASE', None)
+                client = self.clients[loop] = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY or '', stripe_version=settings.STRIPE_API_VERSION or None,
+                    base_addresses={'api': base} if base else {},
+                    http_client=stripe.HTTPXClient(timeout=getattr(settings, 'STRIPE_TIMEOUT', 30)),
+                    # retries resend the same idempotency key, stripe generates one when none is given
+                    max_network_retries=getattr(settings, 'STRIPE_MAX_NETWORK_RETRIES', 2))
+            return client
+
+    def reset(self):
+        # settings changed, e.g. STRIPE_API_BASE in tests
+        with self.lock:
+            self.clients.clear()
+
+
+gateway = StripeGateway()
+
+
+def amount_of(cost):
+    # FloatField costs, 19.99 * 100 is 1998.9999999999998 as a float
+    if cost is None:
+        return None
+    return int((Decimal(str(cost)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def idempotency_key(ids, amount, currency):
+    # the same appointment vaccines at the same price map to the same intent; a new price makes a new one
+    key = f'payment-sheet-av-{"-".join(map(str, ids))}-{amount}{currency}'
+    if len(key) > IDEMPOTENCY_KEY_LENGTH:
+        key = f'payment-sheet-av-{hashlib.sha256(key.encode()).hexdigest()}'
+    return key
+
+
+async def pays_for_anyone(user):
+    # staff and doctors take payment at the desk on behalf of the citizen
+    return (user.is_staff or user.is_superuser
+            or await Staff.objects.filter(pk=user.pk).aexists()
+            or await Doctor.objects.filter(pk=user.pk).aexists())
+
+
+async def get_items(ids, citizen_id=None):
+    ids = sorted({int(i) for i in ids})
+    if not ids:
+        raise PaymentError('No appointment vaccine to pay for.')
+    if len(ids) > PAYMENT_MAX_ITEMS:
+        raise PaymentError(f'At most {PAYMENT_MAX_ITEMS} appointment vaccines per payment.')
+
+    queryset = AppointmentVaccine.objects.filter(id__in=ids, active=True).select_related('appointment__citizen')
+    if citizen_id is not None:
+        # only the citizen's own: the sheet hands out a key to their Stripe customer and its saved cards.
+        # Another citizen's items read as missing, so ids cannot be probed
+        queryset = queryset.filter(appointment__citizen_id=citizen_id)
+    items = [item async for item in queryset.order_by('id')]
+    missing = set(ids) - {item.id for item in items}
+    if missing:
+        raise PaymentError(f'Appointment vaccines not found: {", ".join(map(str, sorted(missing)))}.', 404)
+    if len({item.appointment.citizen_id for item in items}) > 1:
+        raise PaymentError('The appointment vaccines belong to different citizens.')
+    if any(item.status == 'cancelled' for item in items):
+        raise PaymentError('Cancelled appointment vaccines cannot be paid for.')
+    if any(item.cost is None for item in items):
+        raise PaymentError('An appointment vaccine has no cost.')
+    return items
+
+
+async def get_customer_id(client, citizen):
+    if citizen.stripe_customer_id:
+        return citizen.stripe_customer_id
+
+    params = {'metadata': {'citizen_id': str(citizen.pk)}}
+    name = f'{citizen.last_name} {citizen.first_name}'.strip()
+    if name:
+        params['name'] = name
+    if citizen.email:
+        params['email'] = citizen.email
+    # two first payments at once get the same customer back from Stripe, the first id stored wins
+    customer = await client.customers.create_async(params=params,
+                                                   options={'idempotency_key': f'citizen-{citizen.pk}-customer'})
+    await Citizen.objects.filter(pk=citizen.pk, stripe_customer_id__isnull=True).aupdate(stripe_customer_id=customer.id)
+    citizen.stripe_customer_id = await Citizen.objects.values_list('stripe_customer_id', flat=True).aget(pk=citizen.pk)
+    return citizen.stripe_customer_id
+
+
+async def record(citizen, items, intent, key, amount, currency):
+    try:
+        payment, created = await Payment.objects.aget_or_create(intent_id=intent.id, defaults={
+            'citizen': citizen, 'idempotency_key': key, 'amount': amount, 'currency': currency,
+            'status': intent.status})
+    except IntegrityError:
+        # a concurrent retry recorded the same intent
+        return await Payment.objects.aget(intent_id=intent.id)
+    if created:
+        await payment.appointment_vaccines.aset(items)
+    elif payment.status != intent.status:
+        await Payment.objects.filter(pk=payment.pk).aupdate(status=intent.status)
+    return payment
+
+
+async def create_payment_sheet(ids, citizen_id=None):
+    # awaits Stripe instead of holding a worker thread for the length of three calls
+    items = await get_items(ids, citizen_id)
+    citizen = items[0].appointment.citizen
+    currency = getattr(settings, 'STRIPE_CURRENCY', 'usd')
+    amount = sum(amount_of(item.cost) for item in items)
+    if amount <= 0:
+        raise PaymentError('Nothing to pay.')
+    key = idempotency_key([item.id for item in items], amount, currency)
+    intent_params = {
+        'amount': amount,
+        'currency': currency,
+        'automatic_payment_methods': {'enabled': True},
+        'metadata': {'citizen_id': str(citizen.pk),
+                     'appointment_vaccine_ids': ','.join(str(item.id) for item in items)},
+    }
+    key_options = {'stripe_version': settings.STRIPE_API_VERSION} if settings.STRIPE_API_VERSION else {}
+    client = gateway.get_client()
+
+    try:
+        customer_id = await get_customer_id(client, citizen)
+        # independent once the customer exists, the two calls run side by side
+        ephemeral_key, intent = await asyncio.gather(
+            client.ephemeral_keys.create_async(params={'customer': customer_id}, options=key_options),
+            client.payment_intents.create_async(params={**intent_params, 'customer': customer_id},
+                                                options={'idempotency_key': key}))
+    except stripe.StripeError as e:
+        raise PaymentError(e.user_message or str(e), 502)
+
+    await record(citizen, items, intent, key, amount, currency)
+    return {
+        'paymentIntent': intent.client_secret,
+        'ephemeralKey': ephemeral_key.secret,
+        'customer': customer_id,
+        'amount': amount,
+        'currency': currency,
+    }
@@ -0,0 +1,57 @@
+from django.db.models import Count, Sum, Q
+from vac_management.models import *
+from vac_management.rollups import PERIODS
+
+
+def completion_rate_from_rows(period='month', start_date=None, end_date=None, location=None, vaccine_id=None):
+    queryset = AppointmentVaccine.objects.filter(active=True)
+    if location:
+        queryset = queryset.filter(appointment__location__icontains=location)
+    if vaccine_id:
+        queryset = queryset.filter(vaccine_id=vaccine_id)
+
+    return _completion_rate(queryset, 'appointment__scheduled_date', period, start_date, end_date,
+                            completed=Count('id', filter=Q(status='completed')),
+                            cancelled=Count('id', filter=Q(status='cancelled')),
+                            total=Count('id'))
+
+
+def completion_rate_from_rollup(period='month', start_date=None, end_date=None):
+    queryset = VaccinationDailyStat.objects.filter(source='appointment_vaccine')
+
+    return _completion_rate(queryset, 'day', period, start_date, end_date,
+                            completed=Sum('total', filter=Q(status='completed'), default=0),
+                            cancelled=Sum('total', filter=Q(status='cancelled'), default=0),
+                            total=Sum('total', default=0))
+
+
+def completion_rate(period='month', start_date=None, end_date=None, location=None, vaccine_id=None):
+    # location and vaccine are not part of the rollup key
+    if location or vaccine_id:
+        return completion_rate_from_rows(period, start_date, end_date, location, vaccine_id)
+    return completion_rate_from_rollup(period, start_date, end_date)
+
+
+def _completion_rate(queryset, date_field, period, start_date, end_date, completed, cancelled, total):
+    if start_date:
+        queryset = queryset.filter(**{f'{date_field}__gte': start_date})
+    if end_date:
+        queryset = queryset.filter(**{f'{date_field}__lte': end_date})
+
+    rows = (queryset
+            .annotate(period=PERIODS[period](date_field))
+            .values('period')
+            .annotate(total_completed=completed, total_cancelled=cancelled, total_appointments=total)
+            .filter(total_appointments__gt=0)
+            .order_by('period'))
+
+    return [
+        {
+            'period': row['period'].isoformat(),
+            'total_completed': row['total_completed'],
+            'total_cancelled': row['total_cancelled'],
+            'total_appointments': row['total_appointments'],
+            'completion_rate_percent': round(row['total_completed'] / row['total_appointments'] * 100, 2),
+        }
+        for row in rows
+    ]
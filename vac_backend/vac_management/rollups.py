@@ -0,0 +1,214 @@
+from collections import Counter
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum, F, Q
+from django.db.models.functions import TruncMonth, TruncQuarter, TruncYear
+from vac_management.models import *
+
+PERIODS = {
+    'month': TruncMonth,
+    'quarter': TruncQuarter,
+    'year': TruncYear,
+}
+
+# fields whose change moves a row (or its children) to another rollup bucket
+TRACKED_FIELDS = {
+    AppointmentVaccine: ('appointment_id', 'vaccine_id', 'status', 'active', 'dose_quantity_used'),
+    Appointment: ('citizen_id', 'scheduled_date', 'active'),
+    Vaccine: ('category_id',),
+    Campaign: ('start_date',),
+    CampaignVaccine: ('campaign_id', 'vaccine_id', 'dose_quantity_used'),
+    CampaignCitizen: ('campaign_id', 'citizen_id', 'injection_date'),
+}
+
+# a bucket created by another transaction between our read and our insert is read again
+ROLLUP_RETRIES = 3
+
+DAILY_KEY = ('source', 'day', 'status', 'category_id', 'campaign_id')
+CITIZEN_KEY = ('source', 'period_type', 'period_start', 'campaign_id', 'citizen_id')
+
+
+def appointment_vaccine_rows(queryset):
+    rows = (queryset.filter(active=True)
+            .order_by()
+            .values('status', day=F('appointment__scheduled_date'), category_id=F('vaccine__category_id'))
+            .annotate(total=Count('id'), doses=Sum('dose_quantity_used')))
+    for row in rows:
+        key = ('appointment_vaccine', row['day'], row['status'], row['category_id'], None)
+        yield VaccinationDailyStat, key, row['total'], row['doses'] or 0
+
+
+def campaign_vaccine_rows(queryset):
+    rows = (queryset.order_by()
+            .values('campaign_id', day=F('campaign__start_date'), category_id=F('vaccine__category_id'))
+            .annotate(total=Count('id'), doses=Sum('dose_quantity_used')))
+    for row in rows:
+        key = ('campaign_vaccine', row['day'], '', row['category_id'], row['campaign_id'])
+        yield VaccinationDailyStat, key, row['total'], row['doses'] or 0
+
+
+def appointment_citizen_rows(queryset):
+    for period_type, truncate_func in PERIODS.items():
+        rows = (queryset.filter(active=True)
+                .order_by()
+                .annotate(period_start=truncate_func('scheduled_date'))
+                .values('period_start', 'citizen_id')
+                .annotate(total=Count('id')))
+        for row in rows:
+            key = ('appointment', period_type, row['period_start'], None, row['citizen_id'])
+            yield CitizenPeriodStat, key, row['total'], None
+
+
+def campaign_citizen_rows(queryset):
+    for period_type, truncate_func in PERIODS.items():
+        rows = (queryset.order_by()
+                .annotate(period_start=truncate_func('injection_date'))
+                .values('period_start', 'citizen_id')
+                .annotate(total=Count('id')))
+        for row in rows:
+            key = ('campaign', period_type, row['period_start'], None, row['citizen_id'])
+            yield CitizenPeriodStat, key, row['total'], None
+
+    rows = queryset.order_by().values('campaign_id', 'citizen_id').annotate(total=Count('id'))
+    for row in rows:
+        key = ('campaign', 'all', None, row['campaign_id'], row['citizen_id'])
+        yield CitizenPeriodStat, key, row['total'], None
+
+
+def get_scopes(instance, deleting=False):
+    # Children of a deleted parent send their own delete signals, so only
+    # updates need to re-read them. Vaccine is the exception: its
+    # AppointmentVaccine rows are SET_NULL without signals.
+    pk = instance.pk
+    if isinstance(instance, AppointmentVaccine):
+        return [(appointment_vaccine_rows, AppointmentVaccine.objects.filter(pk=pk))]
+    if isinstance(instance, Appointment):
+        scopes = [(appointment_citizen_rows, Appointment.objects.filter(pk=pk))]
+        if not deleting:
+            scopes.append((appointment_vaccine_rows, AppointmentVaccine.objects.filter(appointment_id=pk)))
+        return scopes
+    if isinstance(instance, Vaccine):
+        if deleting:
+            ids = getattr(instance, '_rollup_children', None)
+            if ids is None:
+                ids = instance._rollup_children = list(
+                    AppointmentVaccine.objects.filter(vaccine_id=pk).values_list('id', flat=True))
+            return [(appointment_vaccine_rows, AppointmentVaccine.objects.filter(id__in=ids))]
+        return [(appointment_vaccine_rows, AppointmentVaccine.objects.filter(vaccine_id=pk)),
+                (campaign_vaccine_rows, CampaignVaccine.objects.filter(vaccine_id=pk))]
+    if isinstance(instance, Campaign):
+        if deleting:
+            return []
+        return [(campaign_vaccine_rows, CampaignVaccine.objects.filter(campaign_id=pk))]
+    if isinstance(instance, CampaignVaccine):
+        return [(campaign_vaccine_rows, CampaignVaccine.objects.filter(pk=pk))]
+    if isinstance(instance, CampaignCitizen):
+        return [(campaign_citizen_rows, CampaignCitizen.objects.filter(pk=pk))]
+    return []
+
+
+def snapshot_scopes(scopes):
+    counter = Counter()
+    for rows_func, queryset in scopes:
+        for model, key, total, doses in rows_func(queryset):
+            counter[(model, key, 'total')] += total
+            if doses is not None:
+                counter[(model, key, 'doses')] += doses
+    return counter
+
+
+def snapshot(instance, deleting=False):
+    return snapshot_scopes(get_scopes(instance, deleting))
+
+
+def has_changed(instance):
+    if instance._state.adding or instance.pk is None:
+        return True
+    fields = TRACKED_FIELDS[type(instance)]
+    old = type(instance).objects.filter(pk=instance.pk).values(*fields).first()
+    if old is None:
+        return True
+    return any(old[field] != getattr(instance, field) for field in fields)
+
+
+def apply_delta(before, after):
+    delta = Counter(after)
+    delta.subtract(before)
+
+    grouped = {}
+    for (model, key, field), value in delta.items():
+        if value:
+            grouped.setdefault(model, {}).setdefault(key, {})[field] = value
+
+    with transaction.atomic():
+        for model, changes in grouped.items():
+            for attempt in range(ROLLUP_RETRIES):
+                try:
+                    with transaction.atomic():
+                        apply_changes(model, changes)
+                    break
+                except IntegrityError:
+                    if attempt + 1 == ROLLUP_RETRIES:
+                        raise
+
+
+def apply_changes(model, changes):
+    # a fixed number of statements per rollup table, however many buckets moved
+    key_fields = DAILY_KEY if model is VaccinationDailyStat else CITIZEN_KEY
+    lookups = {key: dict(zip(key_fields, key)) for key in changes}
+    condition = Q()
+    for lookup in lookups.values():
+        condition |= Q(**lookup)
+    existing = {tuple(getattr(obj, field) for field in key_fields): obj
+                for obj in model.objects.filter(condition)}
+
+    counters = sorted({field for fields in changes.values() for field in fields})
+    updated, created, decremented = [], [], []
+    for key, fields in changes.items():
+        obj = existing.get(key)
+        if obj is None:
+            created.append(model(**lookups[key], **fields))
+            continue
+        for field in counters:
+            setattr(obj, field, F(field) + fields.get(field, 0))
+        updated.append(obj)
+        if fields.get('total', 0) < 0:
+            decremented.append(obj.pk)
+
+    if updated:
+        model.objects.bulk_update(updated, counters)
+    if created:
+        model.objects.bulk_create(created)
+    if decremented:
+        model.objects.filter(pk__in=decremented, total__lte=0).delete()
+
+
+def iter_all_rows():
+    yield from appointment_vaccine_rows(AppointmentVaccine.objects.all())
+    yield from campaign_vaccine_rows(CampaignVaccine.objects.all())
+    yield from appointment_citizen_rows(Appointment.objects.all())
+    yield from campaign_citizen_rows(CampaignCitizen.objects.all())
+
+
+def rebuild(batch_size=1000):
+    with transaction.atomic():
+        VaccinationDailyStat.objects.all().delete()
+        CitizenPeriodStat.objects.all().delete()
+
+        batches = {VaccinationDailyStat: [], CitizenPeriodStat: []}
+        created = 0
+        for model, key, total, doses in iter_all_rows():
+            if model is VaccinationDailyStat:
+                obj = model(**dict(zip(DAILY_KEY, key)), total=total, doses=doses)
+            else:
+                obj = model(**dict(zip(CITIZEN_KEY, key)), total=total)
+            batches[model].append(obj)
+            if len(batches[model]) >= batch_size:
+                model.objects.bulk_create(batches[model])
+                created += len(batches[model])
+                batches[model] = []
+
+        for model, objs in batches.items():
+            model.objects.bulk_create(objs)
+            created += len(objs)
+
+    return created
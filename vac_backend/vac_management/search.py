@@ -0,0 +1,121 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from vac_management.models import Campaign, SearchTerm, Vaccine, VaccineCategory
+
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+PREFIX_MIN_LENGTH = 2
+SEARCH_LIMIT = 20
+PREFIX_WEIGHT = 0.5
+
+TOKEN_RE = re.compile(r'\w+')
+
+# indexed fields and their weight in the rank, per document type
+INDEXED = {
+    'vaccine': (Vaccine, {'vaccine_name': 3, 'instruction': 1}),
+    'campaign': (Campaign, {'campaign_name': 3, 'location': 2, 'description': 1}),
+    'category': (VaccineCategory, {'category_name': 3}),
+}
+DOC_TYPES = {model: doc_type for doc_type, (model, _) in INDEXED.items()}
+
+
+def fold(text):
+    # lower-case without diacritics, "Tiêm chủng Đà Nẵng" -> "tiem chung da nang"; đ has no decomposition
+    text = unicodedata.normalize('NFKD', text.lower().replace('đ', 'd'))
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(fold(text or ''))]
+
+
+def document_terms(instance):
+    _, fields = INDEXED[DOC_TYPES[type(instance)]]
+    weights = Counter()
+    for field, weight in fields.items():
+        for token in tokenize(getattr(instance, field)):
+            weights[token] += weight
+    return weights
+
+
+def build_terms(instance):
+    doc_type = DOC_TYPES[type(instance)]
+    return [SearchTerm(doc_type=doc_type, object_id=instance.pk, term=term, weight=weight)
+            for term, weight in document_terms(instance).items()]
+
+
+def needs_index(instance, update_fields=None):
+    if update_fields is None:
+        return True
+    _, fields = INDEXED[DOC_TYPES[type(instance)]]
+    return bool(set(update_fields) & {'active', *fields})
+
+
+def index(instance):
+    with transaction.atomic():
+        unindex(instance)
+        if instance.active:
+            SearchTerm.objects.bulk_create(build_terms(instance))
+
+
+def unindex(instance):
+    SearchTerm.objects.filter(doc_type=DOC_TYPES[type(instance)], object_id=instance.pk).delete()
+
+
+def rebuild(batch_size=1000):
+    created = 0
+    with transaction.atomic():
+        SearchTerm.objects.all().delete()
+        for model, fields in INDEXED.values():
+            terms = []
+            for instance in model.objects.filter(active=True).only('id', *fields).iterator(chunk_size=batch_size):
+                terms.extend(build_terms(instance))
+                if len(terms) >= batch_size:
+                    created += len(SearchTerm.objects.bulk_create(terms))
+                    terms = []
+            created += len(SearchTerm.objects.bulk_create(terms))
+    return created
+
+
+def search(query, doc_types=None, limit=SEARCH_LIMIT):
+    # every query term has to match, the last word of a query may be typed partially;
+    # a document scores its best match per term, prefix matches at half weight
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return []
+
+    # only the last word is still being typed, the ones before it are whole words
+    prefix = tokens[-1] if len(tokens[-1]) >= PREFIX_MIN_LENGTH else None
+    condition = Q(term__in=tokens)
+    if prefix:
+        # terms are stored folded, so the plain LIKE of istartswith keeps the term index usable on MySQL
+        condition |= Q(term__istartswith=prefix)
+    queryset = SearchTerm.objects.filter(condition)
+    if doc_types:
+        queryset = queryset.filter(doc_type__in=doc_types)
+
+    scores = defaultdict(lambda: [0] * len(tokens))
+    for doc_type, object_id, term, weight in queryset.values_list('doc_type', 'object_id', 'term', 'weight'):
+        best = scores[(doc_type, object_id)]
+        for i, token in enumerate(tokens):
+            if term == token:
+                best[i] = max(best[i], weight)
+            elif token == prefix and term.startswith(token):
+                best[i] = max(best[i], weight * PREFIX_WEIGHT)
+
+    hits = [(doc_type, object_id, sum(best)) for (doc_type, object_id), best in scores.items() if all(best)]
+    hits.sort(key=lambda hit: (-hit[2], hit[0], hit[1]))
+    return hits[:limit] if limit else hits
+
+
+def filter_ranked(queryset, query):
+    # the queryset restricted to matching rows, best first
+    doc_type = DOC_TYPES[queryset.model]
+    ids = [object_id for _, object_id, _ in search(query, [doc_type], limit=None)]
+    if not ids:
+        return queryset.none()
+    rank = Case(*[When(pk=pk, then=Value(i)) for i, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(rank, 'pk')
@@ -1,6 +1,6 @@
 from rest_framework import serializers
+from vac_management import thumbnails, uploads
 from vac_management.models import *
-from cloudinary.uploader import upload
 
 
 class BaseSerializer(serializers.ModelSerializer):
@@ -9,28 +9,83 @@ class BaseSerializer(serializers.ModelSerializer):
         return d
 
 
+class AsyncUploadMixin:
+    # files sent for these fields are spooled and uploaded by the background workers (uploads.py);
+    # the field stays as it was until the upload is done
+    async_upload_fields = ()
+
+    def pop_uploads(self, validated_data):
+        return {field: validated_data.pop(field) for field in self.async_upload_fields
+                if validated_data.get(field) is not None}
+
+    def queue_uploads(self, instance, files):
+        for field, file in files.items():
+            uploads.queue(instance, field, file)
+
+    def create(self, validated_data):
+        files = self.pop_uploads(validated_data)
+        instance = super().create(validated_data)
+        self.queue_uploads(instance, files)
+        return instance
+
+    def update(self, instance, validated_data):
+        files = self.pop_uploads(validated_data)
+        instance = super().update(instance, validated_data)
+        self.queue_uploads(instance, files)
+        return instance
+
+    def to_representation(self, instance):
+        d = super().to_representation(instance)
+        pending = instance.__dict__.get('_pending_uploads')
+        if pending:
+            d['pending_uploads'] = {field: PendingAssetSerializer(asset).data for field, asset in pending.items()}
+        return d
+
+
+class ImageVariantsField(serializers.Field):
+    # {"thumbnail": url, "medium": url} from the variants column of an image field, null until
+    # the variants exist; reads the column itself, so fast reads render it too
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return thumbnails.variant_urls(value, self.context.get('request'))
+
+
+class PendingAssetSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PendingAsset
+        fields = ['token', 'field', 'status', 'public_id', 'error', 'created_date', 'finished_at']
+
+
 class VaccineCategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = VaccineCategory
         fields = ['id', 'category_name']
 
 
-class BaseUserSerializer(serializers.ModelSerializer):
+class BaseUserSerializer(AsyncUploadMixin, serializers.ModelSerializer):
     avatar = serializers.FileField(required=False, allow_null=True)
+    avatar_variants = ImageVariantsField()
+    async_upload_fields = ('avatar',)
 
-    def get_avatar(self, obj):
-        avatar = obj.avatar
+    @staticmethod
+    def represent_avatar(avatar):
         if hasattr(avatar, 'url'):
             return avatar.url
         elif isinstance(avatar, str):
             return avatar
         return None
 
+    def get_avatar(self, obj):
+        return self.represent_avatar(obj.avatar)
+
     class Meta:
         abstract = True
         model = BaseUser
-        fields = ['id', 'first_name', 'last_name', 'username', 'password', 'avatar', 'gender', 'address',
-                  'date_of_birth', 'phone_number', 'email', 'is_superuser', 'is_staff', 'is_active', ]
+        fields = ['id', 'first_name', 'last_name', 'username', 'password', 'avatar', 'avatar_variants', 'gender',
+                  'address', 'date_of_birth', 'phone_number', 'email', 'is_superuser', 'is_staff', 'is_active', ]
         extra_kwargs = {
             'password': {
                 'write_only': True
@@ -38,16 +93,13 @@ class BaseUserSerializer(serializers.ModelSerializer):
         }
 
     def create(self, validated_data):
-        avatar_file = validated_data.pop('avatar', None)
+        files = self.pop_uploads(validated_data)
         data = validated_data.copy()
         user = BaseUser(**data)
         user.set_password(user.password)
         user.is_active = True
-        if avatar_file:
-            upload_result = upload(avatar_file)
-            user.avatar = upload_result['public_id']
-
         user.save()
+        self.queue_uploads(user, files)
 
         return user
 
@@ -122,8 +174,10 @@ class DoctorSerializer(BaseUserSerializer):
         return instance
 
 
-class VaccineSerializer(BaseSerializer):
+class VaccineSerializer(AsyncUploadMixin, BaseSerializer):
     image = serializers.FileField(required=False, allow_null=True)
+    image_variants = ImageVariantsField()
+    async_upload_fields = ('image',)
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=VaccineCategory.objects.all(),
         source='category',
@@ -133,8 +187,8 @@ class VaccineSerializer(BaseSerializer):
 
     class Meta:
         model = Vaccine
-        fields = ['id', 'category_id', 'category_name', 'vaccine_name', 'dose_quantity', 'image', 'instruction',
-                  'unit_price', 'created_date', 'updated_date']
+        fields = ['id', 'category_id', 'category_name', 'vaccine_name', 'dose_quantity', 'image', 'image_variants',
+                  'instruction', 'unit_price', 'created_date', 'updated_date']
 
 
 class AppointmentSerializer(BaseSerializer):
@@ -167,13 +221,54 @@ class AppointmentVaccineSerializer(BaseSerializer):
         }
 
 
-class CampaignSerializer(BaseSerializer):
+class AppointmentVaccineBulkCreateSerializer(serializers.Serializer):
+    # plain ids, relations are resolved for the whole batch at once
+    appointment = serializers.IntegerField()
+    vaccine = serializers.IntegerField()
+    doctor = serializers.IntegerField()
+    dose_quantity_used = serializers.IntegerField(min_value=0)
+    status = serializers.ChoiceField(choices=AppointmentVaccine.STATUS_CHOICES, default='scheduled')
+    notes = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    cost = serializers.FloatField(required=False, allow_null=True)
+
+
+class AppointmentVaccineStatusSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=AppointmentVaccine.STATUS_CHOICES)
+
+
+class AppointmentSlotSerializer(serializers.ModelSerializer):
+    available = serializers.SerializerMethodField()
+
+    def get_available(self, obj):
+        return max(obj.capacity - obj.booked, 0)
+
+    def validate_location(self, value):
+        return value.strip().lower()
+
+    class Meta:
+        model = AppointmentSlot
+        fields = ['id', 'location', 'date', 'shift', 'capacity', 'booked', 'available']
+        read_only_fields = ['booked']
+        extra_kwargs = {
+            'capacity': {'min_value': 0}
+        }
+
+
+class StockReceiptSerializer(serializers.Serializer):
+    quantity = serializers.IntegerField(min_value=1)
+    note = serializers.CharField(required=False, allow_null=True, allow_blank=True, max_length=255)
+
+
+class CampaignSerializer(AsyncUploadMixin, BaseSerializer):
     image = serializers.FileField(required=False, allow_null=True)
+    image_variants = ImageVariantsField()
+    async_upload_fields = ('image',)
 
     class Meta:
         model = Campaign
         fields = ['id', 'created_date', 'updated_date', 'campaign_name', 'description', 'start_date', 'end_date',
-                  'location', 'target_population', 'status', 'image']
+                  'location', 'target_population', 'status', 'image', 'image_variants']
 
 
 class CampaignCitizenSerializer(BaseSerializer):
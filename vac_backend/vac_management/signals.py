@@ -0,0 +1,186 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from vac_management import inventory, rollups, search, slots, timeline
+from vac_management.caching import catalog_cache, model_versions
+from vac_management.models import (Appointment, AppointmentVaccine, BaseUser, Campaign, CampaignCitizen, CampaignVaccine,
+                                    Citizen, Doctor, Staff, VaccineCategory, Vaccine)
+
+
+def rollup_pre_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if rollups.has_changed(instance):
+        instance._rollup_before = rollups.snapshot(instance) if instance.pk else rollups.Counter()
+    else:
+        instance._rollup_before = None
+
+
+def rollup_post_save(sender, instance, raw=False, **kwargs):
+    before = getattr(instance, '_rollup_before', None)
+    if raw or before is None:
+        return
+    rollups.apply_delta(before, rollups.snapshot(instance))
+    instance._rollup_before = None
+
+
+def rollup_pre_delete(sender, instance, **kwargs):
+    instance._rollup_before = rollups.snapshot(instance, deleting=True)
+
+
+def rollup_post_delete(sender, instance, **kwargs):
+    after = rollups.snapshot(instance, deleting=True) if sender is rollups.Vaccine else rollups.Counter()
+    rollups.apply_delta(instance._rollup_before, after)
+
+
+# connected per model so that untracked models keep Django's fast-delete path
+for model in rollups.TRACKED_FIELDS:
+    pre_save.connect(rollup_pre_save, sender=model, dispatch_uid=f'rollup_pre_save_{model.__name__}')
+    post_save.connect(rollup_post_save, sender=model, dispatch_uid=f'rollup_post_save_{model.__name__}')
+    pre_delete.connect(rollup_pre_delete, sender=model, dispatch_uid=f'rollup_pre_delete_{model.__name__}')
+    post_delete.connect(rollup_post_delete, sender=model, dispatch_uid=f'rollup_post_delete_{model.__name__}')
+
+
+def bump_catalog_version(sender, **kwargs):
+    # after commit, so a concurrent reader cannot cache pre-commit rows under the new version
+    transaction.on_commit(catalog_cache.bump_version)
+
+
+for model in (VaccineCategory, Vaccine):
+    post_save.connect(bump_catalog_version, sender=model, dispatch_uid=f'catalog_post_save_{model.__name__}')
+    post_delete.connect(bump_catalog_version, sender=model, dispatch_uid=f'catalog_post_delete_{model.__name__}')
+
+
+# models the conditional-GET viewsets read; the user models share one version
+VERSIONED_MODELS = (Appointment, AppointmentVaccine, Campaign, CampaignCitizen, CampaignVaccine, VaccineCategory, Vaccine,
+                    BaseUser, Citizen, Doctor, Staff)
+
+
+def bump_model_version(sender, **kwargs):
+    # the write is committed by then, a failed bump is logged instead of failing the request
+    transaction.on_commit(lambda: model_versions.bump(sender), robust=True)
+
+
+for model in VERSIONED_MODELS:
+    post_save.connect(bump_model_version, sender=model, dispatch_uid=f'version_post_save_{model.__name__}')
+    post_delete.connect(bump_model_version, sender=model, dispatch_uid=f'version_post_delete_{model.__name__}')
+
+
+STOCK_HOLDINGS = {
+    AppointmentVaccine: (inventory.appointment_vaccine_holdings, 'appointment_vaccine'),
+    CampaignVaccine: (inventory.campaign_vaccine_holdings, 'campaign_vaccine'),
+}
+
+
+def stock_pre_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    holdings_func, _ = STOCK_HOLDINGS[sender]
+    old = sender.objects.filter(pk=instance.pk).first() if instance.pk else None
+    instance._stock_before = holdings_func(old) if old else None
+
+
+def stock_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    holdings_func, link = STOCK_HOLDINGS[sender]
+    inventory.apply_movements(inventory.build_movements(getattr(instance, '_stock_before', None),
+                                                        holdings_func(instance), **{link: instance}))
+
+
+def stock_post_delete(sender, instance, origin=None, **kwargs):
+    # deleting the vaccine drops its stock and ledger as well
+    if getattr(origin, 'model', type(origin)) is Vaccine:
+        return
+    holdings_func, _ = STOCK_HOLDINGS[sender]
+    inventory.apply_movements(inventory.build_movements(holdings_func(instance), None,
+                                                        note=f'{sender.__name__} {instance.pk} deleted'))
+
+
+for model in STOCK_HOLDINGS:
+    pre_save.connect(stock_pre_save, sender=model, dispatch_uid=f'stock_pre_save_{model.__name__}')
+    post_save.connect(stock_post_save, sender=model, dispatch_uid=f'stock_post_save_{model.__name__}')
+    post_delete.connect(stock_post_delete, sender=model, dispatch_uid=f'stock_post_delete_{model.__name__}')
+
+
+def slot_pre_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._slot_before = slots.stored_slot_key(instance.pk) if instance.pk else None
+
+
+def slot_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    slots.move(getattr(instance, '_slot_before', None), slots.appointment_slot_key(instance))
+
+
+def slot_pre_delete(sender, instance, **kwargs):
+    instance._slot_before = slots.appointment_slot_key(instance)
+
+
+def slot_post_delete(sender, instance, **kwargs):
+    slots.move(instance._slot_before, None)
+
+
+def slot_staff_pre_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or not instance.pk or (update_fields is not None and 'shift' not in update_fields):
+        instance._shift_before = None
+        return
+    instance._shift_before = Staff.objects.filter(pk=instance.pk).values_list('shift', flat=True).first() or ''
+
+
+def slot_staff_post_save(sender, instance, raw=False, **kwargs):
+    before = getattr(instance, '_shift_before', None)
+    if raw or before is None or before == (instance.shift or ''):
+        return
+    slots.recount_for_staff(instance.pk, {before, instance.shift or ''})
+
+
+pre_save.connect(slot_pre_save, sender=Appointment, dispatch_uid='slot_pre_save_Appointment')
+post_save.connect(slot_post_save, sender=Appointment, dispatch_uid='slot_post_save_Appointment')
+pre_delete.connect(slot_pre_delete, sender=Appointment, dispatch_uid='slot_pre_delete_Appointment')
+post_delete.connect(slot_post_delete, sender=Appointment, dispatch_uid='slot_post_delete_Appointment')
+pre_save.connect(slot_staff_pre_save, sender=Staff, dispatch_uid='slot_pre_save_Staff')
+post_save.connect(slot_staff_post_save, sender=Staff, dispatch_uid='slot_post_save_Staff')
+
+
+def search_post_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or not search.needs_index(instance, update_fields):
+        return
+    search.index(instance)
+
+
+def search_post_delete(sender, instance, **kwargs):
+    search.unindex(instance)
+
+
+for model in search.DOC_TYPES:
+    post_save.connect(search_post_save, sender=model, dispatch_uid=f'search_post_save_{model.__name__}')
+    post_delete.connect(search_post_delete, sender=model, dispatch_uid=f'search_post_delete_{model.__name__}')
+
+
+def timeline_post_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if sender is AppointmentVaccine:
+        timeline.refresh('appointment_vaccine', [instance.pk])
+    elif sender is CampaignCitizen:
+        timeline.refresh('campaign_citizen', [instance.pk])
+    elif timeline.needs_refresh(instance, update_fields):
+        timeline.parent_saved(instance)
+
+
+def timeline_post_delete(sender, instance, **kwargs):
+    if sender is AppointmentVaccine:
+        timeline.remove('appointment_vaccine', [instance.pk])
+    elif sender is CampaignCitizen:
+        timeline.remove('campaign_citizen', [instance.pk])
+    elif sender is Vaccine:
+        timeline.vaccine_deleted(instance.pk)
+
+
+# deleting an appointment, campaign or doctor cascades to the sources, which remove their own events
+for model in (AppointmentVaccine, CampaignCitizen, *timeline.DENORMALIZED_FIELDS):
+    post_save.connect(timeline_post_save, sender=model, dispatch_uid=f'timeline_post_save_{model.__name__}')
+for model in (AppointmentVaccine, CampaignCitizen, Vaccine):
+    post_delete.connect(timeline_post_delete, sender=model, dispatch_uid=f'timeline_post_delete_{model.__name__}')
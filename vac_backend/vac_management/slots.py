@@ -0,0 +1,121 @@
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Lower, Trim
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from vac_management.models import Appointment, AppointmentSlot, SlotWaitlistEntry, Staff
+
+
+class SlotFull(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'This location has no capacity left for that day and shift.'
+    default_code = 'slot_full'
+
+
+def normalize_location(location):
+    return (location or '').strip().lower()
+
+
+def slot_key(location, date, shift, active=True):
+    if not active:
+        return None
+    return normalize_location(location), date, shift or ''
+
+
+def appointment_slot_key(appointment):
+    shift = Staff.objects.filter(pk=appointment.staff_id).values_list('shift', flat=True).first() \
+        if appointment.staff_id else None
+    return slot_key(appointment.location, appointment.scheduled_date, shift, appointment.active)
+
+
+def stored_slot_key(pk):
+    old = Appointment.objects.filter(pk=pk).values('location', 'scheduled_date', 'staff__shift', 'active').first()
+    if old is None:
+        return None
+    return slot_key(old['location'], old['scheduled_date'], old['staff__shift'], old['active'])
+
+
+def slot_filter(key):
+    location, date, shift = key
+    return {'location': location, 'date': date, 'shift': shift}
+
+
+def take(key):
+    # a single conditional UPDATE, it cannot pass capacity however many requests race;
+    # keys without a slot have no quota
+    with transaction.atomic():
+        taken = (AppointmentSlot.objects.filter(**slot_filter(key), booked__lt=F('capacity'))
+                 .update(booked=F('booked') + 1))
+        if not taken and AppointmentSlot.objects.filter(**slot_filter(key)).exists():
+            raise SlotFull()
+
+
+def release(key):
+    with transaction.atomic():
+        released = (AppointmentSlot.objects.filter(**slot_filter(key), booked__gt=0)
+                    .update(booked=F('booked') - 1))
+        if released:
+            promote(key)
+
+
+def move(before, after):
+    if before == after:
+        return
+    with transaction.atomic():
+        if after:
+            take(after)
+        if before:
+            release(before)
+
+
+def promote(key):
+    entry = (SlotWaitlistEntry.objects.select_for_update(skip_locked=True)
+             .filter(slot__in=AppointmentSlot.objects.filter(**slot_filter(key)))
+             .order_by('id').first())
+    if entry is None:
+        return None
+    # the new appointment takes the place through the usual post_save path
+    try:
+        with transaction.atomic():
+            appointment = Appointment.objects.create(citizen_id=entry.citizen_id, staff_id=entry.staff_id,
+                                                     scheduled_date=key[1], location=entry.location,
+                                                     notes=entry.notes)
+            entry.delete()
+    except SlotFull:
+        # the entry's own slot is full (its staff member changed shift, say): it keeps its turn,
+        # and the cancellation that freed this place goes through
+        return None
+    return appointment
+
+
+def enqueue(data):
+    key = slot_key(data['location'], data['scheduled_date'], data['staff'].shift if data.get('staff') else None)
+    slot = AppointmentSlot.objects.get(**slot_filter(key))
+    entry = SlotWaitlistEntry.objects.create(slot=slot, citizen=data['citizen'], staff=data.get('staff'),
+                                             location=data['location'], notes=data.get('notes'))
+    position = SlotWaitlistEntry.objects.filter(slot=slot, id__lte=entry.id).count()
+    return entry, position
+
+
+def recount(slot):
+    # called when a quota is defined or moved; reads are served from the booked counter afterwards
+    queryset = Appointment.objects.annotate(location_key=Lower(Trim('location'))).filter(
+        location_key=slot.location, scheduled_date=slot.date, active=True)
+    if slot.shift:
+        queryset = queryset.filter(staff__shift=slot.shift)
+    else:
+        queryset = queryset.filter(Q(staff__isnull=True) | Q(staff__shift__isnull=True) | Q(staff__shift=''))
+    slot.booked = queryset.count()
+    slot.save(update_fields=['booked'])
+    return slot
+
+
+def recount_for_staff(staff_id, shifts):
+    # a staff member changing shift moves their appointments between slots without saving any of them
+    pairs = set(Appointment.objects.filter(staff_id=staff_id, active=True)
+                .annotate(location_key=Lower(Trim('location')))
+                .values_list('location_key', 'scheduled_date'))
+    if not pairs:
+        return []
+    candidates = AppointmentSlot.objects.filter(shift__in=shifts, date__in={date for _, date in pairs})
+    return [recount(slot) for slot in candidates if (slot.location, slot.date) in pairs]
@@ -1,3 +1,2001 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from vac_management import (exports, inventory, metrics, paginators, payments, reports, rollups, search, serializers,
+                            slots, thumbnails, timeline, uploads, views)
+from vac_management.caching import catalog_cache, model_versions
+from vac_management.fastread import ReadPlan
+from vac_management.management.commands.benchmark_reports import legacy_completion_rate
+from vac_management.management.commands.load_test import FakeStripeHandler, start_fake_stripe
+from vac_management.models import *
+
+
+def create_sample_data(rows=6):
+    category = VaccineCategory.objects.create(category_name='Covid-19')
+    citizen = Citizen.objects.create(username='citizen', email='citizen@example.com', phone_number='0900000000')
+    staff = Staff.objects.create(username='staff', phone_number='0900000001', shift='morning')
+    doctor = Doctor.objects.create(username='doctor', phone_number='0900000002', specialty='Pediatrics')
+    campaign = Campaign.objects.create(campaign_name='Campaign', start_date=date(2025, 1, 1),
+                                       end_date=date(2025, 3, 1), description='Campaign')
+
+    for i in range(rows):
+        vaccine = Vaccine.objects.create(category=category, vaccine_name=f'Vaccine {i}', dose_quantity=100,
+                                         instruction='Instruction', unit_price=10.0)
+        appointment = Appointment.objects.create(citizen=citizen, staff=staff, scheduled_date=date(2025, 1 + i % 12, 1),
+                                                 location='Ho Chi Minh')
+        AppointmentVaccine.objects.create(appointment=appointment, vaccine=vaccine, doctor=doctor,
+                                          dose_quantity_used=1, status='completed' if i % 2 else 'scheduled',
+                                          cost=10.0)
+        CampaignVaccine.objects.create(campaign=campaign, vaccine=vaccine, dose_quantity_used=10)
+        CampaignCitizen.objects.create(campaign=campaign, citizen=Citizen.objects.create(
+            username=f'campaign_citizen_{i}', phone_number='0900000003'), injection_date=date(2025, 2, 1))
+
+    return citizen
+
+
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def count_queries(self, url):
+        # measure the uncached path
+        catalog_cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, paginator, small=1, large=5):
+        with mock.patch.object(paginator, 'page_size', small):
+            small_count = self.count_queries(url)
+        with mock.patch.object(paginator, 'page_size', large):
+            large_count = self.count_queries(url)
+        self.assertEqual(small_count, large_count, f'{url} issues more queries as the page grows')
+
+
+class RelatedGraphQueryTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.citizen = create_sample_data()
+
+    def test_list_endpoints(self):
+        endpoints = [
+            ('/vaccines/', paginators.VaccinePaginator),
+            ('/campaigns/', paginators.CampaignPaginator),
+            ('/campaignvaccine/', paginators.CampaignPaginator),
+            ('/campaigncitizen/', paginators.CampaignPaginator),
+            ('/appointments/', paginators.AppointmentPaginator),
+            ('/appointmentvaccine/', paginators.AppointmentVaccinesPaginator),
+        ]
+        for url, paginator in endpoints:
+            with self.subTest(url=url):
+                self.assertConstantQueries(url, paginator)
+
+    def test_by_citizen(self):
+        url = f'/appointments/by-citizen/?citizen_id={self.citizen.id}'
+        before = self.count_queries(url)
+        for i in range(5):
+            Appointment.objects.create(citizen=self.citizen, staff=Staff.objects.first(),
+                                       scheduled_date=date(2025, 6, 1), location='Ha Noi')
+        self.assertEqual(before, self.count_queries(url))
+
+    def test_appointment_details(self):
+        appointment = Appointment.objects.first()
+        url = f'/appointments/{appointment.id}/details/'
+        before = self.count_queries(url)
+        doctor = Doctor.objects.create(username='doctor_2', phone_number='0900000004')
+        for vaccine in Vaccine.objects.all():
+            AppointmentVaccine.objects.create(appointment=appointment, vaccine=vaccine, doctor=doctor,
+                                              dose_quantity_used=1)
+        self.assertEqual(before, self.count_queries(url))
+
+
+
+class StatsRollupTests(TestCase):
+    endpoints = [
+        '/appointments/completion-rate/?period=month',
+        '/appointments/completion-rate/?period=quarter',
+        '/appointments/people-completed/?period=year',
+        '/campaigncitizen/stats-by-campaign/',
+        '/campaigncitizen/stats-by-time/?period=quarter',
+        '/vaccineusage/vaccine-types-by-time/?period=month',
+    ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.citizen = create_sample_data()
+
+    maxDiff = None
+
+    def fetch_all(self):
+        return {url: self.client.get(url).json() for url in self.endpoints}
+
+    def test_incremental_matches_rebuild(self):
+        appointment = Appointment.objects.first()
+        appointment.scheduled_date = date(2024, 12, 31)
+        appointment.save()
+
+        av = AppointmentVaccine.objects.filter(status='scheduled').first()
+        av.status = 'completed'
+        av.save()
+
+        vaccine = Vaccine.objects.last()
+        vaccine.category = VaccineCategory.objects.create(category_name='Influenza')
+        vaccine.save()
+
+        Appointment.objects.last().delete()
+        CampaignCitizen.objects.create(campaign=Campaign.objects.first(), citizen=self.citizen,
+                                       injection_date=date(2025, 5, 1))
+        AppointmentVaccine.objects.filter(vaccine=Vaccine.objects.first()).first().vaccine.delete()
+
+        incremental = self.fetch_all()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.fetch_all())
+
+    def test_one_row_per_bucket(self):
+        key = {'source': 'campaign', 'period_type': 'all', 'period_start': None,
+               'campaign': Campaign.objects.first(), 'citizen': self.citizen}
+        CitizenPeriodStat.objects.create(**key, total=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CitizenPeriodStat.objects.create(**key, total=1)
+        row = VaccinationDailyStat.objects.filter(campaign=None).first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            VaccinationDailyStat.objects.create(source=row.source, day=row.day, status=row.status,
+                                                category=row.category, total=1)
+
+    def test_bucket_created_concurrently(self):
+        # another request inserts the same new bucket between our read and our insert
+        day = date(2026, 3, 1)
+        key = ('appointment_vaccine', day, 'scheduled', None, None)
+        VaccinationDailyStat.objects.create(**dict(zip(rollups.DAILY_KEY, key)), total=2, doses=2)
+        stale_read = [VaccinationDailyStat.objects.none()]
+        read = VaccinationDailyStat.objects.filter
+
+        def filter(*args, **kwargs):
+            return stale_read.pop() if stale_read else read(*args, **kwargs)
+
+        after = Counter({(VaccinationDailyStat, key, 'total'): 1, (VaccinationDailyStat, key, 'doses'): 3})
+        with mock.patch.object(VaccinationDailyStat.objects, 'filter', side_effect=filter):
+            rollups.apply_delta(Counter(), after)
+        row = VaccinationDailyStat.objects.get(day=day)
+        self.assertEqual((row.total, row.doses), (3, 5))
+
+    def test_completion_rate(self):
+        response = self.client.get('/appointments/completion-rate/?period=year').json()
+        self.assertEqual(response, [{
+            'period': '2025-01-01',
+            'total_completed': 3,
+            'total_cancelled': 0,
+            'total_appointments': 6,
+            'completion_rate_percent': 50.0,
+        }])
+
+    def test_stats_by_campaign(self):
+        CampaignCitizen.objects.create(campaign=Campaign.objects.first(), citizen=Citizen.objects.first(),
+                                       injection_date=date(2025, 2, 1))
+        response = self.client.get('/campaigncitizen/stats-by-campaign/').json()
+        self.assertEqual(response, [{'campaign__campaign_name': 'Campaign', 'total_vaccinated': 6}])
+
+
+class CompletionRateReportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        create_sample_data(rows=12)
+        av = AppointmentVaccine.objects.first()
+        av.status = 'cancelled'
+        av.save()
+
+    def test_matches_legacy(self):
+        for period in ('month', 'quarter', 'year'):
+            with self.subTest(period=period):
+                expected = legacy_completion_rate(period)
+                self.assertEqual(reports.completion_rate_from_rows(period), expected)
+                self.assertEqual(reports.completion_rate_from_rollup(period), expected)
+                self.assertEqual(self.client.get(f'/appointments/completion-rate/?period={period}').json(),
+                                 expected)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            reports.completion_rate('month', location='Ho Chi Minh')
+        with self.assertNumQueries(1):
+            reports.completion_rate('month')
+
+    def test_filters(self):
+        vaccine = Vaccine.objects.first()
+        response = self.client.get('/appointments/completion-rate/', {
+            'period': 'year', 'vaccine_id': vaccine.id, 'start_date': '2025-01-01', 'end_date': '2025-12-31'})
+        self.assertEqual(response.json()[0]['total_appointments'], 1)
+        response = self.client.get('/appointments/completion-rate/', {'start_date': '2025-07-01'})
+        self.assertEqual([row['period'] for row in response.json()],
+                         ['2025-07-01', '2025-08-01', '2025-09-01', '2025-10-01', '2025-11-01', '2025-12-01'])
+        self.assertEqual(self.client.get('/appointments/completion-rate/?period=week').status_code, 400)
+
+    def test_malformed_filters(self):
+        for params in ({'start_date': '2024-13-40x'}, {'end_date': '2024-02-30'}, {'vaccine_id': 'abc'}):
+            response = self.client.get('/appointments/completion-rate/', params)
+            self.assertEqual(response.status_code, 400)
+            param, value = next(iter(params.items()))
+            self.assertEqual(response.json(), {'detail': f'Invalid value for {param}: "{value}".'})
+
+
+class KeysetPaginationTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        create_sample_data(rows=10)
+
+    def test_follow_cursor(self):
+        ids, url = [], '/appointmentvaccine/?page_size=4'
+        while url:
+            data = self.client.get(url).json()
+            self.assertNotIn('count', data)
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+        self.assertEqual(ids, list(AppointmentVaccine.objects.order_by('-id').values_list('id', flat=True)))
+
+    def test_page_size_limit_and_count(self):
+        with mock.patch.object(paginators.AppointmentPaginator, 'max_page_size', 5):
+            data = self.client.get('/appointments/?page_size=50&count=true').json()
+        self.assertEqual(data['count'], 10)
+        self.assertEqual(len(data['results']), 5)
+
+    def test_no_count_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/appointments/')
+        self.assertFalse(any('COUNT(' in query['sql'] for query in ctx.captured_queries))
+
+
+def iter_mysql_tables(plan):
+    if isinstance(plan, dict):
+        if 'table_name' in plan:
+            yield plan
+        for value in plan.values():
+            yield from iter_mysql_tables(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from iter_mysql_tables(value)
+
+
+def full_table_scans(queryset):
+    # tables read without any usable index, according to the backend's EXPLAIN
+    queryset = queryset.order_by()
+    if connection.vendor == 'mysql':
+        plan = json.loads(queryset.explain(format='json'))
+        return [table['table_name'] for table in iter_mysql_tables(plan)
+                if table.get('access_type') == 'ALL' and not table.get('possible_keys')]
+    if connection.vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', queryset.explain())
+    return re.findall(r'\bSCAN (\w+)$', queryset.explain(), re.MULTILINE)
+
+
+def get_viewset_queryset(viewset_class, **params):
+    view = viewset_class(action='list', format_kwarg=None)
+    view.request = Request(APIRequestFactory().get('/', params))
+    return view.get_queryset()
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        catalog_cache.clear()
+        create_sample_data()
+
+    def test_read_through(self):
+        first = self.client.get('/vaccines/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/vaccines/')
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertIn('Last-Modified', second)
+
+    def test_conditional_get(self):
+        response = self.client.get('/categories/')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/categories/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get('/vaccines/by-name/Vaccine 1/',
+                                             HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get('/categories/', HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_write_bumps_version(self):
+        vaccine = Vaccine.objects.first()
+        before = self.client.get(f'/vaccines/{vaccine.id}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            vaccine.vaccine_name = 'Renamed'
+            vaccine.save()
+        after = self.client.get(f'/vaccines/{vaccine.id}/', HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.json()['vaccine_name'], 'Renamed')
+        self.assertNotEqual(before['ETag'], after['ETag'])
+
+    def test_stats(self):
+        self.assertEqual(self.client.get('/vaccines/cache-stats/').status_code, 401)
+        self.client.get('/vaccines/')
+        self.client.get('/vaccines/')
+        self.client.force_authenticate(Staff.objects.create(username='admin', phone_number='0900000009',
+                                                            is_staff=True))
+        stats = self.client.get('/vaccines/cache-stats/').json()
+        self.assertGreaterEqual(stats['misses'], 1)
+        self.assertGreaterEqual(stats['local_hits'], 1)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.citizen = create_sample_data()
+
+    def test_list(self):
+        url = f'/appointments/?citizen_id={self.citizen.id}'
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get('/appointments/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.filter(id=Appointment.objects.first().id).delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/campaigns/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # users have no updated_date, a renamed citizen changes the ETag all the same
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.citizen.first_name = 'Renamed'
+            self.citizen.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['citizen_info']['first_name'], 'Renamed')
+        # and so does a change made through BaseUser
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            BaseUser.objects.get(pk=self.citizen.pk).save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_versions_shared_between_processes(self):
+        # the versions live in the database: a worker with its own cache, or a management command, agree
+        url = f'/appointments/?citizen_id={self.citizen.id}'
+        etag = self.client.get(url)['ETag']
+        cache.clear()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # as generate_data does after its bulk inserts
+        model_versions.bump(Appointment)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail(self):
+        av = AppointmentVaccine.objects.first()
+        response = self.client.get(f'/appointmentvaccine/{av.id}/')
+        self.assertEqual(self.client.get(f'/appointmentvaccine/{av.id}/',
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(f'/appointmentvaccine/{av.id}/',
+                                         HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        # nested rows take part in the validator
+        with self.captureOnCommitCallbacks(execute=True):
+            av.vaccine.instruction = 'Updated'
+            av.vaccine.save()
+        response = self.client.get(f'/appointmentvaccine/{av.id}/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['vaccine_info']['instruction'], 'Updated')
+
+
+class FastReadTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        create_sample_data()
+        Citizen.objects.update(avatar='image/upload/v1/avatar.png')
+        Vaccine.objects.filter(id=Vaccine.objects.first().id).update(image='image/upload/v1/vaccine.png')
+
+    def test_same_output(self):
+        # keyset pages hold every row, so the bytes match link for link
+        for url in ('/appointments/?page_size=50', '/appointmentvaccine/?page_size=50'):
+            with self.subTest(url=url):
+                expected = self.client.get(url)
+                fast = self.client.get(f'{url}&fast=true')
+                self.assertEqual(fast.content, expected.content)
+                self.assertEqual(fast['Content-Type'], 'application/json')
+        for url in ('/campaigncitizen/', '/campaignvaccine/'):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(f'{url}?fast=1').json()['results'],
+                                 self.client.get(url).json()['results'])
+
+    def test_read_plan(self):
+        plan = ReadPlan(serializers.AppointmentVaccineSerializer())
+        self.assertIn('appointment__citizen__avatar', plan.columns)
+        self.assertNotIn('doctor__password', plan.columns)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(plan.render_rows(plan.values(AppointmentVaccine.objects.all()))), 6)
+
+
+class BulkAppointmentVaccineTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.citizen = create_sample_data()
+        self.doctor = Doctor.objects.first()
+
+    def daily_stats(self):
+        return sorted(VaccinationDailyStat.objects.values_list('source', 'day', 'status', 'category_id', 'total', 'doses'))
+
+    def assertRollupsRebuilt(self):
+        incremental = self.daily_stats()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.daily_stats())
+
+    def test_bulk_create(self):
+        appointments = [Appointment.objects.create(citizen=self.citizen, scheduled_date=date(2025, 6, 1 + i % 28),
+                                                   location='Ha Noi') for i in range(100)]
+        vaccines = list(Vaccine.objects.all()[:5])
+        for vaccine in vaccines:
+            inventory.receive(vaccine.id, 100)
+        items = [{'appointment': a.id, 'vaccine': v.id, 'doctor': self.doctor.id, 'dose_quantity_used': 1}
+                 for a in appointments for v in vaccines]
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/appointmentvaccine/bulk-create/', items, format='json')
+        self.assertEqual(response.status_code, 201)
+        # SQLite splits the row, stock ledger and timeline inserts into 999-parameter batches, other backends need fewer
+        self.assertLessEqual(len(ctx.captured_queries), 45)
+
+        created = AppointmentVaccine.objects.in_bulk(response.json()['created'])
+        self.assertEqual([(created[pk].appointment_id, created[pk].vaccine_id) for pk in response.json()['created']],
+                         [(item['appointment'], item['vaccine']) for item in items])
+        self.assertRollupsRebuilt()
+
+    def test_bulk_create_errors(self):
+        existing = AppointmentVaccine.objects.first()
+        appointment = Appointment.objects.first()
+        vaccine = Vaccine.objects.exclude(id=existing.vaccine_id).first()
+        valid = {'appointment': appointment.id, 'vaccine': vaccine.id, 'doctor': self.doctor.id,
+                 'dose_quantity_used': 1}
+        items = [
+            valid,
+            valid,
+            {'appointment': existing.appointment_id, 'vaccine': existing.vaccine_id, 'doctor': existing.doctor_id,
+             'dose_quantity_used': 1},
+            {**valid, 'vaccine': 0},
+            {**valid, 'status': 'unknown'},
+        ]
+        count = AppointmentVaccine.objects.count()
+
+        response = self.client.post('/appointmentvaccine/bulk-create/', items, format='json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([sorted(error) for error in errors],
+                         [[], ['non_field_errors'], ['non_field_errors'], ['vaccine'], ['status']])
+        self.assertEqual(AppointmentVaccine.objects.count(), count)
+        self.assertEqual(self.client.post('/appointmentvaccine/bulk-create/', {}, format='json').status_code, 400)
+
+    def test_bulk_status(self):
+        scheduled = list(AppointmentVaccine.objects.filter(status='scheduled'))
+        completed = AppointmentVaccine.objects.filter(status='completed').first()
+
+        response = self.client.post('/appointmentvaccine/bulk-status/', [
+            {'id': scheduled[0].id, 'status': 'completed'},
+            {'id': completed.id, 'status': 'scheduled'},
+            {'id': 0, 'status': 'cancelled'},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([sorted(error) for error in response.json()['errors']], [[], ['status'], ['id']])
+        self.assertEqual(AppointmentVaccine.objects.get(id=scheduled[0].id).status, 'scheduled')
+
+        items = [{'id': av.id, 'status': 'completed' if i % 2 else 'cancelled'} for i, av in enumerate(scheduled)]
+        # rollups, stock and timeline add a fixed number of statements per table and one UPDATE per vaccine
+        with self.assertNumQueries(26):
+            response = self.client.post('/appointmentvaccine/bulk-status/', items, format='json')
+        self.assertEqual(response.json(), {'updated': [av.id for av in scheduled]})
+        self.assertEqual(sorted(AppointmentVaccine.objects.filter(id__in=[av.id for av in scheduled])
+                                .values_list('status', flat=True)), ['cancelled', 'cancelled', 'completed'])
+        self.assertRollupsRebuilt()
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        cache.clear()
+        create_sample_data()
+        self.vaccine = Vaccine.objects.create(category=VaccineCategory.objects.first(), vaccine_name='Stocked',
+                                              dose_quantity=10, instruction='Instruction', unit_price=10.0)
+        self.doctor = Doctor.objects.first()
+
+    def stock(self):
+        return self.client.get(f'/vaccines/{self.vaccine.id}/stock/').json()
+
+    def assertLedgerMatches(self):
+        on_hand = reserved = 0
+        for kind, quantity in StockMovement.objects.filter(vaccine=self.vaccine).values_list('kind', 'quantity'):
+            on_hand += inventory.EFFECTS[kind][0] * quantity
+            reserved += inventory.EFFECTS[kind][1] * quantity
+        stock = VaccineStock.objects.get(vaccine=self.vaccine)
+        self.assertEqual((stock.on_hand, stock.reserved), (on_hand, reserved))
+
+    def book(self, doses, **kwargs):
+        appointment = Appointment.objects.create(citizen=Citizen.objects.first(), scheduled_date=date(2025, 7, 1))
+        return AppointmentVaccine.objects.create(appointment=appointment, vaccine=self.vaccine, doctor=self.doctor,
+                                                 dose_quantity_used=doses, **kwargs)
+
+    def test_lifecycle(self):
+        self.assertEqual(self.stock(), {'vaccine': self.vaccine.id, 'on_hand': 10, 'reserved': 0, 'available': 10})
+        first, second, third = self.book(3), self.book(2), self.book(1)
+        self.assertEqual(self.stock()['available'], 4)
+
+        first.status = 'completed'
+        first.save()
+        second.status = 'cancelled'
+        second.save()
+        third.delete()
+        CampaignVaccine.objects.create(campaign=Campaign.objects.first(), vaccine=self.vaccine, dose_quantity_used=4)
+        self.assertEqual(self.stock(), {'vaccine': self.vaccine.id, 'on_hand': 3, 'reserved': 0, 'available': 3})
+        self.assertEqual(sorted(StockMovement.objects.filter(vaccine=self.vaccine).values_list('kind', flat=True)),
+                         ['consume', 'issue', 'receipt', 'release', 'release', 'reserve', 'reserve', 'reserve'])
+        self.assertLedgerMatches()
+
+    def test_oversell_is_refused(self):
+        self.book(8)
+        appointment = Appointment.objects.create(citizen=Citizen.objects.first(), scheduled_date=date(2025, 7, 1))
+        response = self.client.post('/appointmentvaccine/', {
+            'appointment': appointment.id, 'vaccine': self.vaccine.id, 'doctor': self.doctor.id,
+            'dose_quantity_used': 3}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(AppointmentVaccine.objects.filter(appointment=appointment, vaccine=self.vaccine).exists())
+
+        response = self.client.post('/appointmentvaccine/bulk-create/', [
+            {'appointment': appointment.id, 'vaccine': self.vaccine.id, 'doctor': self.doctor.id,
+             'dose_quantity_used': 3}], format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.stock()['available'], 2)
+        self.assertLedgerMatches()
+
+    def test_opening_balance_keeps_earlier_reservations(self):
+        # rows scheduled before the stock ledger existed, written without signals
+        first, second, third = AppointmentVaccine.objects.bulk_create([
+            AppointmentVaccine(appointment=Appointment.objects.create(citizen=Citizen.objects.first(),
+                                                                      scheduled_date=date(2025, 7, 1)),
+                               vaccine=self.vaccine, doctor=self.doctor, dose_quantity_used=doses)
+            for doses in (3, 2, 4)])
+        self.assertFalse(VaccineStock.objects.filter(vaccine=self.vaccine).exists())
+
+        response = self.client.patch(f'/appointmentvaccine/{first.id}/', {'status': 'completed'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stock(), {'vaccine': self.vaccine.id, 'on_hand': 7, 'reserved': 6, 'available': 1})
+        response = self.client.patch(f'/appointmentvaccine/{second.id}/', {'status': 'cancelled'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stock()['reserved'], 4)
+        self.assertLedgerMatches()
+
+        # the count by hand was below the reservations
+        other = Vaccine.objects.create(category=self.vaccine.category, vaccine_name='Short', dose_quantity=1,
+                                       instruction='Instruction', unit_price=10.0)
+        AppointmentVaccine.objects.filter(pk=third.pk).update(vaccine=other)
+        self.assertEqual(inventory.get_stock(other.id), {'vaccine': other.id, 'on_hand': 4, 'reserved': 4,
+                                                         'available': 0})
+
+    def test_receipt(self):
+        url = f'/vaccines/{self.vaccine.id}/stock/receipts/'
+        self.assertEqual(self.client.post(url, {'quantity': 5}, format='json').status_code, 401)
+        self.client.force_authenticate(Staff.objects.create(username='admin', phone_number='0900000009',
+                                                            is_staff=True))
+        self.assertEqual(self.stock()['available'], 10)
+        response = self.client.post(url, {'quantity': 5, 'note': 'Delivery'}, format='json')
+        self.assertEqual(response.json()['available'], 15)
+        self.assertEqual(self.stock()['available'], 15)
+        self.assertEqual(self.client.post(url, {'quantity': 0}, format='json').status_code, 400)
+
+
+class InventoryConcurrencyTests(TransactionTestCase):
+    def test_no_overselling(self):
+        category = VaccineCategory.objects.create(category_name='Covid-19')
+        vaccine = Vaccine.objects.create(category=category, vaccine_name='Scarce', dose_quantity=20,
+                                         instruction='Instruction', unit_price=10.0)
+        doctor = Doctor.objects.create(username='doctor', phone_number='0900000002', specialty='Pediatrics')
+        citizen = Citizen.objects.create(username='citizen', phone_number='0900000000')
+        appointments = [Appointment.objects.create(citizen=citizen, scheduled_date=date(2025, 7, 1))
+                        for _ in range(40)]
+        inventory.get_stock(vaccine.id)
+
+        results = []
+
+        def book(appointment):
+            try:
+                for attempt in range(1000):
+                    try:
+                        with transaction.atomic():
+                            AppointmentVaccine.objects.create(appointment=appointment, vaccine=vaccine,
+                                                              doctor=doctor, dose_quantity_used=1)
+                        results.append('booked')
+                        return
+                    except inventory.InsufficientStock:
+                        results.append('refused')
+                        return
+                    except OperationalError:
+                        # SQLite locks whole tables, MySQL and PostgreSQL wait on the row instead
+                        time.sleep(random.random() / 100)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(appointment,)) for appointment in appointments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stock = VaccineStock.objects.get(vaccine=vaccine)
+        self.assertEqual(results.count('booked'), 20)
+        self.assertEqual(results.count('refused'), 20)
+        self.assertEqual((stock.on_hand, stock.reserved), (20, 20))
+        self.assertEqual(AppointmentVaccine.objects.filter(vaccine=vaccine).count(), 20)
+        self.assertEqual(StockMovement.objects.filter(vaccine=vaccine, kind='reserve').count(), 20)
+
+
+class SlotCapacityTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.citizen = create_sample_data()
+        self.staff = Staff.objects.first()
+        self.admin = Staff.objects.create(username='admin', phone_number='0900000009', is_staff=True)
+
+    def book(self, **kwargs):
+        return self.client.post('/appointments/', {
+            'citizen': self.citizen.id, 'staff': self.staff.id, 'scheduled_date': '2025-08-01',
+            'location': ' Ho Chi Minh ', **kwargs}, format='json')
+
+    def create_slot(self, capacity):
+        self.client.force_authenticate(self.admin)
+        response = self.client.post('/slots/', {'location': 'HO CHI MINH', 'date': '2025-08-01', 'shift': 'morning',
+                                                'capacity': capacity}, format='json')
+        self.client.force_authenticate(None)
+        return response
+
+    def test_quota(self):
+        self.assertEqual(self.book().status_code, 201)
+        self.assertEqual(self.create_slot(2).json()['booked'], 1)
+        self.assertEqual(self.book().status_code, 201)
+        self.assertEqual(self.book().status_code, 409)
+        self.assertEqual(Appointment.objects.filter(scheduled_date=date(2025, 8, 1)).count(), 2)
+
+        # other shifts and days have no quota
+        self.assertEqual(self.book(scheduled_date='2025-08-02').status_code, 201)
+        with self.assertNumQueries(1):
+            response = self.client.get('/slots/?location=ho chi minh&date_from=2025-08-01&available=true')
+        self.assertEqual(response.json()['results'], [])
+        slot = self.client.get('/slots/?location=Ho Chi Minh&date=2025-08-01').json()['results'][0]
+        self.assertEqual((slot['booked'], slot['available']), (2, 0))
+
+    def test_move_and_cancel(self):
+        self.create_slot(1)
+        appointment = Appointment.objects.get(id=self.book().json()['id'])
+        appointment.scheduled_date = date(2025, 8, 3)
+        appointment.save()
+        self.assertEqual(AppointmentSlot.objects.get().booked, 0)
+        self.assertEqual(self.book().status_code, 201)
+        appointment.scheduled_date = date(2025, 8, 1)
+        with self.assertRaises(slots.SlotFull):
+            appointment.save()
+
+    def test_recount_on_changes(self):
+        self.book()
+        slot = self.create_slot(2).json()
+        self.client.force_authenticate(self.admin)
+        response = self.client.patch(f'/slots/{slot["id"]}/', {'date': '2025-08-02'}, format='json')
+        self.assertEqual(response.json()['booked'], 0)
+        response = self.client.patch(f'/slots/{slot["id"]}/', {'date': '2025-08-01'}, format='json')
+        self.assertEqual(response.json()['booked'], 1)
+        self.client.force_authenticate(None)
+
+        # the appointment follows its staff member to the afternoon
+        self.staff.shift = 'afternoon'
+        self.staff.save()
+        self.assertEqual(AppointmentSlot.objects.get().booked, 0)
+        self.assertEqual(self.book(staff=Staff.objects.create(username='morning', phone_number='0900000010',
+                                                              shift='morning').id).status_code, 201)
+        self.staff.shift = 'morning'
+        self.staff.save(update_fields=['shift'])
+        self.assertEqual(AppointmentSlot.objects.get().booked, 2)
+        self.assertEqual(self.book().status_code, 409)
+
+    def test_waitlist(self):
+        self.create_slot(1)
+        booked = self.book().json()
+        response = self.client.post('/appointments/?waitlist=true', {
+            'citizen': self.citizen.id, 'staff': self.staff.id, 'scheduled_date': '2025-08-01',
+            'location': 'Ho Chi Minh', 'notes': 'Queued'}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['position'], 1)
+
+        Appointment.objects.get(id=booked['id']).delete()
+        promoted = Appointment.objects.get(notes='Queued')
+        self.assertEqual(promoted.scheduled_date, date(2025, 8, 1))
+        self.assertFalse(SlotWaitlistEntry.objects.exists())
+        self.assertEqual(AppointmentSlot.objects.get().booked, 1)
+
+    def test_waitlist_promotion_into_full_slot(self):
+        self.create_slot(1)
+        booked = self.book().json()
+        other = Staff.objects.create(username='other', phone_number='0900000011', shift='morning')
+        self.assertEqual(self.client.post('/appointments/?waitlist=true', {
+            'citizen': self.citizen.id, 'staff': other.id, 'scheduled_date': '2025-08-01',
+            'location': 'Ho Chi Minh', 'notes': 'Queued'}, format='json').status_code, 202)
+        # the waitlisted staff member moves to a shift with no place left
+        AppointmentSlot.objects.create(location='ho chi minh', date=date(2025, 8, 1), shift='afternoon', capacity=0)
+        other.shift = 'afternoon'
+        other.save()
+
+        Appointment.objects.get(id=booked['id']).delete()
+        self.assertFalse(Appointment.objects.filter(id=booked['id']).exists())
+        self.assertFalse(Appointment.objects.filter(notes='Queued').exists())
+        self.assertEqual(SlotWaitlistEntry.objects.get().staff, other)
+        self.assertEqual(AppointmentSlot.objects.get(shift='morning').booked, 0)
+
+
+class SlotConcurrencyTests(TransactionTestCase):
+    def test_concurrent_booking(self):
+        citizen = Citizen.objects.create(username='citizen', phone_number='0900000000')
+        staff = Staff.objects.create(username='staff', phone_number='0900000001', shift='afternoon')
+        slot = AppointmentSlot.objects.create(location='da nang', date=date(2025, 9, 1), shift='afternoon',
+                                              capacity=15)
+        results = []
+
+        def book():
+            try:
+                for attempt in range(1000):
+                    try:
+                        with transaction.atomic():
+                            Appointment.objects.create(citizen=citizen, staff=staff, scheduled_date=slot.date,
+                                                       location='Da Nang')
+                        results.append('booked')
+                        return
+                    except slots.SlotFull:
+                        results.append('full')
+                        return
+                    except OperationalError:
+                        time.sleep(random.random() / 100)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        slot.refresh_from_db()
+        self.assertEqual((results.count('booked'), results.count('full')), (15, 25))
+        self.assertEqual(slot.booked, 15)
+        self.assertEqual(Appointment.objects.filter(scheduled_date=slot.date).count(), 15)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        create_sample_data()
+        self.client.force_authenticate(Staff.objects.create(username='admin', phone_number='0900000009',
+                                                            is_staff=True))
+
+    def read_csv(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+    def test_csv(self):
+        response = self.client.get('/appointmentvaccine/export/csv/?status=completed&date_from=2025-03-01')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('attachment; filename="appointmentvaccine-', response['Content-Disposition'])
+        rows = self.read_csv(response)
+        expected = AppointmentVaccine.objects.filter(status='completed', appointment__scheduled_date__gte='2025-03-01')
+        self.assertEqual([int(row['id']) for row in rows], sorted(expected.values_list('id', flat=True)))
+        self.assertEqual(rows[0]['vaccine_name'], expected.order_by('id').first().vaccine.vaccine_name)
+        self.assertEqual(rows[0]['notes'], '')
+
+        self.assertEqual(len(self.read_csv(self.client.get('/appointments/export/csv/?location=chi'))), 6)
+        self.assertEqual(len(self.read_csv(self.client.get('/campaigncitizen/export/csv/'))), 6)
+
+    def test_chunks(self):
+        # one bounded query per chunk, plus the one that finds the end
+        export = exports.EXPORTS['appointments']
+        with self.assertNumQueries(4):
+            chunks = list(export.iter_chunks(export.get_queryset({}), chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 2])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/appointments/export/xlsx/').status_code, 400)
+        self.assertEqual(self.client.get('/appointments/export/csv/?date_from=yesterday').status_code, 400)
+        self.client.force_authenticate(Citizen.objects.get(username='citizen'))
+        self.assertEqual(self.client.get('/appointments/export/csv/').status_code, 403)
+
+    @skipIf(exports.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        import pyarrow.parquet
+
+        response = self.client.get('/appointmentvaccine/export/parquet/?vaccine_id=1')
+        self.assertEqual(response.status_code, 200)
+        table = pyarrow.parquet.read_table(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(table.column('id').to_pylist(), list(AppointmentVaccine.objects.filter(vaccine_id=1)
+                                                              .values_list('id', flat=True)))
+        self.assertEqual(str(table.schema.field('scheduled_date').type), 'date32[day]')
+        self.assertEqual(str(table.schema.field('cost').type), 'double')
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_data', 'campaigncitizen', '--filter', 'date_to=2025-02-01', stdout=out)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]['campaign_name'], 'Campaign')
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.category = VaccineCategory.objects.create(category_name='Viêm gan')
+        self.hepatitis = Vaccine.objects.create(category=self.category, vaccine_name='Engerix-B Viêm gan B',
+                                                dose_quantity=10, instruction='Tiêm bắp', unit_price=10.0)
+        self.flu = Vaccine.objects.create(category=self.category, vaccine_name='Vaxigrip',
+                                          dose_quantity=10, instruction='Phòng cúm, tiêm bắp', unit_price=10.0)
+        self.campaign = Campaign.objects.create(campaign_name='Tiêm chủng mở rộng', start_date=date(2025, 1, 1),
+                                                end_date=date(2025, 3, 1), description='Viêm gan B cho trẻ',
+                                                location='Đà Nẵng')
+        CampaignVaccine.objects.create(campaign=self.campaign, vaccine=self.hepatitis, dose_quantity_used=1)
+        Campaign.objects.create(campaign_name='Other', start_date=date(2025, 1, 1), end_date=date(2025, 3, 1),
+                                description='Other')
+
+    def test_fold(self):
+        self.assertEqual(search.tokenize('Tiêm chủng ĐÀ NẴNG, Engerix-B'),
+                         ['tiem', 'chung', 'da', 'nang', 'engerix', 'b'])
+
+    def test_ranked_and_accent_insensitive(self):
+        hits = search.search('viem gan')
+        # the vaccine and the category carry the words in their names, the campaign in its description
+        self.assertEqual([hit[:2] for hit in hits], [('category', self.category.id), ('vaccine', self.hepatitis.id),
+                                                     ('campaign', self.campaign.id)])
+        self.assertEqual(search.search('da nan', ['campaign'])[0][:2], ('campaign', self.campaign.id))
+        self.assertEqual([hit[1] for hit in search.search('TIÊM BẮP', ['vaccine'])],
+                         sorted([self.hepatitis.id, self.flu.id]))
+        self.assertEqual(search.search('cúm viêm'), [])
+
+    def test_prefix_only_for_last_word(self):
+        self.assertEqual([hit[1] for hit in search.search('engerix vi', ['vaccine'])], [self.hepatitis.id])
+        # a partial word before the last one has to match whole
+        self.assertEqual(search.search('vi gan', ['vaccine']), [])
+        self.assertEqual(search.search('tie bap', ['vaccine']), [])
+        self.assertEqual([hit[1] for hit in search.search('viem gan', ['vaccine'])], [self.hepatitis.id])
+
+    def test_incremental(self):
+        self.flu.vaccine_name = 'Influvac Tetra'
+        self.flu.save()
+        self.assertEqual([hit[1] for hit in search.search('influvac')], [self.flu.id])
+        self.assertEqual(search.search('vaxigrip'), [])
+
+        self.flu.active = False
+        self.flu.save(update_fields=['active'])
+        self.assertEqual(search.search('influvac'), [])
+        self.hepatitis.delete()
+        self.assertFalse(SearchTerm.objects.filter(doc_type='vaccine', object_id=self.hepatitis.id).exists())
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.campaign.save(update_fields=['status'])
+        self.assertFalse([q for q in ctx.captured_queries if 'searchterm' in q['sql']])
+
+        indexed = sorted(SearchTerm.objects.values_list('doc_type', 'object_id', 'term', 'weight'))
+        search.rebuild()
+        self.assertEqual(indexed, sorted(SearchTerm.objects.values_list('doc_type', 'object_id', 'term', 'weight')))
+
+    def test_endpoints(self):
+        response = self.client.get('/search/', {'q': 'viem gan b', 'type': 'vaccine,campaign'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([(r['type'], r['id']) for r in results], [('vaccine', self.hepatitis.id),
+                                                                   ('campaign', self.campaign.id)])
+        self.assertEqual(results[0]['object']['vaccine_name'], 'Engerix-B Viêm gan B')
+        self.assertEqual(self.client.get('/search/', {'q': 'x', 'type': 'doctor'}).status_code, 400)
+
+        campaigns = self.client.get('/campaigns/', {'q': 'mo rong'}).json()['results']
+        self.assertEqual([c['id'] for c in campaigns], [self.campaign.id])
+        campaigns = self.client.get('/campaigns/', {'category_id': self.category.id}).json()['results']
+        self.assertEqual([c['id'] for c in campaigns], [self.campaign.id])
+        vaccines = self.client.get('/vaccines/', {'q': 'tiem'}).json()['results']
+        self.assertEqual(len(vaccines), 2)
+
+
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.citizen = create_sample_data(rows=3)
+        self.doctor = Doctor.objects.get()
+        self.doctor.first_name, self.doctor.last_name = 'An', 'Nguyen'
+        self.doctor.save()
+        self.campaign = Campaign.objects.get()
+        CampaignCitizen.objects.create(campaign=self.campaign, citizen=self.citizen, injection_date=date(2025, 2, 1))
+
+    def events(self):
+        return sorted(VaccinationEvent.objects.values_list(*timeline.HISTORY_FIELDS, 'citizen_id'),
+                      key=lambda event: event[:2])
+
+    def assertRebuilt(self):
+        incremental = self.events()
+        timeline.rebuild()
+        self.assertEqual(incremental, self.events())
+
+    def test_history(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/appointments/history/', {'citizen_id': self.citizen.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        events = response.json()
+        self.assertEqual([(e['source'], e['event_date']) for e in events], [
+            ('appointment_vaccine', '2025-03-01'), ('appointment_vaccine', '2025-02-01'),
+            ('campaign_citizen', '2025-02-01'), ('appointment_vaccine', '2025-01-01')])
+        first = AppointmentVaccine.objects.select_related('appointment', 'vaccine__category').get(
+            vaccine__vaccine_name='Vaccine 0')
+        self.assertEqual(events[-1], {
+            'source': 'appointment_vaccine', 'source_id': first.id, 'event_date': '2025-01-01', 'status': 'scheduled',
+            'vaccine_id': first.vaccine_id, 'vaccine_name': 'Vaccine 0', 'category_id': first.vaccine.category_id,
+            'category_name': first.vaccine.category.category_name, 'doctor_id': self.doctor.id,
+            'doctor_name': 'An Nguyen', 'location': 'Ho Chi Minh', 'appointment_id': first.appointment_id,
+            'campaign_id': None, 'campaign_name': None, 'dose_quantity': 1, 'cost': 10.0, 'notes': None})
+        self.assertEqual(events[2]['campaign_name'], 'Campaign')
+
+        self.assertEqual(self.client.get('/appointments/history/').status_code, 400)
+        self.assertEqual(self.client.get('/appointments/history/', {'citizen_id': 0}).status_code, 404)
+        other = Citizen.objects.create(username='no_history', phone_number='0900000009')
+        self.assertEqual(self.client.get('/appointments/history/', {'citizen_id': other.id}).json(), [])
+
+    def test_sync_on_write(self):
+        item = AppointmentVaccine.objects.select_related('appointment', 'vaccine').first()
+        item.status = 'completed'
+        item.save()
+        item.appointment.scheduled_date, item.appointment.location = date(2025, 5, 1), 'Da Nang'
+        item.appointment.save()
+        item.vaccine.vaccine_name = 'Renamed'
+        item.vaccine.save()
+        self.citizen.appointment_set.exclude(pk=item.appointment_id).first().delete()
+        VaccineCategory.objects.update(category_name='Renamed category')
+        VaccineCategory.objects.get().save()
+        self.doctor.last_name = 'Tran'
+        self.doctor.save(update_fields=['last_name'])
+        self.campaign.campaign_name = 'Renamed campaign'
+        self.campaign.save()
+
+        event = VaccinationEvent.objects.get(source='appointment_vaccine', source_id=item.id)
+        self.assertEqual((event.status, event.event_date, event.location, event.vaccine_name, event.category_name,
+                          event.doctor_name), ('completed', date(2025, 5, 1), 'Da Nang', 'Renamed',
+                                               'Renamed category', 'An Tran'))
+        self.assertEqual(VaccinationEvent.objects.filter(citizen=self.citizen, source='appointment_vaccine').count(), 2)
+        self.assertEqual(set(VaccinationEvent.objects.filter(source='campaign_citizen')
+                             .values_list('campaign_name', flat=True)), {'Renamed campaign'})
+        self.assertRebuilt()
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.campaign.save(update_fields=['status'])
+        self.assertFalse([q for q in ctx.captured_queries if 'vaccinationevent' in q['sql']])
+
+        item.vaccine.delete()
+        event = VaccinationEvent.objects.get(source='appointment_vaccine', source_id=item.id)
+        self.assertEqual((event.vaccine_id, event.vaccine_name, event.category_name), (None, None, None))
+        item.refresh_from_db()
+        item.active = False
+        item.save()
+        self.assertFalse(VaccinationEvent.objects.filter(source='appointment_vaccine', source_id=item.id).exists())
+        self.citizen.campaigncitizen_set.get().delete()
+        self.assertFalse(VaccinationEvent.objects.filter(citizen=self.citizen, source='campaign_citizen').exists())
+        self.assertRebuilt()
+
+    def test_bulk(self):
+        appointment = Appointment.objects.create(citizen=self.citizen, scheduled_date=date(2025, 6, 1),
+                                                 location='Ha Noi')
+        vaccines = list(Vaccine.objects.all())
+        for vaccine in vaccines:
+            inventory.receive(vaccine.id, 10)
+        response = self.client.post('/appointmentvaccine/bulk-create/', [
+            {'appointment': appointment.id, 'vaccine': v.id, 'doctor': self.doctor.id, 'dose_quantity_used': 1}
+            for v in vaccines], format='json')
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()['created']
+        response = self.client.post('/appointmentvaccine/bulk-status/',
+                                    [{'id': ids[0], 'status': 'completed'}], format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(dict(VaccinationEvent.objects.filter(appointment_id=appointment.id)
+                              .values_list('source_id', 'status')),
+                         {pk: 'completed' if pk == ids[0] else 'scheduled' for pk in ids})
+        self.assertRebuilt()
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        create_sample_data()
+        metrics.registry.clear()
+        self.admin = Staff.objects.create(username='admin', phone_number='0900000009', is_staff=True)
+
+    def scrape(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/metrics/')
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_route_metrics(self):
+        self.assertEqual(self.client.get('/appointments/completion-rate/?period=year').status_code, 200)
+        self.client.get('/appointments/completion-rate/?period=month')
+
+        text = self.scrape()
+        labels = '{route="appointment-completion-rate",method="GET"}'
+        self.assertIn(f'http_requests_total{{route="appointment-completion-rate",method="GET",status="200"}} 2', text)
+        self.assertIn(f'http_request_duration_seconds_count{labels} 2', text)
+        self.assertIn(f'http_request_db_queries_bucket{{route="appointment-completion-rate",method="GET",le="+Inf"}} 2',
+                      text)
+        self.assertIn(f'http_request_render_duration_seconds_count{labels} 2', text)
+        self.assertIn(f'http_response_size_bytes_sum{labels} ', text)
+        self.assertIn('catalog_cache_lookups_total{outcome="misses"}', text)
+
+        # the report reads one rollup query
+        metrics.registry.clear()
+        self.client.get('/appointments/completion-rate/?period=year')
+        self.assertIn(f'http_request_db_queries_sum{labels} 1\n', self.scrape())
+
+    def test_protected(self):
+        self.assertIn(self.client.get('/metrics/').status_code, (401, 403))
+        self.client.force_authenticate(Citizen.objects.get(username='citizen'))
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0)
+    def test_slow_request_logged(self):
+        with self.assertLogs('vac_management.metrics', 'WARNING') as logs:
+            self.client.get('/appointmentvaccine/')
+        self.assertIn('(appointmentvaccine-list)', logs.output[0])
+        self.assertIn('vac_management_appointmentvaccine', logs.output[0])
+
+
+class BenchmarkTests(TestCase):
+    def test_generate_data(self):
+        call_command('generate_data', citizens=30, staff=3, doctors=2, vaccines=4, campaigns=2, appointments=40,
+                     appointment_vaccines=100, campaign_citizens=25, batch_size=16, stdout=io.StringIO())
+        self.assertEqual(Citizen.objects.count(), 30)
+        self.assertEqual(Doctor.objects.count(), 2)
+        self.assertEqual(Appointment.objects.count(), 40)
+        self.assertEqual(AppointmentVaccine.objects.count(), 100)
+        self.assertEqual(CampaignCitizen.objects.count(), 25)
+        self.assertEqual(Citizen.objects.filter(username__startswith='citizen_').count(), 30)
+        # the rollups are rebuilt after the bulk inserts
+        self.assertEqual(VaccinationDailyStat.objects.filter(source='appointment_vaccine')
+                         .aggregate(total=Sum('total'))['total'], 100)
+
+        # a second run appends after the existing ids
+        version = catalog_cache.get_version()
+        call_command('generate_data', citizens=5, staff=1, doctors=1, vaccines=1, campaigns=0, appointments=5,
+                     appointment_vaccines=5, campaign_citizens=0, skip_derived=True, stdout=io.StringIO())
+        self.assertEqual(Citizen.objects.count(), 35)
+        self.assertEqual(Appointment.objects.count(), 45)
+        # and the catalog cache does not serve pages from before the bulk inserts
+        self.assertNotEqual(catalog_cache.get_version(), version)
+
+    def test_run_and_compare(self):
+        create_sample_data()
+        baseline = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'baseline.json'
+        out = io.StringIO()
+        call_command('run_benchmarks', repeat=2, output=str(baseline), stdout=out, stderr=io.StringIO())
+        report = json.loads(baseline.read_text())
+        results = report['results']
+        for name in ('appointment-list', 'appointment-detail', 'appointment-completion-rate',
+                     'appointmentvaccine-list', 'campaigncitizen-stats-by-time', 'vaccineusage-vaccine-types-by-time',
+                     'appointment-get-by-citizen', 'search-list', 'airflow-extraction'):
+            self.assertIn(name, results)
+        self.assertFalse([name for name, result in results.items() if result['status'] not in (200, None)])
+        self.assertEqual(results['appointment-completion-rate']['queries'], 1)
+        self.assertEqual(report['rows']['AppointmentVaccine'], 6)
+
+        call_command('run_benchmarks', repeat=2, compare=str(baseline), tolerance=100, stdout=io.StringIO(),
+                     stderr=io.StringIO())
+        results['appointment-completion-rate']['queries'] = 0
+        baseline.write_text(json.dumps(report))
+        with self.assertRaisesMessage(CommandError, '1 regressions'):
+            call_command('run_benchmarks', repeat=2, compare=str(baseline), tolerance=100, stdout=io.StringIO(),
+                         stderr=io.StringIO())
+
+
+class FailingBackend:
+    calls = 0
+
+    def upload(self, path, asset):
+        FailingBackend.calls += 1
+        raise ConnectionError('cloudinary is down')
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(UPLOAD_BACKEND='vac_management.uploads.LocalBackend', UPLOAD_WORKERS=0,
+                                            MEDIA_ROOT=self.media, UPLOAD_SPOOL_DIR=f'{self.media}/spool'))
+        self.category = VaccineCategory.objects.create(category_name='Covid-19')
+
+    def create_vaccine(self, name='pfizer.png'):
+        return self.client.post('/vaccines/', {
+            'category_id': self.category.id, 'vaccine_name': 'Pfizer', 'dose_quantity': 10, 'instruction': 'Tiêm',
+            'unit_price': 10.0, 'image': SimpleUploadedFile(name, b'image bytes', content_type='image/png'),
+        }, format='multipart')
+
+    def test_create_returns_before_the_upload(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.create_vaccine()
+        self.assertEqual(response.status_code, 201)
+        pending = response.data['pending_uploads']['image']
+        self.assertEqual(pending['status'], 'pending')
+        self.assertIsNone(response.data['image'])
+        self.assertEqual(self.client.get(f'/uploads/{pending["token"]}/').data['status'], 'pending')
+
+        for callback in callbacks:
+            callback()
+        asset = PendingAsset.objects.get(token=pending['token'])
+        self.assertEqual((asset.status, asset.attempts), ('done', 1))
+        self.assertTrue(Vaccine.objects.filter(pk=response.data['id'], image=asset.public_id).exists())
+        self.assertEqual(Path(self.media, asset.public_id).read_bytes(), b'image bytes')
+        self.assertFalse(Path(asset.spool_path).exists())
+        self.assertEqual(self.client.get(f'/uploads/{pending["token"]}/').data['public_id'], asset.public_id)
+
+    def test_user_avatar(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/', {
+                'username': 'citizen', 'password': 'secret', 'phone_number': '0900000000',
+                'avatar': SimpleUploadedFile('me.jpg', b'avatar', content_type='image/jpeg'),
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('avatar', response.data['pending_uploads'])
+        self.assertEqual(BaseUser.objects.get(username='citizen').avatar.format, 'jpg')
+
+    @mock.patch.object(uploads, 'UPLOAD_RETRY_DELAY', 0)
+    def test_failed_upload_is_retried(self):
+        FailingBackend.calls = 0
+        with override_settings(UPLOAD_BACKEND='vac_management.tests.FailingBackend'):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.create_vaccine()
+        asset = PendingAsset.objects.get()
+        self.assertEqual((asset.status, asset.attempts, FailingBackend.calls), ('failed', 3, 3))
+        self.assertIn('cloudinary is down', asset.error)
+        self.assertTrue(Path(asset.spool_path).exists())
+        self.assertIsNone(Vaccine.objects.get(pk=response.data['id']).image)
+
+        out = io.StringIO()
+        call_command('process_uploads', older_than=0, retry_failed=True, stdout=out)
+        self.assertIn('Processed 1 uploads (0 failed)', out.getvalue())
+        asset.refresh_from_db()
+        self.assertEqual(asset.status, 'done')
+        self.assertTrue(Vaccine.objects.filter(pk=response.data['id'], image=asset.public_id).exists())
+
+    def test_superseded_upload(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            vaccine_id = self.create_vaccine('first.png').data['id']
+            self.client.patch(f'/vaccines/{vaccine_id}/', {
+                'image': SimpleUploadedFile('second.png', b'second', content_type='image/png'),
+            }, format='multipart')
+        first, second = PendingAsset.objects.order_by('id')
+        # the second upload finishes first, the late first one must not overwrite it
+        uploads.process(second.id)
+        uploads.process(first.id)
+        second.refresh_from_db()
+        self.assertTrue(Vaccine.objects.filter(pk=vaccine_id, image=second.public_id).exists())
+        self.assertEqual(PendingAsset.objects.get(pk=first.id).status, 'done')
+        # a claimed upload is not processed twice
+        self.assertIsNone(uploads.process(first.id))
+
+    def test_apply_in_one_transaction(self):
+        # the check, the save and the asset marked done commit together, under the lock of the row:
+        # an older upload finishing at the same time waits for it and then sees the newer one done
+        with self.captureOnCommitCallbacks():
+            vaccine_id = self.create_vaccine('first.png').data['id']
+        asset = PendingAsset.objects.get()
+        with CaptureQueriesContext(connection) as ctx:
+            uploads.process(asset.id)
+        sql = [query['sql'] for query in ctx.captured_queries]
+        begin = next(i for i, query in enumerate(sql) if query.startswith('SAVEPOINT'))
+        savepoint = sql[begin].split()[1]
+        check = next(i for i, query in enumerate(sql) if 'vac_management_pendingasset' in query and '"id" >' in query)
+        save = next(i for i, query in enumerate(sql) if query.startswith('UPDATE "vac_management_vaccine"'))
+        done = next(i for i, query in enumerate(sql)
+                    if query.startswith('UPDATE "vac_management_pendingasset"') and "'done'" in query)
+        self.assertLess(begin, check)
+        self.assertLess(check, save)
+        self.assertLess(save, done)
+        self.assertLess(done, sql.index(f'RELEASE SAVEPOINT {savepoint}'))
+        self.assertTrue(Vaccine.objects.filter(pk=vaccine_id, image=PendingAsset.objects.get().public_id).exists())
+
+
+@override_settings(UPLOAD_BACKEND='vac_management.uploads.LocalBackend', UPLOAD_WORKERS=2)
+class UploadPoolTests(TransactionTestCase):
+    def test_workers(self):
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media, UPLOAD_SPOOL_DIR=f'{media}/spool'))
+        category = VaccineCategory.objects.create(category_name='Covid-19')
+        campaigns = [Campaign.objects.create(campaign_name=f'Campaign {i}', start_date=date(2025, 1, 1),
+                                             end_date=date(2025, 2, 1), description='Campaign') for i in range(4)]
+        vaccine = Vaccine.objects.create(category=category, vaccine_name='Pfizer', dose_quantity=10,
+                                         instruction='Tiêm', unit_price=10.0)
+        with transaction.atomic():
+            for obj in [vaccine, *campaigns]:
+                uploads.queue(obj, 'image', SimpleUploadedFile('image.png', b'image', content_type='image/png'))
+            # nothing runs before the commit
+            self.assertFalse(uploads.pool.futures)
+        done, not_done = uploads.pool.wait(timeout=30)
+        self.assertFalse(not_done)
+        self.assertEqual(PendingAsset.objects.filter(status='done').count(), 5)
+        vaccine.refresh_from_db()
+        self.assertTrue(str(vaccine.image).startswith('uploads/'))
+        self.assertFalse(Campaign.objects.filter(image__isnull=True).exists())
+
+
+def png_bytes(size=(800, 400), mode='RGBA'):
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else 'red').save(out, 'PNG')
+    return out.getvalue()
+
+
+@skipIf(thumbnails.Image is None, 'Pillow is not installed')
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(UPLOAD_BACKEND='vac_management.uploads.LocalBackend', UPLOAD_WORKERS=0,
+                                            MEDIA_ROOT=self.media, UPLOAD_SPOOL_DIR=f'{self.media}/spool'))
+        self.category = VaccineCategory.objects.create(category_name='Cúm')
+
+    def create_vaccine(self, content, name='pfizer.png'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/vaccines/', {
+                'category_id': self.category.id, 'vaccine_name': 'Pfizer', 'dose_quantity': 10,
+                'instruction': 'Tiêm', 'unit_price': 10.0, 'image': SimpleUploadedFile(name, content),
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def test_variants(self):
+        from PIL import Image
+
+        content = png_bytes()
+        vaccine_id = self.create_vaccine(content)
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertTrue(Vaccine.objects.filter(pk=vaccine_id, image=f'uploads/{digest}.png').exists())
+
+        variants = self.client.get(f'/vaccines/{vaccine_id}/').data['image_variants']
+        self.assertEqual(variants, {
+            'thumbnail': f'http://testserver/media/variants/{digest[:2]}/{digest}/thumbnail.jpg',
+            'medium': f'http://testserver/media/variants/{digest[:2]}/{digest}/medium.jpg',
+        })
+        directory = Path(self.media, 'variants', digest[:2], digest)
+        with Image.open(directory / 'thumbnail.jpg') as thumbnail, Image.open(directory / 'medium.jpg') as medium:
+            self.assertEqual((thumbnail.size, medium.size), ((160, 160), (640, 320)))
+            self.assertEqual(thumbnail.format, 'JPEG')
+        self.assertLess((directory / 'thumbnail.jpg').stat().st_size, len(content))
+
+        # read from the row, not from the disk
+        with mock.patch.object(Path, 'exists') as exists:
+            self.assertEqual(self.client.get('/vaccines/').data['results'][0]['image_variants'], variants)
+        exists.assert_not_called()
+
+        # the same picture again reuses the variants
+        with mock.patch.object(thumbnails.Image, 'open', wraps=thumbnails.Image.open) as image_open:
+            other_id = self.create_vaccine(content, 'copy.png')
+        image_open.assert_not_called()
+        self.assertEqual(self.client.get(f'/vaccines/{other_id}/').data['image_variants'], variants)
+
+    def test_not_an_image(self):
+        vaccine_id = self.create_vaccine(b'%PDF-1.4', 'leaflet.pdf')
+        self.assertEqual(PendingAsset.objects.get().status, 'done')
+        self.assertIsNone(self.client.get(f'/vaccines/{vaccine_id}/').data['image_variants'])
+
+    def test_spool_not_served(self):
+        with override_settings():
+            del settings.UPLOAD_SPOOL_DIR
+            self.assertFalse(uploads.spool_dir().is_relative_to(settings.MEDIA_ROOT))
+
+    def test_fast_read(self):
+        create_sample_data()
+        vaccine_id = self.create_vaccine(png_bytes())
+        appointment = Appointment.objects.first()
+        AppointmentVaccine.objects.create(appointment=appointment, vaccine_id=vaccine_id, doctor=Doctor.objects.get(),
+                                          dose_quantity_used=1, cost=10.0)
+        expected = self.client.get('/appointmentvaccine/?page_size=50')
+        self.assertIn('/media/variants/', expected.content.decode())
+        self.assertEqual(self.client.get('/appointmentvaccine/?page_size=50&fast=true').content, expected.content)
+
+    def test_backfill(self):
+        vaccine = Vaccine.objects.create(category=self.category, vaccine_name='Legacy', dose_quantity=10,
+                                         instruction='Tiêm', unit_price=10.0, image='image/upload/v1/legacy.png')
+        content = png_bytes(mode='RGB')
+        out = io.StringIO()
+        with mock.patch('vac_management.management.commands.generate_image_variants.Command.download',
+                        return_value=content), self.captureOnCommitCallbacks(execute=True):
+            call_command('generate_image_variants', stdout=out, stderr=io.StringIO())
+        self.assertIn('re-ingested 1, 0 failed', out.getvalue())
+        digest = hashlib.sha256(content).hexdigest()
+        vaccine.refresh_from_db()
+        self.assertEqual(thumbnails.source_digest(vaccine.image), digest)
+        self.assertEqual(set(vaccine.image_variants), {'thumbnail', 'medium'})
+
+        # stored under its digest already, only the variants are made
+        campaign = Campaign.objects.create(campaign_name='Legacy', start_date='2025-01-01', end_date='2025-01-31',
+                                           description='Legacy', image=f'image/upload/v1/uploads/{digest}.png')
+        with mock.patch('vac_management.management.commands.generate_image_variants.Command.download',
+                        return_value=content), mock.patch.object(uploads, 'queue') as queue:
+            call_command('generate_image_variants', stdout=out, stderr=io.StringIO())
+        queue.assert_not_called()
+        self.assertIn('Generated variants of 1 images, re-ingested 0, 0 failed', out.getvalue())
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.image_variants, vaccine.image_variants)
+
+        # nothing left to do
+        call_command('generate_image_variants', stdout=out, stderr=io.StringIO())
+        self.assertIn('Generated variants of 0 images, re-ingested 0, 0 failed', out.getvalue())
+
+
+
+class PaymentSheetTests(TestCase):
+    def setUp(self):
+        server = start_fake_stripe(delay=0.1)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.enterContext(override_settings(STRIPE_API_BASE=f'http://127.0.0.1:{server.server_port}',
+                                            STRIPE_SECRET_KEY='sk_test_fake', STRIPE_API_VERSION='2024-06-20'))
+        payments.gateway.reset()
+        self.addCleanup(payments.gateway.reset)
+        self.citizen = create_sample_data()
+        self.ids = list(AppointmentVaccine.objects.order_by('id').values_list('id', flat=True))
+        self.authorize(self.client, self.citizen)
+
+    def authorize(self, client, user):
+        # the app sends the OAuth2 access token it logged in with
+        token = AccessToken.objects.create(user=user, token=f'token-{user.pk}', scope='read write',
+                                           expires=timezone.now() + timedelta(hours=1))
+        client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {token.token}'
+
+    def pay(self, **data):
+        return self.client.post('/payment-sheet/', data, content_type='application/json')
+
+    def test_customer_reused(self):
+        first = self.pay(vaccine_id=self.ids[0]).json()
+        second = self.pay(vaccine_id=self.ids[1]).json()
+        self.assertEqual(first['customer'], 'customer_1')
+        self.assertEqual(second['customer'], 'customer_1')
+        self.assertEqual(len(FakeStripeHandler.objects['customer']), 1)
+        self.assertEqual(Citizen.objects.get(pk=self.citizen.pk).stripe_customer_id, 'customer_1')
+        self.assertEqual(FakeStripeHandler.objects['ephemeral_key'][1]['params'], {'customer': 'customer_1'})
+        self.assertNotEqual(first['paymentIntent'], second['paymentIntent'])
+        self.assertEqual((first['amount'], first['currency']), (1000, 'usd'))
+
+    def test_retry_is_idempotent(self):
+        first = self.pay(vaccine_id=self.ids[0]).json()
+        retry = self.pay(vaccine_id=self.ids[0]).json()
+        self.assertEqual(retry['paymentIntent'], first['paymentIntent'])
+        self.assertEqual(len(FakeStripeHandler.objects['payment_intent']), 1)
+        self.assertEqual(Payment.objects.get().intent_id, 'payment_intent_1')
+
+        # a changed price is a new payment
+        AppointmentVaccine.objects.filter(pk=self.ids[0]).update(cost=12.5)
+        self.assertNotEqual(self.pay(vaccine_id=self.ids[0]).json()['paymentIntent'], first['paymentIntent'])
+
+    def test_several_appointment_vaccines(self):
+        AppointmentVaccine.objects.filter(pk=self.ids[0]).update(cost=19.99)
+        AppointmentVaccine.objects.filter(pk=self.ids[1]).update(cost=0.1)
+        response = self.pay(appointment_vaccine_ids=[self.ids[1], self.ids[0]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['amount'], 2009)
+        intent = FakeStripeHandler.objects['payment_intent'][0]['params']
+        self.assertEqual(intent['metadata[appointment_vaccine_ids]'], f'{self.ids[0]},{self.ids[1]}')
+        self.assertEqual(intent['amount'], '2009')
+        payment = Payment.objects.get()
+        self.assertEqual(sorted(payment.appointment_vaccines.values_list('id', flat=True)), self.ids[:2])
+        self.assertEqual((payment.amount, payment.citizen_id), (2009, self.citizen.pk))
+
+    def test_calls_run_concurrently(self):
+        self.pay(vaccine_id=self.ids[0])
+        self.assertEqual(FakeStripeHandler.max_in_flight, 2)
+
+    async def test_asgi(self):
+        # the ASGI handler runs the view and the middleware in the event loop, no thread hop
+        metrics.registry.clear()
+        headers = {'Authorization': self.client.defaults['HTTP_AUTHORIZATION']}
+        responses = await asyncio.gather(*(
+            self.async_client.post('/payment-sheet/', {'vaccine_id': pk}, content_type='application/json',
+                                   headers=headers)
+            for pk in self.ids[:3]))
+        self.assertEqual([response.status_code for response in responses], [200, 200, 200])
+        self.assertEqual({response.json()['customer'] for response in responses}, {'customer_1'})
+        self.assertEqual(len(FakeStripeHandler.objects['customer']), 1)
+        self.assertIn('http_requests_total{route="payment-sheet",method="POST",status="200"} 3',
+                      metrics.registry.render())
+
+    def test_errors(self):
+        self.assertEqual(self.pay(vaccine_id=0).status_code, 404)
+        self.assertEqual(self.pay(vaccine_id='x').status_code, 400)
+        self.assertEqual(self.client.get('/payment-sheet/').status_code, 400)
+        other = CampaignCitizen.objects.first().citizen
+        AppointmentVaccine.objects.filter(pk=self.ids[1]).update(
+            appointment=Appointment.objects.create(citizen=other, staff=Staff.objects.get(),
+                                                   scheduled_date=date(2025, 5, 1), location='Ha Noi'))
+        response = self.pay(appointment_vaccine_ids=self.ids[:2])
+        self.assertEqual(response.status_code, 404)
+        self.assertIn(str(self.ids[1]), response.json()['error'])
+        with override_settings(STRIPE_CURRENCY='xxx'):
+            response = self.pay(vaccine_id=self.ids[0])
+        self.assertEqual(response.status_code, 502)
+        self.assertIn('Invalid currency', response.json()['error'])
+        self.assertFalse(Payment.objects.exists())
+
+    def test_only_own_appointment_vaccines(self):
+        self.client.defaults.pop('HTTP_AUTHORIZATION')
+        self.assertEqual(self.pay(vaccine_id=self.ids[0]).status_code, 401)
+        self.assertEqual(self.client.post('/payment-sheet/', {'vaccine_id': self.ids[0]}, content_type='application/json',
+                                          HTTP_AUTHORIZATION='Bearer unknown').status_code, 401)
+
+        # the view is csrf exempt, a browser session does not authenticate it
+        self.client.force_login(self.citizen)
+        self.assertEqual(self.pay(vaccine_id=self.ids[0]).status_code, 401)
+        self.client.logout()
+
+        other = CampaignCitizen.objects.first().citizen
+        self.authorize(self.client, other)
+        response = self.pay(vaccine_id=self.ids[0])
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('customer', FakeStripeHandler.objects)
+        self.assertIsNone(Citizen.objects.get(pk=self.citizen.pk).stripe_customer_id)
+
+    def test_staff_pays_for_citizen(self):
+        for user in (Staff.objects.get(), Doctor.objects.get()):
+            self.authorize(self.client, user)
+            response = self.pay(vaccine_id=self.ids[0])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['customer'], 'customer_1')
+        self.assertEqual(Payment.objects.get().citizen_id, self.citizen.pk)
+
+        # one intent is paid by one customer
+        other = CampaignCitizen.objects.first().citizen
+        AppointmentVaccine.objects.filter(pk=self.ids[1]).update(
+            appointment=Appointment.objects.create(citizen=other, staff=Staff.objects.get(),
+                                                   scheduled_date=date(2025, 5, 1), location='Ha Noi'))
+        response = self.pay(appointment_vaccine_ids=self.ids[:2])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'The appointment vaccines belong to different citizens.')
+
+
+class ExplainPlanTests(TestCase):
+    def setUp(self):
+        create_sample_data()
+
+    def test_hot_filters_use_indexes(self):
+        citizen = Citizen.objects.order_by('id').first()
+        vaccine = Vaccine.objects.first()
+        querysets = {
+            'appointments?citizen_id': get_viewset_queryset(views.AppointmentViewSet, citizen_id=citizen.id),
+            'appointments?date': get_viewset_queryset(views.AppointmentViewSet, date='2025-01-01'),
+            'appointmentvaccine?status': get_viewset_queryset(views.AppointmentVaccineViewSet, status='completed'),
+            'appointmentvaccine?vaccine_id&status': get_viewset_queryset(
+                views.AppointmentVaccineViewSet, vaccine_id=vaccine.id, status='completed'),
+            'campaigncitizen injection_date': CampaignCitizen.objects.filter(injection_date__gte=date(2025, 1, 1)),
+            'extraction scheduled_date': Appointment.objects.filter(
+                scheduled_date__gte=date(2025, 1, 1), scheduled_date__lt=date(2025, 1, 2), active=True),
+        }
+        for name, queryset in querysets.items():
+            with self.subTest(query=name):
+                self.assertEqual(full_table_scans(queryset), [], queryset.explain())
+
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'airflow' / 'dags'))
+
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    # fails the first attempts for addresses starting with 429/500, always rejects 400
+    attempts = {}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        to_mail = body['personalizations'][0]['to'][0]['email']
+        attempt = self.attempts[to_mail] = self.attempts.get(to_mail, 0) + 1
+
+        code = 202
+        if to_mail.startswith('429') and attempt == 1:
+            code = 429
+        elif to_mail.startswith('500') and attempt < 3:
+            code = 500
+        elif to_mail.startswith('400'):
+            code = 400
+        self.send_response(code)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class EmailDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        FakeSendGridHandler.attempts = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSendGridHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_retries_and_results(self):
+        from sendgrid import SendGridAPIClient
+        from utils import email_templates
+        from utils.email_dispatcher import EmailDispatcher
+
+        client = SendGridAPIClient('key', host=f'http://127.0.0.1:{self.server.server_port}')
+        dispatcher = EmailDispatcher(client, workers=4, rate_per_second=100, max_retries=3, backoff=0.01)
+        app = {'patient_name': 'A', 'phone': '1', 'scheduled_date': '2025-01-01', 'location': 'HN', 'notes': ''}
+        emails = ['ok@example.com', '429@example.com', '500@example.com', '400@example.com']
+        template = email_templates.get_template('appointment_reminder', 'en')
+
+        results = dict(dispatcher.dispatch((to_mail, email_templates.build_message(template, app, to_mail))
+                                           for to_mail in emails))
+
+        self.assertEqual({to_mail: result['status'] for to_mail, result in results.items()}, {
+            'ok@example.com': 'sent', '429@example.com': 'sent', '500@example.com': 'sent',
+            '400@example.com': 'failed'})
+        self.assertEqual(results['500@example.com']['attempts'], 3)
+        self.assertEqual(results['400@example.com']['attempts'], 1)
+
+
+class EmailTemplateTests(SimpleTestCase):
+    def setUp(self):
+        from utils import email_templates
+
+        self.templates = email_templates
+        self.template = email_templates.get_template('appointment_reminder', 'en')
+        self.app = {'email': 'a@example.com', 'patient_name': '<b>Eve</b>', 'phone': '1',
+                    'scheduled_date': '2025-01-02', 'location': 'Ha Noi & Da Nang',
+                    'notes': '<script>alert(1)</script>'}
+
+    def test_user_values_are_escaped(self):
+        html = self.templates.build_message(self.template, self.app, 'a@example.com').get()['content'][0]['value']
+        self.assertNotIn('<script>', html)
+        self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', html)
+        self.assertIn('<b>&lt;b&gt;Eve&lt;/b&gt;</b>', html)
+        self.assertIn('Ha Noi &amp; Da Nang', html)
+
+        substitutions = self.template.substitutions(self.app)
+        self.assertEqual(substitutions['-notes-'], '&lt;script&gt;alert(1)&lt;/script&gt;')
+        self.assertEqual(self.template.substitutions({})['-notes-'], '')
+
+    def test_batch(self):
+        apps = [{**self.app, 'email': f'p{i}@example.com', 'patient_name': f'<i>{i}</i>'} for i in range(3)]
+        message = self.templates.build_batch(self.template, apps).get()
+        personalizations = message['personalizations']
+        self.assertEqual(len(personalizations), 3)
+        by_recipient = {p['to'][0]['email']: p['substitutions'] for p in personalizations}
+        self.assertEqual(set(by_recipient), {app['email'] for app in apps})
+        for i in range(3):
+            substitutions = by_recipient[f'p{i}@example.com']
+            self.assertEqual(len(substitutions), len(self.template.fields))
+            self.assertEqual(substitutions['-patient_name-'], f'&lt;i&gt;{i}&lt;/i&gt;')
+        # the body is sent once, with tags in place of the values
+        self.assertIn('<b>-patient_name-</b>', message['content'][0]['value'])
+        self.assertNotIn('<script>', json.dumps(message))
+
+    def test_batches_split_at_the_cap(self):
+        cap = self.templates.MAX_PERSONALIZATIONS
+        apps = [{**self.app, 'email': f'p{i}@example.com'} for i in range(2 * cap + 1)]
+        self.assertEqual([len(batch) for batch in self.templates.iter_batches(apps, 5000)], [cap, cap, 1])
+        self.assertEqual([len(batch) for batch in self.templates.iter_batches(apps[:5], 2)], [2, 2, 1])
+        self.assertEqual(len(self.templates.build_batch(self.template, apps[:cap]).get()['personalizations']), cap)
+        with self.assertRaises(ValueError):
+            self.templates.build_batch(self.template, apps[:cap + 1])
+
+
+class FakeMySQLConnection:
+    # sqlite standing in for the MySQL connection of the DAG: the ledger's dialect is translated and NOW()
+    # follows a clock the test moves
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        self.db.execute('CREATE TABLE vac_management_reminderdelivery (id INTEGER PRIMARY KEY, appointment_id INTEGER, '
+                        'scheduled_date TEXT, template TEXT, status TEXT, claim_token TEXT, claimed_at TEXT, '
+                        'sent_at TEXT, attempts INTEGER, error TEXT, UNIQUE (appointment_id, scheduled_date, template))')
+        self.now = datetime(2025, 1, 1, 8, 0)
+        self.autocommit = False
+        self.closed = False
+
+    def translate(self, sql):
+        sql = sql.replace('INSERT IGNORE', 'INSERT OR IGNORE').replace('NOW()', f"'{self.now:%Y-%m-%d %H:%M:%S}'")
+        sql = re.sub(r"('[^']*') - INTERVAL %s SECOND", r"datetime(\1, '-' || %s || ' seconds')", sql)
+        return sql.replace('%s', '?')
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def execute(self, sql, params=()):
+                self.result = connection.db.execute(connection.translate(sql), params)
+
+            def executemany(self, sql, rows):
+                connection.db.executemany(connection.translate(sql), rows)
+
+            def fetchall(self):
+                return self.result.fetchall()
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+    def rows(self):
+        return {row[0]: row[1:] for row in self.db.execute(
+            'SELECT appointment_id, status, claim_token, attempts FROM vac_management_reminderdelivery')}
+
+
+class DeliveryLedgerTests(SimpleTestCase):
+    def setUp(self):
+        from utils.delivery_ledger import DeliveryLedger
+
+        self.connection = FakeMySQLConnection()
+        self.ledger = lambda token: DeliveryLedger(self.connection, '2025-01-02', 'appointment_reminder', token)
+
+    def test_claim_and_record(self):
+        ledger = self.ledger('run-1/0')
+        self.assertEqual(ledger.claim([1, 2, 3]), {1, 2, 3})
+        self.assertTrue(self.connection.autocommit)
+        ledger.record([(1, {'status': 'sent'}), (2, {'status': 'failed', 'error': 'HTTP 500'})])
+        self.assertEqual(self.connection.rows(), {1: ('sent', 'run-1/0', 1), 2: ('failed', 'run-1/0', 1),
+                                                  3: ('pending', 'run-1/0', 0)})
+        self.assertEqual(ledger.claim([]), set())
+
+    def test_reclaim_after_lease(self):
+        from utils.delivery_ledger import LEASE_SECONDS
+
+        self.ledger('run-1/0').claim([1, 2])
+        # a worker that died holds its rows until the lease runs out
+        self.assertEqual(self.ledger('run-2/0').claim([1, 2]), set())
+        self.connection.now += timedelta(seconds=LEASE_SECONDS + 1)
+        self.assertEqual(self.ledger('run-2/0').claim([1, 2]), {1, 2})
+        self.assertEqual(self.ledger('run-1/0').claim([1, 2]), set())
+
+    def test_max_attempts(self):
+        from utils.delivery_ledger import MAX_ATTEMPTS
+
+        for attempt in range(MAX_ATTEMPTS):
+            ledger = self.ledger(f'run-{attempt}/0')
+            self.assertEqual(ledger.claim([1]), {1}, attempt)
+            ledger.record([(1, {'status': 'failed', 'error': 'HTTP 500'})])
+        self.assertEqual(self.ledger('run-last/0').claim([1]), set())
+        self.assertEqual(self.connection.rows()[1], ('failed', f'run-{MAX_ATTEMPTS - 1}/0', MAX_ATTEMPTS))
+
+        # the task's own retries stop there too
+        ledger = self.ledger('run-1/0')
+        for attempt in range(MAX_ATTEMPTS):
+            self.assertEqual(ledger.claim([2]), {2}, attempt)
+            ledger.record([(2, {'status': 'failed', 'error': 'HTTP 500'})])
+        self.assertEqual(ledger.claim([2]), set())
+
+    def test_retry_with_same_token(self):
+        ledger = self.ledger('run-1/0')
+        ledger.claim([1, 2, 3])
+        ledger.record([(1, {'status': 'sent'})])
+        # the task retried: the same token takes back its pending rows at once, sent ones stay sent
+        retry = self.ledger('run-1/0')
+        self.assertEqual(retry.claim([1, 2, 3]), {2, 3})
+        retry.record([(2, {'status': 'sent'}), (3, {'status': 'sent'})])
+        self.assertEqual(retry.claim([1, 2, 3]), set())
+        self.assertEqual({status for status, _, _ in self.connection.rows().values()}, {'sent'})
+        self.assertEqual(self.connection.db.execute('SELECT COUNT(*) FROM vac_management_reminderdelivery').fetchone(),
+                         (3,))
+
+    def test_shards_do_not_overlap(self):
+        from utils.appointment_stream import shard_of
+
+        header = {'min_id': 1, 'max_id': 100}
+        ids = range(1, 101)
+        claims = [self.ledger(f'run-1/{shard}').claim(i for i in ids if shard_of(i, header, 4) == shard)
+                  for shard in range(4)]
+        self.assertEqual(sum(len(claim) for claim in claims), 100)
+        self.assertEqual(set().union(*claims), set(ids))
+        # a shard reading past its range does not take rows another shard holds
+        self.assertEqual(self.ledger('run-1/0').claim(ids), claims[0])
+
+
+class FakeDispatcher:
+    # fails the first send of the given appointments
+    def __init__(self, failing):
+        self.failing = set(failing)
+        self.sent = []
+
+    def dispatch(self, jobs):
+        for batch, message in jobs:
+            ids = [app['id'] for app in batch]
+            if self.failing & set(ids):
+                self.failing -= set(ids)
+                yield batch, {'status': 'failed', 'error': 'HTTP 500', 'attempts': 1}
+            else:
+                self.sent.extend(ids)
+                yield batch, {'status': 'sent', 'attempts': 1}
+
+
+class SendEmailsTests(SimpleTestCase):
+    def test_failed_send_is_retried(self):
+        from utils import appointment_email_sender, appointment_stream
+
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        path = f'{directory}/appointments.ndjson'
+        header = {'sum_number_of_appointments': 4, 'scheduled_date': '2025-01-02', 'generated_at': 'run-1',
+                  'min_id': 1, 'max_id': 4}
+        appointment_stream.write_appointments(path, header, [
+            {'id': i, 'email': f'p{i}@example.com', 'patient_name': f'P{i}', 'phone': '1',
+             'scheduled_date': '2025-01-02', 'location': 'Ha Noi', 'notes': ''} for i in range(1, 5)])
+        offsets = [offset for offset, _ in appointment_stream.iter_appointments(path)]
+        connection = FakeMySQLConnection()
+        dispatcher = FakeDispatcher(failing=[2])
+        self.enterContext(mock.patch.multiple(appointment_email_sender, APPOINTMENTS_FILE=path,
+                                              STATUS_FILE=f'{path}.status', EMAIL_BATCH_SIZE=1, CHECKPOINT_EVERY=2,
+                                              get_mysql_connection=lambda: connection,
+                                              get_dispatcher=lambda: dispatcher))
+
+        # the run fails, so Airflow retries it, and the checkpoint stops before the failed reminder
+        with self.assertLogs(appointment_email_sender.logger, 'ERROR'), \
+                self.assertRaisesMessage(RuntimeError, '1 reminders failed'):
+            appointment_email_sender.send_emails()
+        self.assertEqual(dispatcher.sent, [1, 3, 4])
+        self.assertEqual(appointment_stream.load_checkpoint(path, header), offsets[0])
+        self.assertEqual(connection.rows()[2], ('failed', 'run-1/0', 1))
+
+        # the retry resumes there, sends the failed one and skips the delivered ones
+        appointment_email_sender.send_emails()
+        self.assertEqual(dispatcher.sent, [1, 3, 4, 2])
+        self.assertEqual(appointment_stream.load_checkpoint(path, header), offsets[-1])
+        self.assertEqual({status for status, _, _ in connection.rows().values()}, {'sent'})
+
+    def test_errors_fail_the_task(self):
+        from utils import appointment_email_sender
+
+        connection = FakeMySQLConnection()
+        header = {'sum_number_of_appointments': 1, 'scheduled_date': '2025-01-02', 'generated_at': 'run-1'}
+        with mock.patch.object(appointment_email_sender, 'read_header', return_value=header), \
+                mock.patch.object(appointment_email_sender, 'load_checkpoint', return_value=0), \
+                mock.patch.object(appointment_email_sender, 'get_mysql_connection', return_value=connection), \
+                mock.patch.object(appointment_email_sender, 'get_dispatcher',
+                                  side_effect=ValueError('SendGrid API key is missing or empty')), \
+                self.assertLogs(appointment_email_sender.logger, 'ERROR'):
+            with self.assertRaisesMessage(ValueError, 'SendGrid API key'):
+                appointment_email_sender.send_emails()
+        self.assertTrue(connection.closed)
+
+    def test_extraction_errors_fail_the_task(self):
+        from utils import valid_appointment_extraction
+
+        with mock.patch.object(valid_appointment_extraction, 'get_mysql_connection',
+                               side_effect=OSError('Can\'t connect to MySQL server')), \
+                self.assertLogs(valid_appointment_extraction.logger, 'ERROR'):
+            with self.assertRaisesMessage(OSError, 'connect to MySQL'):
+                valid_appointment_extraction.save_appointments_to_json()
+
+
+class DjangoMySQLConnection:
+    # the test database behind the mysql.connector calls the extraction makes
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self, dictionary=False, buffered=True):
+        cursor = connection.cursor()
+
+        class Cursor:
+            def execute(self, sql, params=()):
+                cursor.execute(sql, params)
+
+            def rows(self, rows):
+                if not dictionary:
+                    return rows
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in rows]
+
+            def fetchone(self):
+                return self.rows([cursor.fetchone()])[0]
+
+            def fetchmany(self, size):
+                return self.rows(cursor.fetchmany(size))
+
+            def fetchall(self):
+                return self.rows(cursor.fetchall())
+
+            def close(self):
+                cursor.close()
+
+        return Cursor()
+
+    def start_transaction(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def legacy_extract(connection, day):
+    # the extraction before the JOIN: the day's appointments, then one citizen lookup per appointment
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("SELECT id, scheduled_date, location, notes, citizen_id, staff_id, active "
+                   "FROM vac_management_appointment WHERE DATE(scheduled_date) = %s AND active = 1", (day,))
+    appointments = cursor.fetchall()
+    result = []
+    for app in appointments:
+        cursor.execute("SELECT id, email, first_name, last_name, phone_number FROM vac_management_baseuser "
+                       "WHERE id = %s", (app['citizen_id'],))
+        citizen = cursor.fetchone()
+        result.append({
+            "id": app['id'],
+            "scheduled_date": str(app['scheduled_date']),
+            "location": app['location'],
+            "notes": app['notes'] if app['notes'] else "NO COMMENT",
+            "citizen_id": app['citizen_id'],
+            "staff_id": app['staff_id'],
+            "email": citizen['email'],
+            "patient_name": f"{citizen['first_name']} {citizen['last_name']}",
+            "phone": citizen['phone_number'],
+        })
+    return {"sum_number_of_appointments": len(result), "appointments": result}
+
+
+class ExtractionTests(TestCase):
+    def setUp(self):
+        from utils import valid_appointment_extraction
+
+        self.extraction = valid_appointment_extraction
+        self.day = datetime.now().date() + timedelta(days=1)
+        staff = Staff.objects.create(username='staff', phone_number='0900000001', shift='morning')
+        for i in range(5):
+            citizen = Citizen.objects.create(username=f'citizen_{i}', email=f'c{i}@example.com', first_name='Nguyễn',
+                                             last_name=f'Văn {i}', phone_number=f'090000001{i}')
+            Appointment.objects.create(citizen=citizen, staff=staff if i % 2 else None, scheduled_date=self.day,
+                                       location='Hà Nội', notes=f'note {i}' if i % 3 else None)
+            # other days and cancelled appointments stay out
+            Appointment.objects.create(citizen=citizen, scheduled_date=self.day + timedelta(days=1), location='HN')
+            Appointment.objects.create(citizen=citizen, scheduled_date=self.day, location='HN', active=False)
+
+    def test_matches_legacy_output(self):
+        with self.assertNumQueries(6):
+            expected = legacy_extract(DjangoMySQLConnection(), self.day)
+        path = f'{self.enterContext(tempfile.TemporaryDirectory())}/appointments.ndjson'
+
+        with mock.patch.object(self.extraction, 'APPOINTMENTS_FILE', path), \
+                mock.patch.object(self.extraction, 'get_mysql_connection', DjangoMySQLConnection), \
+                self.assertNumQueries(2):
+            self.assertEqual(self.extraction.save_appointments_to_json(), 5)
+
+        from utils.appointment_stream import iter_appointments, read_header
+
+        header = read_header(path)
+        self.assertEqual(header['sum_number_of_appointments'], expected['sum_number_of_appointments'])
+        self.assertEqual(header['scheduled_date'], str(self.day))
+        records = [app for _, app in iter_appointments(path)]
+        self.assertEqual(records, sorted(expected['appointments'], key=lambda app: app['id']))
+        self.assertEqual((header['min_id'], header['max_id']), (records[0]['id'], records[-1]['id']))
+
+    def test_batches(self):
+        connection = DjangoMySQLConnection()
+        with self.assertNumQueries(1):
+            rows = list(self.extraction.iter_valid_appointments(connection, self.day, batch_size=2))
+        self.assertEqual([self.extraction.to_appointment_data(row) for row in rows],
+                         sorted(legacy_extract(connection, self.day)['appointments'], key=lambda app: app['id']))
+
+
+class AppointmentStreamTests(SimpleTestCase):
+    def setUp(self):
+        from utils import appointment_stream
+
+        self.stream = appointment_stream
+        self.path = f'{self.enterContext(tempfile.TemporaryDirectory())}/out/appointments.ndjson'
+        self.header = {'sum_number_of_appointments': 6, 'scheduled_date': '2025-01-02', 'generated_at': 'run-1',
+                       'min_id': 1, 'max_id': 6}
+        self.apps = [{'id': i, 'email': f'p{i}@example.com', 'patient_name': f'Nguyễn {i}', 'phone': '1',
+                      'scheduled_date': '2025-01-02', 'location': 'Hà Nội', 'notes': 'line\nbreak'}
+                     for i in range(1, 7)]
+
+    def test_round_trip(self):
+        self.assertEqual(self.stream.write_appointments(self.path, self.header, iter(self.apps)), 6)
+
+        self.assertEqual(self.stream.read_header(self.path), self.header)
+        records = list(self.stream.iter_appointments(self.path))
+        self.assertEqual([app for _, app in records], self.apps)
+        offsets = [offset for offset, _ in records]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(offsets[-1], Path(self.path).stat().st_size)
+        self.assertFalse(Path(f'{self.path}.tmp').exists())
+        # resuming from a record's offset starts at the next one
+        self.assertEqual([app for _, app in self.stream.iter_appointments(self.path, offsets[2])], self.apps[3:])
+
+    def test_checkpoint(self):
+        self.stream.write_appointments(self.path, self.header, self.apps)
+        offsets = [offset for offset, _ in self.stream.iter_appointments(self.path)]
+
+        self.assertIsNone(self.stream.load_checkpoint(self.path, self.header))
+        self.stream.save_checkpoint(self.path, self.header, offsets[1])
+        self.assertEqual(self.stream.load_checkpoint(self.path, self.header), offsets[1])
+        # shards keep separate checkpoints, and a new extraction run starts over
+        self.assertIsNone(self.stream.load_checkpoint(self.path, self.header, '.1'))
+        self.assertIsNone(self.stream.load_checkpoint(self.path, {**self.header, 'generated_at': 'run-2'}))
+
+    def send_emails(self, dispatcher, connection, **kwargs):
+        from utils import appointment_email_sender
+
+        with mock.patch.multiple(appointment_email_sender, APPOINTMENTS_FILE=self.path,
+                                 STATUS_FILE=f'{self.path}.status', EMAIL_BATCH_SIZE=1, CHECKPOINT_EVERY=2,
+                                 get_mysql_connection=lambda: connection, get_dispatcher=lambda: dispatcher):
+            appointment_email_sender.send_emails(**kwargs)
+
+    def test_resume_after_partial_run(self):
+        from utils import appointment_email_sender
+
+        self.stream.write_appointments(self.path, self.header, self.apps)
+        offsets = [offset for offset, _ in self.stream.iter_appointments(self.path)]
+        connection = FakeMySQLConnection()
+        dispatcher = FakeDispatcher(failing=[])
+        dispatch = dispatcher.dispatch
+        calls = []
+
+        def crash_on_third_chunk(jobs):
+            calls.append(jobs)
+            if len(calls) == 3:
+                raise ConnectionError('worker lost')
+            return dispatch(jobs)
+
+        with mock.patch.object(dispatcher, 'dispatch', crash_on_third_chunk), \
+                self.assertLogs(appointment_email_sender.logger, 'ERROR'), \
+                self.assertRaises(ConnectionError):
+            self.send_emails(dispatcher, connection)
+        self.assertEqual(dispatcher.sent, [1, 2, 3, 4])
+        self.assertEqual(self.stream.load_checkpoint(self.path, self.header), offsets[3])
+
+        # the retry picks up at the checkpoint and re-claims the rows the crashed chunk left pending
+        self.send_emails(dispatcher, connection)
+        self.assertEqual(dispatcher.sent, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.stream.load_checkpoint(self.path, self.header), offsets[-1])
+        self.assertEqual({status for status, _, _ in connection.rows().values()}, {'sent'})
+
+    def test_shards_cover_the_file_once(self):
+        self.stream.write_appointments(self.path, self.header, self.apps)
+        connection = FakeMySQLConnection()
+        dispatchers = [FakeDispatcher(failing=[]) for _ in range(4)]
+
+        for shard, dispatcher in enumerate(dispatchers):
+            self.send_emails(dispatcher, connection, shard=shard, shards=4)
+
+        sent = [dispatcher.sent for dispatcher in dispatchers]
+        self.assertEqual(sorted(i for ids in sent for i in ids), [app['id'] for app in self.apps])
+        # contiguous id ranges, the last shard is short
+        self.assertEqual(sent, [[1, 2], [3, 4], [5, 6], []])
+        offsets = [offset for offset, _ in self.stream.iter_appointments(self.path)]
+        self.assertEqual([self.stream.load_checkpoint(self.path, self.header, f'.{shard}') for shard in range(4)],
+                         [offsets[1], offsets[3], offsets[5], None])
@@ -0,0 +1,91 @@
+import logging
+import os
+import re
+import threading
+from pathlib import Path, PurePosixPath
+from django.conf import settings
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# name -> (width, height, crop); a cropped variant fills the box, the others fit inside it
+IMAGE_VARIANTS = {
+    'thumbnail': (160, 160, True),
+    'medium': (640, 640, False),
+}
+VARIANT_QUALITY = 82
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def variants():
+    return getattr(settings, 'IMAGE_VARIANTS', IMAGE_VARIANTS)
+
+
+def variants_dir():
+    return getattr(settings, 'IMAGE_VARIANTS_DIR', 'variants')
+
+
+def relative_path(digest, name):
+    # content addressed: the same picture uploaded twice shares its variants
+    return f'{variants_dir()}/{digest[:2]}/{digest}/{name}.jpg'
+
+
+def source_digest(value):
+    # uploads are stored under the sha256 of their content, older images under any other name
+    name = getattr(value, 'public_id', None) or str(value)
+    stem = PurePosixPath(name).name.split('.')[0]
+    return stem if DIGEST_RE.match(stem) else None
+
+
+def flatten(image):
+    # JPEG has no alpha, transparent areas become white instead of black
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def generate(path, digest):
+    # returns {name: path under MEDIA_ROOT} of every variant, stored on the row next to its image
+    if Image is None:
+        logger.warning('Pillow is not installed, no variants generated for %s', digest)
+        return None
+    root = Path(settings.MEDIA_ROOT)
+    stored = {name: relative_path(digest, name) for name in variants()}
+    missing = {name: spec for name, spec in variants().items() if not (root / stored[name]).exists()}
+    if not missing:
+        return stored
+
+    with Image.open(path) as image:
+        # JPEGs decode at a reduced scale when the largest variant allows it
+        image.draft('RGB', (max(w for w, _, _ in missing.values()), max(h for _, h, _ in missing.values())))
+        image = flatten(ImageOps.exif_transpose(image))
+    for name, (width, height, crop) in missing.items():
+        if crop:
+            variant = ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+        else:
+            variant = image.copy()
+            variant.thumbnail((width, height), Image.Resampling.LANCZOS)
+        target = root / relative_path(digest, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed, a reader never sees half a file
+        partial = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}')
+        variant.save(partial, 'JPEG', quality=VARIANT_QUALITY, optimize=True, progressive=True)
+        os.replace(partial, target)
+    return stored
+
+
+def variant_urls(stored, request=None):
+    if not stored:
+        return None
+    urls = {name: settings.MEDIA_URL + path for name, path in stored.items()}
+    if request is not None:
+        urls = {name: request.build_absolute_uri(url) for name, url in urls.items()}
+    return urls
+
@@ -0,0 +1,127 @@
+from django.db import transaction
+from django.db.models import F, Subquery
+from vac_management.models import *
+
+# what the history endpoint returns per event, newest first
+HISTORY_FIELDS = ('source', 'source_id', 'event_date', 'status', 'vaccine_id', 'vaccine_name', 'category_id',
+                  'category_name', 'doctor_id', 'doctor_name', 'location', 'appointment_id', 'campaign_id',
+                  'campaign_name', 'dose_quantity', 'cost', 'notes')
+HISTORY_ORDERING = ('-event_date', 'source', '-source_id')
+
+# fields of a parent copied into its events, a save that touches none of them leaves the timeline alone
+DENORMALIZED_FIELDS = {
+    Appointment: {'citizen', 'citizen_id', 'scheduled_date', 'location', 'active'},
+    Campaign: {'campaign_name', 'location', 'active'},
+    Vaccine: {'vaccine_name', 'category', 'category_id'},
+    VaccineCategory: {'category_name'},
+    Doctor: {'first_name', 'last_name', 'username'},
+}
+
+
+def doctor_name(first_name, last_name, username):
+    return f'{first_name or ""} {last_name or ""}'.strip() or username
+
+
+def appointment_vaccine_events(queryset):
+    rows = (queryset.filter(active=True, appointment__active=True)
+            .order_by()
+            .values('id', 'status', 'vaccine_id', 'doctor_id', 'appointment_id', 'cost', 'notes', 'dose_quantity_used',
+                    citizen_id=F('appointment__citizen_id'), event_date=F('appointment__scheduled_date'),
+                    location=F('appointment__location'), vaccine_name=F('vaccine__vaccine_name'),
+                    category_id=F('vaccine__category_id'), category_name=F('vaccine__category__category_name'),
+                    doctor_first_name=F('doctor__first_name'), doctor_last_name=F('doctor__last_name'),
+                    doctor_username=F('doctor__username')))
+    for row in rows:
+        yield VaccinationEvent(source='appointment_vaccine', source_id=row['id'], citizen_id=row['citizen_id'],
+                               event_date=row['event_date'], status=row['status'], vaccine_id=row['vaccine_id'],
+                               vaccine_name=row['vaccine_name'], category_id=row['category_id'],
+                               category_name=row['category_name'], doctor_id=row['doctor_id'],
+                               doctor_name=doctor_name(row['doctor_first_name'], row['doctor_last_name'],
+                                                       row['doctor_username']),
+                               location=row['location'], appointment_id=row['appointment_id'],
+                               dose_quantity=row['dose_quantity_used'], cost=row['cost'], notes=row['notes'])
+
+
+def campaign_citizen_events(queryset):
+    # a campaign may give several vaccines, the event names the campaign rather than one of them
+    rows = (queryset.filter(active=True, campaign__active=True)
+            .order_by()
+            .values('id', 'citizen_id', 'campaign_id', 'notes', event_date=F('injection_date'),
+                    campaign_name=F('campaign__campaign_name'), location=F('campaign__location')))
+    for row in rows:
+        yield VaccinationEvent(source='campaign_citizen', source_id=row['id'], citizen_id=row['citizen_id'],
+                               event_date=row['event_date'], location=row['location'],
+                               campaign_id=row['campaign_id'], campaign_name=row['campaign_name'], notes=row['notes'])
+
+
+SOURCES = {
+    'appointment_vaccine': (AppointmentVaccine, appointment_vaccine_events),
+    'campaign_citizen': (CampaignCitizen, campaign_citizen_events),
+}
+
+
+def refresh(source, ids):
+    # rewrites the events of these source rows; inactive or deleted ones are left out
+    ids = list(ids)
+    if not ids:
+        return 0
+    model, events_func = SOURCES[source]
+    with transaction.atomic():
+        VaccinationEvent.objects.filter(source=source, source_id__in=ids).delete()
+        return len(VaccinationEvent.objects.bulk_create(events_func(model.objects.filter(pk__in=ids))))
+
+
+def remove(source, ids):
+    VaccinationEvent.objects.filter(source=source, source_id__in=list(ids)).delete()
+
+
+def needs_refresh(instance, update_fields):
+    return update_fields is None or bool(DENORMALIZED_FIELDS[type(instance)] & set(update_fields))
+
+
+def parent_saved(instance):
+    if isinstance(instance, Appointment):
+        refresh('appointment_vaccine', instance.appointmentvaccine_set.values_list('id', flat=True))
+    elif isinstance(instance, Campaign):
+        refresh('campaign_citizen', instance.campaigncitizen_set.values_list('id', flat=True))
+    # renames touch many events, they are updated in place and only where the copy differs
+    elif isinstance(instance, Vaccine):
+        (VaccinationEvent.objects.filter(vaccine_id=instance.pk)
+         .exclude(vaccine_name=instance.vaccine_name, category_id=instance.category_id)
+         .update(vaccine_name=instance.vaccine_name, category_id=instance.category_id,
+                 category_name=Subquery(VaccineCategory.objects.filter(pk=instance.category_id)
+                                        .values('category_name')[:1])))
+    elif isinstance(instance, VaccineCategory):
+        (VaccinationEvent.objects.filter(vaccine_id__in=instance.vaccine_set.values_list('id', flat=True))
+         .exclude(category_name=instance.category_name)
+         .update(category_name=instance.category_name))
+    elif isinstance(instance, Doctor):
+        name = doctor_name(instance.first_name, instance.last_name, instance.username)
+        VaccinationEvent.objects.filter(doctor_id=instance.pk).exclude(doctor_name=name).update(doctor_name=name)
+
+
+def vaccine_deleted(vaccine_id):
+    # the appointment vaccines keep their rows with the vaccine set to NULL, without a signal
+    VaccinationEvent.objects.filter(vaccine_id=vaccine_id).update(vaccine_id=None, vaccine_name=None,
+                                                                  category_id=None, category_name=None)
+
+
+def history(citizen_id):
+    return list(VaccinationEvent.objects.filter(citizen_id=citizen_id)
+                .order_by(*HISTORY_ORDERING)
+                .values(*HISTORY_FIELDS))
+
+
+def rebuild(batch_size=1000):
+    created = 0
+    with transaction.atomic():
+        VaccinationEvent.objects.all().delete()
+        for model, events_func in SOURCES.values():
+            events = []
+            for event in events_func(model.objects.all()):
+                events.append(event)
+                if len(events) >= batch_size:
+                    created += len(VaccinationEvent.objects.bulk_create(events))
+                    events = []
+            created += len(VaccinationEvent.objects.bulk_create(events))
+    return created
@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+from pathlib import Path
+from django.apps import apps
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from vac_management import thumbnails
+from vac_management.models import PendingAsset
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_MAX_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 2
+# an upload claimed longer ago than this belongs to a worker that died
+UPLOAD_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+class CloudinaryBackend:
+    def upload(self, path, asset):
+        import cloudinary.uploader
+
+        # resized by Cloudinary on the way in, only the limited image is stored
+        size = getattr(settings, 'UPLOAD_MAX_DIMENSION', 1600)
+        # named by content, an image uploaded again replaces itself
+        result = cloudinary.uploader.upload(path, public_id=asset.digest or None,
+                                            transformation=[{'width': size, 'height': size, 'crop': 'limit'}])
+        return result['public_id']
+
+
+class LocalBackend:
+    # stand-in for tests and development, files are copied under MEDIA_ROOT
+    def upload(self, path, asset):
+        directory = Path(settings.MEDIA_ROOT) / getattr(settings, 'UPLOAD_LOCAL_DIR', 'uploads')
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f'{asset.digest or asset.token.hex}{Path(asset.original_name or "").suffix.lower()}'
+        shutil.copyfile(path, directory / name)
+        return f'{directory.name}/{name}'
+
+
+def get_backend():
+    return import_string(getattr(settings, 'UPLOAD_BACKEND', 'vac_management.uploads.CloudinaryBackend'))()
+
+
+def spool_dir():
+    # kept out of MEDIA_ROOT, the raw uploads are never served
+    return Path(getattr(settings, 'UPLOAD_SPOOL_DIR', Path(settings.BASE_DIR) / 'spool'))
+
+
+def spool(file):
+    directory = spool_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / uuid.uuid4().hex
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        for chunk in file.chunks():
+            digest.update(chunk)
+            out.write(chunk)
+    return path, digest.hexdigest()
+
+
+class UploadPool:
+    # one pool per process; UPLOAD_WORKERS = 0 uploads inline after commit
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = set()
+
+    def submit(self, asset_id):
+        workers = getattr(settings, 'UPLOAD_WORKERS', 4)
+        if not workers:
+            process(asset_id)
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+            future = self.executor.submit(self.run, asset_id)
+            self.futures.add(future)
+        future.add_done_callback(self.discard)
+
+    def run(self, asset_id):
+        try:
+            process(asset_id)
+        except Exception:
+            logger.exception('Upload of pending asset %s failed', asset_id)
+        finally:
+            # worker threads open their own connections
+            connections.close_all()
+
+    def discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def wait(self, timeout=None):
+        with self.lock:
+            futures = list(self.futures)
+        return wait(futures, timeout=timeout)
+
+
+pool = UploadPool()
+
+
+def queue(instance, field, file):
+    path, digest = spool(file)
+    asset = PendingAsset.objects.create(model=instance._meta.label_lower, object_id=instance.pk, field=field,
+                                        spool_path=str(path), digest=digest, original_name=(file.name or '')[-255:],
+                                        size=file.size or 0)
+    # the worker reads the row, so it starts once the row is committed
+    transaction.on_commit(lambda: pool.submit(asset.pk))
+    instance.__dict__.setdefault('_pending_uploads', {})[field] = asset
+    return asset
+
+
+def retry_locked(func, *args):
+    # a lock wait timeout or deadlock against another writer of the row, the statement is retried
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        try:
+            return func(*args)
+        except OperationalError as e:
+            if attempt + 1 == UPLOAD_MAX_ATTEMPTS:
+                raise
+            logger.warning('%s failed (attempt %d): %s', func.__name__, attempt + 1, e)
+            time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+
+def claim(asset_id):
+    now = timezone.now()
+    return (PendingAsset.objects.filter(pk=asset_id)
+            .filter(Q(status='pending') | Q(status='uploading', claimed_at__lt=now - UPLOAD_CLAIM_TIMEOUT))
+            .update(status='uploading', claimed_at=now))
+
+
+def count_attempt(asset_id):
+    PendingAsset.objects.filter(pk=asset_id).update(attempts=F('attempts') + 1)
+
+
+def mark_failed(asset_id, error):
+    PendingAsset.objects.filter(pk=asset_id).update(status='failed', error=error, finished_at=timezone.now())
+
+
+def process(asset_id):
+    if not retry_locked(claim, asset_id):
+        return None
+    asset = PendingAsset.objects.get(pk=asset_id)
+
+    backend = get_backend()
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        retry_locked(count_attempt, asset_id)
+        try:
+            public_id = backend.upload(asset.spool_path, asset)
+            break
+        except Exception as e:
+            logger.warning('Upload of pending asset %s failed (attempt %d): %s', asset_id, attempt + 1, e)
+            error = str(e)
+            if attempt + 1 < UPLOAD_MAX_ATTEMPTS:
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+    else:
+        retry_locked(mark_failed, asset_id, error)
+        return asset
+
+    stored = None
+    if asset.digest:
+        # before the field points at the image, so its variants are there as soon as it shows
+        try:
+            stored = thumbnails.generate(asset.spool_path, asset.digest)
+        except OSError as e:
+            # not an image Pillow reads, it is stored without variants
+            logger.warning('No variants for pending asset %s: %s', asset_id, e)
+        except Exception:
+            logger.exception('Could not generate the variants of pending asset %s', asset_id)
+    retry_locked(apply, asset, public_id, stored)
+    Path(asset.spool_path).unlink(missing_ok=True)
+    return asset
+
+
+def apply(asset, public_id, stored=None):
+    # the row stays locked from the check to the asset marked done, so of two uploads finishing together
+    # the later one waits and sees the other done; an upload queued later and already finished wins
+    model = apps.get_model(asset.model)
+    with transaction.atomic():
+        instance = model.objects.select_for_update().filter(pk=asset.object_id).first()
+        superseded = PendingAsset.objects.filter(model=asset.model, object_id=asset.object_id, field=asset.field,
+                                                 id__gt=asset.id, status='done').exists()
+        if instance is not None and not superseded:
+            setattr(instance, asset.field, public_id)
+            update_fields = [asset.field]
+            if hasattr(instance, f'{asset.field}_variants'):
+                # the variants of the previous image go with it
+                setattr(instance, f'{asset.field}_variants', stored)
+                update_fields.append(f'{asset.field}_variants')
+            if any(field.name == 'updated_date' for field in model._meta.concrete_fields):
+                update_fields.append('updated_date')
+            # saved with signals, so cached catalog entries and validators follow
+            instance.save(update_fields=update_fields)
+        PendingAsset.objects.filter(pk=asset.pk).update(status='done', public_id=public_id, error=None,
+                                                        finished_at=timezone.now())
+
+
+def requeue(older_than=timedelta(minutes=1), retry_failed=False):
+    # uploads whose worker never ran, e.g. the process restarted with work queued
+    statuses = Q(status='pending') | Q(status='uploading', claimed_at__lt=timezone.now() - UPLOAD_CLAIM_TIMEOUT)
+    if retry_failed:
+        PendingAsset.objects.filter(status='failed').update(status='pending', attempts=0)
+    ids = list(PendingAsset.objects.filter(statuses, created_date__lt=timezone.now() - older_than)
+               .order_by('id').values_list('id', flat=True))
+    return [process(asset_id) for asset_id in ids]
@@ -1,5 +1,5 @@
 from django.urls import path, include
-from . import views
+from . import metrics, views
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -10,6 +10,9 @@ router.register('campaigns', views.CampaignViewSet, basename='campaign')
 router.register('campaignvaccine', views.CampaignVaccineViewSet, basename='campaignvaccine')
 router.register('campaigncitizen', views.CampaignCitizenViewSet, basename='campaigncitizen')
 router.register('appointments', views.AppointmentViewSet, basename='appointment')
+router.register('slots', views.AppointmentSlotViewSet, basename='slot')
+router.register('search', views.SearchViewSet, basename='search')
+router.register('uploads', views.PendingAssetViewSet, basename='upload')
 router.register('citizen', views.CitizenViewSet, basename='citizen')
 router.register('staffs', views.StaffViewSet, basename='staff')
 router.register('doctors', views.DoctorViewSet, basename='doctor')
@@ -20,4 +23,5 @@ router.register('vaccineusage', views.VaccineUsageViewSet, basename='vaccineusag
 urlpatterns = [
     path('', include(router.urls)),
     path('payment-sheet/', views.payment_sheet, name='payment-sheet'),
+    path('metrics/', metrics.metrics_view, name='metrics'),
 ]
@@ -1,21 +1,59 @@
+from collections import defaultdict
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import viewsets, generics, parsers, permissions, status
 from vac_management.models import *
-from vac_management import serializers, perms, paginators
-from django.db.models import Count, Sum, Q
+from vac_management import serializers, perms, paginators, reports, bulk, inventory, search, slots, timeline
+from vac_management.caching import CatalogCacheMixin, ConditionalGetMixin, catalog_cache, catalog_response
+from vac_management.exports import ExportMixin, parse_date_param, parse_int
+from vac_management.fastread import FastReadMixin
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum, Q, F
 from django.db.models.functions import TruncMonth, TruncQuarter, TruncYear
 
 
-class VaccineCategoryViewSet(viewsets.ModelViewSet):
+class RelatedGraphMixin:
+    # relations walked by the serializer, declared once per viewset
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def load_related(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+    def get_queryset(self):
+        return self.load_related(super().get_queryset())
+
+
+class AtomicWriteMixin:
+    # stock movements run in post_save/post_delete, a refused reservation has to undo the write
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            super().perform_create(serializer)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            super().perform_update(serializer)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            super().perform_destroy(instance)
+
+
+class VaccineCategoryViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
     queryset = VaccineCategory.objects.filter(active=True)
     serializer_class = serializers.VaccineCategorySerializer
 
 
-class VaccineViewSet(viewsets.ModelViewSet):
+class VaccineViewSet(CatalogCacheMixin, RelatedGraphMixin, viewsets.ModelViewSet):
     queryset = Vaccine.objects.filter(active=True)
     serializer_class = serializers.VaccineSerializer
     pagination_class = paginators.VaccinePaginator
+    select_related_fields = ('category',)
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -24,85 +62,119 @@ class VaccineViewSet(viewsets.ModelViewSet):
         if category_id:
             queryset = queryset.filter(category_id=category_id)
 
+        q = self.request.query_params.get('q')
+        if q:
+            queryset = search.filter_ranked(queryset, q)
+
         return queryset
 
     @action(methods=['get'], url_path='by-name/(?P<vaccine_name>[^/.]+)', detail=False)
     def get_by_name(self, request, vaccine_name=None):
         try:
-            vaccine = Vaccine.objects.get(vaccine_name__iexact=vaccine_name, active=True)
-            return Response(serializers.VaccineSerializer(vaccine).data)
+            return catalog_response(request, lambda: serializers.VaccineSerializer(
+                self.load_related(Vaccine.objects).get(vaccine_name__iexact=vaccine_name, active=True)).data)
         except Vaccine.DoesNotExist:
             return Response({"detail": "Vaccine not found."}, status=status.HTTP_404_NOT_FOUND)
 
     @action(methods=['get'], detail=True)
     def details(self, request, pk=None):
         try:
-            vaccine = self.get_object()
-            return Response(serializers.VaccineSerializer(vaccine).data)
+            return catalog_response(request, lambda: serializers.VaccineSerializer(self.get_object()).data)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
 
+    @action(methods=['get'], detail=True)
+    def stock(self, request, pk=None):
+        try:
+            data = inventory.get_stock(int(pk))
+        except ValueError:
+            data = None
+        if data is None:
+            return Response({"detail": "Vaccine not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
+
+    @action(methods=['post'], url_path='stock/receipts', detail=True,
+            permission_classes=[perms.IsSuperuserStaffPermission])
+    def receive_stock(self, request, pk=None):
+        vaccine = self.get_object()
+        serializer = serializers.StockReceiptSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        inventory.receive(vaccine.id, serializer.validated_data['quantity'], serializer.validated_data.get('note'))
+        return Response(inventory.get_stock(vaccine.id), status=status.HTTP_201_CREATED)
+
+    @action(methods=['get'], url_path='cache-stats', detail=False,
+            permission_classes=[perms.IsSuperuserStaffPermission])
+    def cache_stats(self, request):
+        return Response(catalog_cache.get_stats())
 
-class CampaignViewSet(viewsets.ModelViewSet):
+
+class CampaignViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Campaign.objects.filter(active=True)
     serializer_class = serializers.CampaignSerializer
     pagination_class = paginators.CampaignPaginator
 
     def get_queryset(self):
-        query = self.queryset
+        query = super().get_queryset()
 
         q = self.request.query_params.get('q')
         if q:
-            query = query.filter(subject__icontains=q)
+            query = search.filter_ranked(query, q)
 
+        # campaigns have no category of their own, they take those of their vaccines
         cate_id = self.request.query_params.get('category_id')
         if cate_id:
-            query = query.filter(category_id=cate_id)
+            query = query.filter(id__in=CampaignVaccine.objects.filter(vaccine__category_id=cate_id, active=True)
+                                 .values('campaign_id'))
 
         return query
 
 
-class CampaignVaccineViewSet(viewsets.ModelViewSet):
+class CampaignVaccineViewSet(AtomicWriteMixin, ConditionalGetMixin, FastReadMixin, RelatedGraphMixin,
+                             viewsets.ModelViewSet):
     queryset = CampaignVaccine.objects.filter(active=True)
     serializer_class = serializers.CampaignVaccineSerializer
     pagination_class = paginators.CampaignPaginator
+    select_related_fields = ('vaccine__category', 'campaign')
 
 
-class CampaignCitizenViewSet(viewsets.ModelViewSet):
+class CampaignCitizenViewSet(ConditionalGetMixin, ExportMixin, FastReadMixin, RelatedGraphMixin,
+                             viewsets.ModelViewSet):
     queryset = CampaignCitizen.objects.filter(active=True)
     serializer_class = serializers.CampaignCitizenSerializer
     pagination_class = paginators.CampaignPaginator
+    select_related_fields = ('campaign', 'citizen')
+    export_name = 'campaigncitizen'
 
     @action(methods=['get'], url_path='stats-by-campaign', detail=False)
     def stats_by_campaign(self, request):
-        stats = (CampaignCitizen.objects
+        stats = (CitizenPeriodStat.objects
+                 .filter(source='campaign', period_type='all')
                  .values('campaign__campaign_name')
-                 .annotate(total_vaccinated=Count('citizen', distinct=True))
+                 .annotate(total_vaccinated=Count('id'))
                  .order_by('campaign__campaign_name'))
         return Response(stats)
 
     @action(methods=['get'], url_path='stats-by-time', detail=False)
     def stats_by_time(self, request):
         period = request.query_params.get('period', 'month')
-        if period == 'month':
-            truncate_func = TruncMonth
-        elif period == 'quarter':
-            truncate_func = TruncQuarter
-        else:
-            truncate_func = TruncYear
+        if period not in ('month', 'quarter'):
+            period = 'year'
 
-        stats = (CampaignCitizen.objects
-                 .annotate(period=truncate_func('injection_date'))
-                 .values('period')
-                 .annotate(total_vaccinated=Count('citizen', distinct=True))
+        stats = (CitizenPeriodStat.objects
+                 .filter(source='campaign', period_type=period, campaign__isnull=True)
+                 .values(period=F('period_start'))
+                 .annotate(total_vaccinated=Count('id'))
                  .order_by('period'))
         return Response(stats)
 
 
-class AppointmentViewSet(viewsets.ModelViewSet):
+class AppointmentViewSet(AtomicWriteMixin, ConditionalGetMixin, ExportMixin, FastReadMixin, RelatedGraphMixin,
+                         viewsets.ModelViewSet):
     queryset = Appointment.objects.filter(active=True)
     serializer_class = serializers.AppointmentSerializer
     pagination_class = paginators.AppointmentPaginator
+    export_name = 'appointments'
+    select_related_fields = ('citizen', 'staff')
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -125,13 +197,26 @@ class AppointmentViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except slots.SlotFull:
+            if request.query_params.get('waitlist') not in ('1', 'true'):
+                raise
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        entry, position = slots.enqueue(serializer.validated_data)
+        return Response({"waitlist_id": entry.id, "position": position}, status=status.HTTP_202_ACCEPTED)
+
     @action(methods=['get'], detail=True)
     def details(self, request, pk=None):
         try:
             appointment = self.get_object()
             appointment_data = serializers.AppointmentSerializer(appointment).data
 
-            vaccines = AppointmentVaccine.objects.filter(appointment=appointment, active=True)
+            vaccines = AppointmentVaccineViewSet.load_related(
+                AppointmentVaccine.objects.filter(appointment=appointment, active=True))
             vaccines_data = serializers.AppointmentVaccineSerializer(vaccines, many=True).data
 
             result = {
@@ -150,99 +235,154 @@ class AppointmentViewSet(viewsets.ModelViewSet):
             if not citizen_id:
                 return Response({"detail": "Citizen ID is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-            appointments = Appointment.objects.filter(citizen_id=citizen_id, active=True)
+            appointments = self.load_related(Appointment.objects.filter(citizen_id=citizen_id, active=True))
             return Response(serializers.AppointmentSerializer(appointments, many=True).data)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
 
+    @action(methods=['get'], detail=False)
+    def history(self, request):
+        # every appointment vaccine and campaign injection of the citizen, from the timeline in one query
+        citizen_id = request.query_params.get('citizen_id')
+        if not citizen_id or not citizen_id.isdigit():
+            return Response({"detail": "Citizen ID is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        events = timeline.history(citizen_id)
+        if not events and not Citizen.objects.filter(pk=citizen_id).exists():
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(events)
+
     @action(methods=['get'], url_path='completion-rate', detail=False)
     def completion_rate(self, request):
         period = request.query_params.get('period', 'month')  # month, quarter, year
-        if period == 'month':
-            truncate_func = TruncMonth
-        elif period == 'quarter':
-            truncate_func = TruncQuarter
-        elif period == 'year':
-            truncate_func = TruncYear
-        total_completed = AppointmentVaccine.objects.filter(status='completed').count()
-        total_cancelled = AppointmentVaccine.objects.filter(status='cancelled').count()
-        queryset = (
-            AppointmentVaccine.objects.filter(active=True)
-            .annotate(period=truncate_func('appointment__scheduled_date'))
-            .values('period', 'status')
+        if period not in ('month', 'quarter', 'year'):
+            return Response({"detail": "Invalid period."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # a filter that does not parse is an error, not a filter silently left out
+        filters = {}
+        for param, parse in (('start_date', parse_date_param), ('end_date', parse_date_param),
+                             ('vaccine_id', parse_int)):
+            value = request.query_params.get(param)
+            if value in (None, ''):
+                continue
+            filters[param] = parse(value)
+            if filters[param] is None:
+                return Response({"detail": f'Invalid value for {param}: "{value}".'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        result = reports.completion_rate(period, location=request.query_params.get('location'), **filters)
+        return Response(result)
+
+    @action(methods=['get'], url_path='people-completed', detail=False)
+    def people_completed(self, request):
+        period_type = request.query_params.get('period', 'month')
+
+        people = (
+            CitizenPeriodStat.objects
+            .filter(source='appointment', period_type=period_type)
+            .values('period_start')
             .annotate(count=Count('id'))
+            .order_by('period_start')
         )
 
-        summary = {}
-        for item in queryset:
-            period = item['period'].isoformat()
-            status = item['status']
-            count = item['count']
-
-            if period not in summary:
-                summary[period] = {
-                    'total_completed': 0,
-                    'total_cancelled': 0,
-                    'total_appointments': 0,
-                    'completion_rate_percent': 0,
-                }
-
-            if status == 'completed':
-                summary[period]['total_completed'] += count
-            elif status == 'cancelled':
-                summary[period]['total_cancelled'] += count
-
-            summary[period]['total_appointments'] += count
-
-        # Tính tỷ lệ hoàn thành (%)
-        for stats in summary.values():
-            total = stats['total_appointments']
-            if total > 0:
-                stats['completion_rate_percent'] = round(stats['total_completed'] / total * 100, 2)
-
         result = [
             {
-                'period': period,
-                **stats
+                'period': item['period_start'].isoformat(),
+                'people_completed_count': item['count']
             }
-            for period, stats in sorted(summary.items())
+            for item in people
         ]
 
         return Response(result)
 
-    @action(methods=['get'], url_path='people-completed', detail=False)
-    def people_completed(self, request):
-        period_type = request.query_params.get('period', 'month')
 
-        if period_type == 'month':
-            truncate_func = TruncMonth
-        elif period_type == 'quarter':
-            truncate_func = TruncQuarter
-        elif period_type == 'year':
-            truncate_func = TruncYear
+class AppointmentSlotViewSet(viewsets.ModelViewSet):
+    queryset = AppointmentSlot.objects.all()
+    serializer_class = serializers.AppointmentSlotSerializer
+    pagination_class = paginators.SlotPaginator
 
-        appointments = (
-            Appointment.objects
-            .filter(active=True)
-            .annotate(period=truncate_func('scheduled_date'))
-            .values('period', 'citizen_id')
-            .distinct()
-        )
+    def get_permissions(self):
+        if self.request.method in permissions.SAFE_METHODS:
+            return [permissions.AllowAny()]
+        return [perms.IsSuperuserStaffPermission()]
 
-        grouped = {}
-        for item in appointments:
-            period = item['period'].isoformat()
-            grouped.setdefault(period, set()).add(item['citizen_id'])
+    def get_queryset(self):
+        queryset = super().get_queryset()
 
-        result = [
-            {
-                'period': period,
-                'people_completed_count': len(citizen_ids)
-            }
-            for period, citizen_ids in sorted(grouped.items())
-        ]
+        location = self.request.query_params.get('location')
+        if location:
+            queryset = queryset.filter(location=slots.normalize_location(location))
+
+        date = self.request.query_params.get('date')
+        if date:
+            queryset = queryset.filter(date=date)
+
+        date_from = self.request.query_params.get('date_from')
+        if date_from:
+            queryset = queryset.filter(date__gte=date_from)
+
+        date_to = self.request.query_params.get('date_to')
+        if date_to:
+            queryset = queryset.filter(date__lte=date_to)
+
+        shift = self.request.query_params.get('shift')
+        if shift is not None:
+            queryset = queryset.filter(shift=shift)
+
+        # availability comes from the booked counter, never from counting appointments
+        if self.request.query_params.get('available') in ('1', 'true'):
+            queryset = queryset.filter(booked__lt=F('capacity'))
+
+        return queryset
+
+    def perform_create(self, serializer):
+        slots.recount(serializer.save())
+
+    def perform_update(self, serializer):
+        # a new location, date or shift covers other appointments
+        slots.recount(serializer.save())
+
+
+class SearchViewSet(viewsets.ViewSet):
+    # ranked matches across the catalog, ?q=...&type=vaccine,campaign,category
+    max_limit = 50
+    result_types = {
+        'vaccine': (Vaccine.objects.filter(active=True).select_related('category'), serializers.VaccineSerializer),
+        'campaign': (Campaign.objects.filter(active=True), serializers.CampaignSerializer),
+        'category': (VaccineCategory.objects.filter(active=True), serializers.VaccineCategorySerializer),
+    }
+
+    def list(self, request):
+        q = request.query_params.get('q', '')
+        doc_types = [t for t in request.query_params.get('type', '').split(',') if t]
+        if any(t not in self.result_types for t in doc_types):
+            return Response({"detail": f"type must be among {', '.join(self.result_types)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(request.query_params.get('limit', search.SEARCH_LIMIT)), self.max_limit)
+        except ValueError:
+            return Response({"detail": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        hits = search.search(q, doc_types, limit=max(limit, 1))
+        ids = defaultdict(list)
+        for doc_type, object_id, _ in hits:
+            ids[doc_type].append(object_id)
+        objects = {doc_type: self.result_types[doc_type][0].in_bulk(pks) for doc_type, pks in ids.items()}
+
+        results = []
+        for doc_type, object_id, score in hits:
+            obj = objects[doc_type].get(object_id)
+            if obj is not None:
+                results.append({'type': doc_type, 'id': object_id, 'score': score,
+                                'object': self.result_types[doc_type][1](obj).data})
+        return Response({'query': q, 'results': results})
 
-        return Response(result)
+
+class PendingAssetViewSet(viewsets.ViewSet, generics.RetrieveAPIView):
+    # progress of a queued upload, polled with the token returned under pending_uploads
+    queryset = PendingAsset.objects.all()
+    serializer_class = serializers.PendingAssetSerializer
+    lookup_field = 'token'
 
 
 class VaccineUsageViewSet(viewsets.ViewSet, generics.GenericAPIView):
@@ -256,49 +396,34 @@ class VaccineUsageViewSet(viewsets.ViewSet, generics.GenericAPIView):
         elif period == 'year':
             truncate_func = TruncYear
 
-        appointment_usage = (
-            AppointmentVaccine.objects
-            .filter(status='completed')
-            .annotate(period=truncate_func('appointment__scheduled_date'))
-            .values('period', 'vaccine__category__category_name')
-            .annotate(usage=Sum('dose_quantity_used'))
-            .values('period', 'vaccine__category__category_name', 'dose_quantity_used')
-        )
-
-        campaign_usage = (
-            CampaignVaccine.objects
-            .annotate(period=truncate_func('campaign__start_date'))
-            .values('period', 'vaccine__category__category_name')
-            .annotate(usage=Sum('dose_quantity_used'))
-            .values('period', 'vaccine__category__category_name', 'dose_quantity_used')
+        usage = (
+            VaccinationDailyStat.objects
+            .filter(Q(source='appointment_vaccine', status='completed') | Q(source='campaign_vaccine'))
+            .annotate(period=truncate_func('day'))
+            .values('period', 'category__category_name')
+            .annotate(usage=Sum('doses'))
         )
 
-        combined = {}
-        for item in appointment_usage:
-            key = (item['period'].isoformat(), item['vaccine__category__category_name'])
-            combined[key] = combined.get(key, 0) + item['dose_quantity_used']
-
-        for item in campaign_usage:
-            key = (item['period'].isoformat(), item['vaccine__category__category_name'])
-            combined[key] = combined.get(key, 0) + item['dose_quantity_used']
-
         result = [
             {
-                'period': period,
-                'category_name': category_name,
-                'dose_quantity_used': dose_quantity_used,
+                'period': item['period'].isoformat(),
+                'category_name': item['category__category_name'],
+                'dose_quantity_used': item['usage'],
             }
-            for (period, category_name), dose_quantity_used in combined.items()
+            for item in usage
         ]
 
-        result = sorted(result, key=lambda x: (x['period'], x['category_name']))
+        result = sorted(result, key=lambda x: (x['period'], x['category_name'] or ''))
         return Response(result)
 
 
-class AppointmentVaccineViewSet(viewsets.ModelViewSet):
+class AppointmentVaccineViewSet(AtomicWriteMixin, ConditionalGetMixin, ExportMixin, FastReadMixin,
+                                RelatedGraphMixin, viewsets.ModelViewSet):
     queryset = AppointmentVaccine.objects.filter(active=True)
     serializer_class = serializers.AppointmentVaccineSerializer
     pagination_class = paginators.AppointmentVaccinesPaginator
+    export_name = 'appointmentvaccine'
+    select_related_fields = ('vaccine__category', 'doctor', 'appointment__citizen', 'appointment__staff')
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -322,6 +447,42 @@ class AppointmentVaccineViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
 
+    def get_bulk_items(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return None, Response({"detail": "Expected a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > bulk.BULK_MAX_ITEMS:
+            return None, Response({"detail": f"At most {bulk.BULK_MAX_ITEMS} items per request."},
+                                  status=status.HTTP_400_BAD_REQUEST)
+        return items, None
+
+    @action(methods=['post'], url_path='bulk-create', detail=False)
+    def bulk_create(self, request):
+        items, error = self.get_bulk_items(request)
+        if error:
+            return error
+
+        try:
+            ids = bulk.bulk_create_appointment_vaccines(items)
+        except bulk.BulkError as e:
+            return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            return Response({"detail": "Some items were created concurrently, retry the request."},
+                            status=status.HTTP_409_CONFLICT)
+        return Response({"created": ids}, status=status.HTTP_201_CREATED)
+
+    @action(methods=['post'], url_path='bulk-status', detail=False)
+    def bulk_status(self, request):
+        items, error = self.get_bulk_items(request)
+        if error:
+            return error
+
+        try:
+            ids = bulk.bulk_update_status(items)
+        except bulk.BulkError as e:
+            return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"updated": ids})
+
 
 class CitizenViewSet(viewsets.ViewSet, generics.CreateAPIView, generics.UpdateAPIView):
     queryset = Citizen.objects.filter(is_active=True)
@@ -429,44 +590,44 @@ class UserViewSet(viewsets.ViewSet, generics.CreateAPIView, generics.UpdateAPIVi
         return Response(serializers.BaseUserSerializer(request.user).data)
 
 
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
-import stripe, os, json
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from vac_management import payments
+import json
+
 
-STRIPE_API_VERSION = f"{os.getenv('STRIPE_API_VERSION')}"
-STRIPE_SECRET_KEY = f"{os.getenv('STRIPE_SECRET_KEY')}"
-stripe.api_version = STRIPE_API_VERSION
-stripe.api_key = STRIPE_SECRET_KEY
+@sync_to_async
+def authenticate(request):
+    # a plain Django view, so the API's OAuth2 and token authentication run here. Not the session:
+    # the view is csrf_exempt, a browser's cookies must not create intents from another site
+    try:
+        user = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]).user
+    except exceptions.AuthenticationFailed:
+        return None
+    return user if user.is_authenticated else None
 
 
 @csrf_exempt
-def payment_sheet(request):
+async def payment_sheet(request):
+    # {"vaccine_id": <appointment vaccine id>} or {"appointment_vaccine_ids": [...]} for one intent over several,
+    # of the authenticated citizen; staff and doctors take payment for any citizen
     if request.method != "POST":
         return JsonResponse({'error': 'Invalid request'}, status=400)
 
+    user = await authenticate(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided.'}, status=401)
+
     try:
         data = json.loads(request.body)
-        av_id = data.get('vaccine_id')
-        av = AppointmentVaccine.objects.get(id=av_id)
-        amount = int(av.cost * 100)
-        customer = stripe.Customer.create()
-
-        ephemeral_key = stripe.EphemeralKey.create(
-            customer=customer.id,
-            stripe_version=STRIPE_API_VERSION
-        )
-
-        payment_intent = stripe.PaymentIntent.create(
-            amount=amount,
-            currency='usd',
-            customer=customer.id,
-            automatic_payment_methods={"enabled": True},
-        )
-
-        return JsonResponse({
-            'paymentIntent': payment_intent.client_secret,
-            'ephemeralKey': ephemeral_key.secret,
-            'customer': customer.id
-        })
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
+        ids = data.get('appointment_vaccine_ids') or [data.get('vaccine_id')]
+        citizen_id = None if await payments.pays_for_anyone(user) else user.pk
+        return JsonResponse(await payments.create_payment_sheet(ids, citizen_id))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    except payments.PaymentError as e:
+        return JsonResponse({'error': str(e)}, status=e.status_code)
@@ -59,7 +59,6 @@ export default {
       BASE_URL: process.env.BASE_URL,
       GEMINI_API_KEY: process.env.GEMINI_API_KEY,
       GOOGLE_WEB_CLIENT_ID: process.env.GOOGLE_WEB_CLIENT_ID,
-      STRIPE_SECRET_KEY: process.env.STRIPE_SECRET_KEY,
       STRIPE_PUBLISHABLE_KEY: process.env.STRIPE_PUBLISHABLE_KEY,
       eas: {
         projectId: process.env.EAS_PROJECT_ID,
@@ -19,7 +19,7 @@ import commonStyles, { COLORS, FONT_SIZE, SPACING } from '../../styles/MyStyles'
 import { useNavigation } from "@react-navigation/native";
 import { MyDispatchContext, MyUserContext } from "../../utils/MyContexts";
 import { useContext } from "react";
-import Apis, { endpoints } from "../../utils/Apis";
+import Apis, { authApis, endpoints } from "../../utils/Apis";
 import { TextInput } from "react-native-paper";
 import * as Print from 'expo-print';
 import * as Sharing from 'expo-sharing';
@@ -28,7 +28,7 @@ import { signOut } from 'firebase/auth';
 import { auth } from '../../../config/Firebase';
 import { Ionicons } from '@expo/vector-icons';
 import { StripeProvider, usePaymentSheet } from '@stripe/stripe-react-native';
-const { STRIPE_SECRET_KEY, STRIPE_PUBLISHABLE_KEY, BASE_URL } = Constants.expoConfig.extra;
+const { STRIPE_PUBLISHABLE_KEY } = Constants.expoConfig.extra;
 
 const HomeScreen = () => {
   const nav = useNavigation();
@@ -84,17 +84,10 @@ const HomeScreen = () => {
 
   const fetchPaymentSheetParams = async (i) => {
     const token = await AsyncStorage.getItem('token');
-    const response = await fetch(`${BASE_URL}/payment-sheet/`, {
-      method: 'POST',
-      headers: {
-        'Authorization': `Bearer ${STRIPE_SECRET_KEY}`,
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        vaccine_id: i,
-      })
+    const response = await authApis(token).post(endpoints['payment-sheet'], {
+      vaccine_id: i,
     });
-    const { paymentIntent, ephemeralKey, customer } = await response.json();
+    const { paymentIntent, ephemeralKey, customer } = response.data;
     return {
       paymentIntent,
       ephemeralKey,
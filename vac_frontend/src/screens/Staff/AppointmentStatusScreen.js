@@ -24,7 +24,7 @@ import { useContext } from "react";
 import { ActivityIndicator, HelperText, List, TextInput } from 'react-native-paper';
 import { Picker } from '@react-native-picker/picker';
 import { StripeProvider, usePaymentSheet } from '@stripe/stripe-react-native';
-const { STRIPE_SECRET_KEY, STRIPE_PUBLISHABLE_KEY, BASE_URL } = Constants.expoConfig.extra;
+const { STRIPE_PUBLISHABLE_KEY } = Constants.expoConfig.extra;
 import AsyncStorage from "@react-native-async-storage/async-storage";
 const AppointmentStatusScreen = () => {
   const nav = useNavigation();
@@ -34,6 +34,7 @@ const AppointmentStatusScreen = () => {
   const [vaccines, setVaccines] = useState([]);
   const [loading, setLoading] = useState(false);
   const [page, setPage] = useState(1);
+  const [nextUrl, setNextUrl] = useState(null);
   const [msg, setMsg] = useState(null);
   const [selectedData, setSelectedData] = useState(null);
   const [isEditModalVisible, setIsEditModalVisible] = useState(false);
@@ -60,17 +61,10 @@ const AppointmentStatusScreen = () => {
 
   const fetchPaymentSheetParams = async (i) => {
     const token = await AsyncStorage.getItem('token');
-    const response = await fetch(`${BASE_URL}/payment-sheet/`, {
-      method: 'POST',
-      headers: {
-        'Authorization': `Bearer ${STRIPE_SECRET_KEY}`,
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        vaccine_id: i,
-      })
+    const response = await authApis(token).post(endpoints['payment-sheet'], {
+      vaccine_id: i,
     });
-    const { paymentIntent, ephemeralKey, customer } = await response.json();
+    const { paymentIntent, ephemeralKey, customer } = response.data;
     return {
       paymentIntent,
       ephemeralKey,
@@ -135,15 +129,15 @@ const AppointmentStatusScreen = () => {
     if (page > 0) {
       try {
         setLoading(true);
-        const url = `${endpoints['appointmentvaccine']}?page=${page}`;
+        const url = page === 1 ? endpoints['appointmentvaccine'] : nextUrl;
         const response = await Apis.get(url);
         const data = response.data;
 
         if (data?.results) { setAppointmentVaccines([...appointmentVaccines, ...data.results]); }
         else { setAppointmentVaccines([...appointmentVaccines, ...data]); }
 
+        setNextUrl(data.next);
         if (data.next === null) { setPage(0); }
-        else if (data?.results.next === null) { setPage(0); }
 
       } catch (error) {
         console.error('Error fetching appointment vaccines:', error);
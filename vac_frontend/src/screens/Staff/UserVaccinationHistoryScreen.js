@@ -29,6 +29,7 @@ const UserVaccinationHistory = () => {
   const [usersdata, setUsersData] = useState([]);
   const [loading, setLoading] = useState(true);
   const [page, setPage] = useState(1);
+  const [nextUrl, setNextUrl] = useState(null);
   const [msg, setMsg] = useState(null);
 
   const loadUsersData = async () => {
@@ -36,7 +37,7 @@ const UserVaccinationHistory = () => {
       try {
         setLoading(true);
         const token = await AsyncStorage.getItem('token');
-        const url = `${endpoints['get-users']}?page=${page}`;
+        const url = page === 1 ? endpoints['get-users'] : nextUrl;
         const response = await Apis.get(url, {
           headers: {
             Authorization: `Bearer ${token}`
@@ -47,6 +48,7 @@ const UserVaccinationHistory = () => {
         if (data?.results) { setUsersData([...usersdata, ...data.results]); }
         else { setUsersData([...usersdata, ...data]); }
 
+        setNextUrl(data.next);
         if (data.next === null) { setPage(0); }
 
       } catch (error) {
@@ -19,6 +19,7 @@ export const endpoints = {
   'campaigncitizen': '/campaigncitizen/',
   'vaccineusage': '/vaccineusage/vaccine-types-by-time/',
   'people-completed': '/appointments/people-completed/',
+  'payment-sheet': '/payment-sheet/',
 };
 
 export const authApis = (token) => {